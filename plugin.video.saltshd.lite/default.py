@@ -25,16 +25,23 @@ import xbmcgui
 import xbmc
 import xbmcvfs
 import json
+import bisect
+import hashlib
+import xbmcaddon
 import urlresolver
 from Queue import Queue, Empty
-from salts_lib.db_utils import DB_Connection, DatabaseRecoveryError
+from salts_lib.db_utils import DatabaseRecoveryError, get_db_connection, close_db_connections
 from salts_lib.url_dispatcher import URL_Dispatcher
 from salts_lib.srt_scraper import SRT_Scraper
 from salts_lib.trakt_api import Trakt_API, TransientTraktError, TraktNotFoundError, TraktError, TraktAuthError
+from salts_lib.trakt_api import BASE_URL as TRAKT_HOST
 from salts_lib import utils
 from salts_lib import utils2
 from salts_lib import log_utils
 from salts_lib import gui_utils
+from salts_lib import scraper_health
+from salts_lib import stream_probe
+from salts_lib import downloader
 from salts_lib import kodi
 from salts_lib.kodi import i18n
 from salts_lib.constants import *
@@ -49,6 +56,7 @@ OFFLINE = kodi.get_setting('trakt_offline') == 'true'
 trakt_api = Trakt_API(TOKEN, use_https, list_size, trakt_timeout, OFFLINE)
 
 url_dispatcher = URL_Dispatcher()
+LIBRARY_TIMEOUT = 10 * 60  # seconds a subscription update waits for the next item before giving up on the rest
 
 @url_dispatcher.register(MODES.MAIN)
 def main_menu():
@@ -263,6 +271,7 @@ def force_refresh(refresh_mode, section=None, slug=None, username=None):
         try:
             workers, _ = get_progress(cached=False)
         finally:
+            utils2.cancel_workers(workers)
             utils2.reap_workers(workers, None)
     elif refresh_mode == MODES.MY_CAL:
         trakt_api.get_my_calendar(start_date, 8, cached=False)
@@ -313,6 +322,7 @@ def scraper_settings():
     kodi.create_item({'mode': MODES.TOGGLE_ALL}, label, thumb=utils2.art('scraper.png'), fanart=utils2.art('fanart.jpg'))
     COLORS = ['green', 'limegreen', 'greenyellow', 'yellowgreen', 'yellow', 'orange', 'darkorange', 'orangered', 'red', 'darkred']
     fail_limit = int(kodi.get_setting('disable-limit'))
+    scoreboard = scraper_health.Scoreboard()
     
     for i, cls in enumerate(scrapers):
         name = cls.get_name()
@@ -332,7 +342,7 @@ def scraper_settings():
         else:
             index = min([(int(failures) * (len(COLORS) - 1) / fail_limit), len(COLORS) - 1])
             
-        label = '%s. %s [COLOR %s][FL: %s][/COLOR]:' % (i + 1, label, COLORS[index], failures)
+        label = '%s. %s [COLOR %s][FL: %s][/COLOR] [%s]:' % (i + 1, label, COLORS[index], failures, scoreboard.get(name))
 
         menu_items = []
         if i > 0:
@@ -364,6 +374,9 @@ def reset_rel_urls(name):
 @url_dispatcher.register(MODES.RESET_FAILS, ['name'])
 def reset_fails(name):
     kodi.set_setting('%s_last_results' % (name), '0')
+    scoreboard = scraper_health.Scoreboard()
+    scoreboard.get(name).reset()
+    scoreboard.save()
     kodi.refresh_container()
 
 @url_dispatcher.register(MODES.MOVE_TO, ['name'])
@@ -491,6 +504,7 @@ def show_history(section, page=1):
     content_type = CONTENT_TYPES.EPISODES if section == SECTIONS.TV else CONTENT_TYPES.MOVIES
     utils2.set_view(content_type)
     kodi.end_of_directory()
+    trakt_api.prefetch_next_page()
 
 @url_dispatcher.register(MODES.MY_CAL, ['mode'], ['start_date'])
 @url_dispatcher.register(MODES.CAL, ['mode'], ['start_date'])
@@ -557,6 +571,7 @@ def browse_liked_lists(section, page=1):
         label = '%s >>' % (i18n('next_page'))
         kodi.create_item(query, label, thumb=utils2.art('nextpage.png'), fanart=utils2.art('fanart.jpg'), is_folder=True)
     kodi.end_of_directory()
+    trakt_api.prefetch_next_page()
 
 @url_dispatcher.register(MODES.OTHER_LISTS, ['section'])
 def browse_other_lists(section):
@@ -790,7 +805,8 @@ def get_progress(cached=True):
                 log_utils.log('Skipping %s (%s) as cached MNE ended exclusion' % (trakt_id, show['show']['title']), log_utils.LOGDEBUG)
                 continue
             
-            worker = utils2.start_worker(q, utils.parallel_get_progress, [trakt_id, cached, .08])
+            # trakt calls aren't host limited; the pool size alone bounds them
+            worker = utils2.start_worker(q, utils.parallel_get_progress, [trakt_id, cached, .08], name=trakt_id)
             percent = (i + 1) * 25 / total + 10
             pd.update(percent, line1=i18n('req_progress') % (show['show']['title']))
             worker_count += 1
@@ -829,6 +845,7 @@ def get_progress(cached=True):
             log_utils.log('All progress results received', log_utils.LOGDEBUG)
             
         total = len(workers)
+        utils2.cancel_workers(workers)
         if worker_count > 0:
             timeout_msg = i18n('progress_timeouts') % (worker_count, total)
             kodi.notify(msg=timeout_msg, duration=5000)
@@ -870,7 +887,9 @@ def show_progress():
         kodi.set_content(CONTENT_TYPES.EPISODES)
         kodi.end_of_directory(cache_to_disc=False)
     finally:
-        try: utils2.reap_workers(workers, None)
+        try:
+            utils2.cancel_workers(workers)
+            utils2.reap_workers(workers, None)
         except UnboundLocalError: pass
 
 @url_dispatcher.register(MODES.MANAGE_SUBS, ['section'])
@@ -1063,6 +1082,11 @@ def get_sources(mode, video_type, title, year, trakt_id, season='', episode='',
     timeout = max_timeout = int(kodi.get_setting('source_timeout'))
     if max_timeout == 0: timeout = None
     max_results = int(kodi.get_setting('source_results'))
+    source_ttl = int(kodi.get_setting('source_cache_ttl')) * 60
+    pseudo_tv = xbmcgui.Window(10000).getProperty('PseudoTVRunning').lower()
+    auto_play = pseudo_tv == 'true' or (mode == MODES.GET_SOURCES and kodi.get_setting('auto-play') == 'true') or mode == MODES.AUTOPLAY
+    early_quality = utils2.get_early_play_quality() if auto_play else 0
+    enable_sort = kodi.get_setting('enable_sort') == 'true'
     worker_count = 0
     workers = []
     try:
@@ -1070,53 +1094,105 @@ def get_sources(mode, video_type, title, year, trakt_id, season='', episode='',
         begin = time.time()
         fails = {}
         counts = {}
+        errors = set()
+        deadlines = {}
+        stale = []
+        scoreboard = scraper_health.Scoreboard()
         video = ScraperVideo(video_type, title, year, trakt_id, season, episode, ep_title, ep_airdate)
         active = not dialog and not utils2.from_playlist()
         if kodi.get_setting('pd_force_disable') == 'true': active = False
         with kodi.ProgressDialog(i18n('getting_sources'), utils2.make_progress_msg(video_type, title, year, season, episode), '', '', active=active) as pd:
-            scrapers = utils.relevant_scrapers(video_type)
+            scrapers = scoreboard.order(utils.relevant_scrapers(video_type))
             total = len(scrapers)
             for cls in scrapers:
                 if pd.is_canceled(): return False
                 scraper = cls(max_timeout)
-                worker = utils2.start_worker(q, utils2.parallel_get_sources, [scraper, video])
                 worker_count += 1
                 progress = worker_count * 50 / total
                 pd.update(progress, line2=i18n('requested_sources_from') % (cls.get_name()))
+                cached, is_stale = utils2.get_cached_sources(video, cls.get_name(), source_ttl) if source_ttl else (None, False)
+                if cached is not None:
+                    for hoster in cached: hoster['class'] = scraper
+                    q.put({'name': cls.get_name(), 'hosters': cached, 'cached': True})
+                    deadlines[cls.get_name()] = 0
+                    if is_stale: stale.append(scraper)
+                    continue
+                
+                worker = utils2.start_worker(q, utils2.parallel_get_sources, [scraper, video, bool(source_ttl)], utils2.scraper_host(scraper), cls.get_name())
                 workers.append(worker)
                 fails[cls.get_name()] = True
                 counts[cls.get_name()] = 0
+                deadlines[cls.get_name()] = scoreboard.get(cls.get_name()).deadline(max_timeout)
         
-            # collect results from workers
+            if enable_sort:
+                SORT_KEYS['source'] = utils.make_source_sort_key()
+                sort_key = utils2.make_sort_key()
+            else:
+                sort_key = None
+            
+            # collect results from workers; filter, resolver check and merge each batch as it arrives
             hosters = []
+            sort_keys = []
+            host_info = {}
+            total_hosters = 0
+            early_play = False
             while worker_count > 0:
                 try:
+                    if max_timeout > 0:
+                        # keep waiting as long as any outstanding scraper is still inside its own deadline
+                        timeout = time_left(workers, deadlines)
                     log_utils.log('Calling get with timeout: %s' % (timeout), log_utils.LOGDEBUG)
                     result = q.get(True, timeout)
-                    counts[result['name']] = len(result['hosters'])
+                    del deadlines[result['name']]
+                    if not result.get('cached'): counts[result['name']] = len(result['hosters'])
                     if pd.is_canceled(): return False
                     log_utils.log('Got %s Source Results' % (len(result['hosters'])), log_utils.LOGDEBUG)
                     worker_count -= 1
                     progress = ((total - worker_count) * 50 / total) + 50
                     pd.update(progress, line2=i18n('received_sources_from') % (len(result['hosters']), result['name']))
-                    hosters += result['hosters']
-                    del fails[result['name']]
-                    if max_timeout > 0:
-                        timeout = max_timeout - (time.time() - begin)
-                        if timeout < 0: timeout = 0
+                    total_hosters += len(result['hosters'])
+                    if result.get('cached'):
+                        log_utils.log('Using cached sources from %s' % (result['name']), log_utils.LOGDEBUG)
+                    elif result.get('error'):
+                        errors.add(result['name'])
+                        scoreboard.get(result['name']).record_failure()
+                    else:
+                        del fails[result['name']]
+                        scoreboard.get(result['name']).record_success(result['time'], len(result['hosters']))
+                    early_play = merge_hosters(hosters, sort_keys, result['hosters'], video_type, host_info, early_quality, sort_key)
                 except Empty:
+                    # a scraper that only got out of the pool queue during the wait still has time left
+                    if max_timeout > 0 and time_left(workers, deadlines, started_only=True) > 0: continue
                     log_utils.log('Get Sources Scraper Timeouts: %s' % (', '.join([name for name in fails])), log_utils.LOGWARNING)
                     break
 
-                if max_results > 0 and len(hosters) >= max_results:
-                    log_utils.log('Exceeded max results: %s/%s' % (max_results, len(hosters)), log_utils.LOGDEBUG)
+                if early_play:
+                    log_utils.log('Early Play Source Found after %.2fs: %s' % (time.time() - begin, hosters[0]['url']), log_utils.LOGDEBUG)
+                    fails = {}
+                    break
+                
+                if max_results > 0 and total_hosters >= max_results:
+                    log_utils.log('Exceeded max results: %s/%s' % (max_results, total_hosters), log_utils.LOGDEBUG)
                     fails = {}
                     break
 
             else:
                 log_utils.log('All source results received', log_utils.LOGDEBUG)
     
+            # scrapers still queued in the pool never ran, so don't hold it against them
+            canceled = utils2.cancel_workers(workers)
+            # nor against one that got out of the queue too late to use up its own deadline
+            canceled += [worker for worker in workers if worker.name in fails and time_left([worker], deadlines) > 0]
+            for worker in canceled:
+                fails.pop(worker.name, None)
+                counts.pop(worker.name, None)
             utils2.record_failures(fails, counts)
+            for name in fails:
+                if name not in errors:
+                    scoreboard.get(name).record_failure()
+            scoreboard.save()
+            if stale:
+                utils2.revalidate_sources(stale, video, timeout=max_timeout or None)
             timeouts = len(fails)
             if timeouts > 4:
                 timeout_msg = i18n('scraper_timeout') % (timeouts, len(workers))
@@ -1125,7 +1201,7 @@ def get_sources(mode, video_type, title, year, trakt_id, season='', episode='',
             else:
                 timeout_msg = ''
             workers = utils2.reap_workers(workers)
-            if not hosters:
+            if not total_hosters:
                 log_utils.log('No Sources found for: |%s|' % (video), log_utils.LOGWARNING)
                 msg = i18n('no_sources')
                 msg += ' (%s)' % timeout_msg if timeout_msg else ''
@@ -1136,17 +1212,6 @@ def get_sources(mode, video_type, title, year, trakt_id, season='', episode='',
                 kodi.notify(msg=timeout_msg, duration=7500)
             
             pd.update(100, line2=i18n('applying_source_filters'))
-                
-            if pd.is_canceled(): return False
-            hosters = utils2.filter_exclusions(hosters)
-            hosters = utils2.filter_quality(video_type, hosters)
-
-            if pd.is_canceled(): return False
-            hosters = apply_urlresolver(hosters)
-            
-            if kodi.get_setting('enable_sort') == 'true':
-                SORT_KEYS['source'] = utils.make_source_sort_key()
-                hosters.sort(key=utils2.get_sort_key)
             if pd.is_canceled(): return False
     
         if not hosters:
@@ -1155,9 +1220,8 @@ def get_sources(mode, video_type, title, year, trakt_id, season='', episode='',
             kodi.notify(msg=i18n('no_useable_sources') % (msg), duration=5000)
             return False
 
-        pseudo_tv = xbmcgui.Window(10000).getProperty('PseudoTVRunning').lower()
-        if pseudo_tv == 'true' or (mode == MODES.GET_SOURCES and kodi.get_setting('auto-play') == 'true') or mode == MODES.AUTOPLAY:
-            auto_play_sources(hosters, video_type, trakt_id, dialog, season, episode)
+        if auto_play:
+            auto_play_sources(hosters, video_type, trakt_id, dialog, season, episode, sort_key)
         else:
             if dialog or (dialog is None and kodi.get_setting('source-win') == 'Dialog'):
                 stream_url, direct = pick_source_dialog(hosters)
@@ -1165,59 +1229,106 @@ def get_sources(mode, video_type, title, year, trakt_id, season='', episode='',
             else:
                 pick_source_dir(mode, hosters, video_type, trakt_id, season, episode)
     finally:
+        utils2.cancel_workers(workers)
         utils2.reap_workers(workers, None)
 
-def apply_urlresolver(hosters):
+def time_left(workers, deadlines, started_only=False):
+    """
+    Seconds until the last outstanding scraper passes its deadline. Each deadline runs from when that scraper's task
+    actually started, so time spent queued in the pool doesn't count against it; a task that hasn't started yet has
+    all of its deadline left unless started_only
+    """
+    now = time.time()
+    left = 0
+    for worker in workers:
+        if worker.name in deadlines:
+            if started_only and worker.started_at is None: continue
+            started_at = worker.started_at or now
+            left = max(left, started_at + deadlines[worker.name] - now)
+    return left
+
+def merge_hosters(hosters, sort_keys, new_hosters, video_type, host_info, early_quality=0, sort_key=None):
+    """
+    Filter a batch of scraper results and merge it into the already sorted hosters list (sort_keys is kept in parallel)
+    sort_key is the function from utils2.make_sort_key; without one the batch is just appended
+    Returns True if the best merged source is good enough to start playing without waiting on the remaining scrapers
+    """
+    new_hosters = utils2.filter_exclusions(new_hosters)
+    new_hosters = utils2.filter_quality(video_type, new_hosters)
+    with log_utils.span('apply_urlresolver'):
+        new_hosters = apply_urlresolver(new_hosters, host_info)
+    for hoster in new_hosters:
+        if sort_key is not None:
+            # probed streams break ties by how fast they answered; seq keeps equal keys in arrival order and stops dicts from being compared
+            key = (sort_key(hoster), stream_probe.speed_key(hoster), len(sort_keys))
+            index = bisect.bisect(sort_keys, key)
+            sort_keys.insert(index, key)
+            hosters.insert(index, hoster)
+        else:
+            hosters.append(hoster)
+
+    if early_quality:
+        # with sorting on, only the overall best source counts; otherwise any new source can trigger it
+        candidates = hosters[:1] if sort_key is not None else new_hosters
+        for hoster in candidates:
+            if not hoster['multi-part'] and hoster['quality'] is not None and Q_ORDER.get(hoster['quality'], 0) >= early_quality:
+                return True
+    return False
+
+def apply_urlresolver(hosters, host_info=None):
+    """
+    host_info is optional state that can be passed in by callers that filter hosters in batches so that the
+    host capabilities are only loaded once
+    """
     filter_unusable = kodi.get_setting('filter_unusable') == 'true'
     show_debrid = kodi.get_setting('show_debrid') == 'true'
     if not filter_unusable and not show_debrid:
         return hosters
     
-    debrid_resolvers = [resolver() for resolver in urlresolver.relevant_resolvers(order_matters=True) if resolver.isUniversal()]
+    if host_info is None: host_info = {}
+    if 'hosts' not in host_info:
+        host_info['hosts'] = db_connection.get_host_cache(get_resolver_signature(), HOST_CACHE_LIMIT)
+    hosts = host_info['hosts']
+    unk_hosts = host_info.setdefault('unk_hosts', {})
     filtered_hosters = []
-    debrid_hosts = {}
-    unk_hosts = {}
-    known_hosts = {}
     for hoster in hosters:
         if 'direct' in hoster and hoster['direct'] == False and hoster['host']:
             host = hoster['host']
-            if filter_unusable:
-                if host in unk_hosts:
-                    # log_utils.log('Unknown Hit: %s from %s' % (host, hoster['class'].get_name()), log_utils.LOGDEBUG)
-                    unk_hosts[host] += 1
-                    continue
-                elif host in known_hosts:
-                    # log_utils.log('Known Hit: %s from %s' % (host, hoster['class'].get_name()), log_utils.LOGDEBUG)
-                    known_hosts[host] += 1
-                    filtered_hosters.append(hoster)
-                else:
-                    hmf = urlresolver.HostedMediaFile(host=host, media_id='dummy')  # use dummy media_id to force host validation
-                    if hmf:
-                        # log_utils.log('Known Miss: %s from %s' % (host, hoster['class'].get_name()), log_utils.LOGDEBUG)
-                        known_hosts[host] = known_hosts.get(host, 0) + 1
-                        filtered_hosters.append(hoster)
-                    else:
-                        # log_utils.log('Unknown Miss: %s from %s' % (host, hoster['class'].get_name()), log_utils.LOGDEBUG)
-                        unk_hosts[host] = unk_hosts.get(host, 0) + 1
-                        continue
-            else:
-                filtered_hosters.append(hoster)
-            
-            if host in debrid_hosts:
-                # log_utils.log('Debrid cache found for %s: %s' % (host, debrid_hosts[host]), log_utils.LOGDEBUG)
-                hoster['debrid'] = debrid_hosts[host]
-            else:
-                temp_resolvers = [resolver.name[:3].upper() for resolver in debrid_resolvers if resolver.valid_url('', host)]
-                # log_utils.log('%s supported by: %s' % (host, temp_resolvers), log_utils.LOGDEBUG)
-                debrid_hosts[host] = temp_resolvers
-                if temp_resolvers:
-                    hoster['debrid'] = temp_resolvers
+            if host not in hosts:
+                hosts[host] = get_host_capability(host, host_info)
+            resolvable, debrid = hosts[host]
+            if filter_unusable and not resolvable:
+                unk_hosts[host] = unk_hosts.get(host, 0) + 1
+                continue
+
+            filtered_hosters.append(hoster)
+            if debrid:
+                hoster['debrid'] = debrid
         else:
             filtered_hosters.append(hoster)
             
     log_utils.log('Discarded Hosts: %s' % (sorted(unk_hosts.items(), key=lambda x: x[1], reverse=True)), log_utils.LOGDEBUG)
     return filtered_hosters
 
+def get_host_capability(host, host_info):
+    if 'debrid_resolvers' not in host_info:
+        host_info['debrid_resolvers'] = [resolver() for resolver in urlresolver.relevant_resolvers(order_matters=True) if resolver.isUniversal()]
+    hmf = urlresolver.HostedMediaFile(host=host, media_id='dummy')  # use dummy media_id to force host validation
+    debrid = [resolver.name[:3].upper() for resolver in host_info['debrid_resolvers'] if resolver.valid_url('', host)]
+    log_utils.log('Host Capability: %s resolvable: %s debrid: %s' % (host, bool(hmf), debrid), log_utils.LOGDEBUG)
+    db_connection.cache_host(host, bool(hmf), debrid)
+    return bool(hmf), debrid
+
+def get_resolver_signature():
+    """
+    Changes whenever urlresolver is updated or the enabled resolvers/authorized debrid accounts change; used to throw
+    away cached host capabilities that might no longer be true
+    """
+    try: version = xbmcaddon.Addon('script.module.urlresolver').getAddonInfo('version')
+    except: version = ''
+    resolvers = sorted('%s%s' % (resolver.name, '*' if resolver.isUniversal() else '') for resolver in urlresolver.relevant_resolvers())
+    return hashlib.md5('%s|%s' % (version, '|'.join(resolvers))).hexdigest()
+
 @url_dispatcher.register(MODES.RESOLVE_SOURCE, ['mode', 'class_url', 'direct', 'video_type', 'trakt_id', 'class_name'], ['season', 'episode'])
 @url_dispatcher.register(MODES.DIRECT_DOWNLOAD, ['mode', 'class_url', 'direct', 'video_type', 'trakt_id', 'class_name'], ['season', 'episode'])
 def resolve_source(mode, class_url, direct, video_type, trakt_id, class_name, season='', episode=''):
@@ -1272,7 +1383,8 @@ def play_source(mode, hoster_url, direct, video_type, trakt_id, dialog, season='
                 stream_url = hoster_url
             else:
                 try:
-                    stream_url = hmf.resolve()
+                    with log_utils.span('resolve'):
+                        stream_url = hmf.resolve()
                     if not stream_url or not isinstance(stream_url, basestring):
                         try: msg = stream_url.msg
                         except: msg = hoster_url
@@ -1341,8 +1453,11 @@ def play_source(mode, hoster_url, direct, video_type, trakt_id, dialog, season='
         except TransientTraktError as e:
             log_utils.log('During Playback: %s' % (str(e)), log_utils.LOGWARNING)  # just log warning if trakt calls fail and leave meta and art blank
     
-        if mode in [MODES.DOWNLOAD_SOURCE, MODES.DIRECT_DOWNLOAD]:
-            utils2.download_media(stream_url, path, file_name)
+        if mode == MODES.DIRECT_DOWNLOAD and kodi.get_setting('download_queue') == 'true':
+            downloader.queue_download(stream_url, path, file_name)
+            return True
+        elif mode in [MODES.DOWNLOAD_SOURCE, MODES.DIRECT_DOWNLOAD]:
+            downloader.download_media(stream_url, path, file_name)
             return True
     
         if video_type == VIDEO_TYPES.EPISODE and utils2.srt_download_enabled() and show_meta:
@@ -1364,9 +1479,10 @@ def play_source(mode, hoster_url, direct, video_type, trakt_id, dialog, season='
         xbmc.Player().play(stream_url, listitem)
     return True
 
-def auto_play_sources(hosters, video_type, trakt_id, dialog, season, episode):
+def auto_play_sources(hosters, video_type, trakt_id, dialog, season, episode, sort_key=None):
     active = kodi.get_setting('show_pd') == 'true' or not dialog
     if kodi.get_setting('pd_force_disable') == 'true': active = False
+    hosters = stream_probe.order_for_autoplay(hosters, sort_key)
     total_hosters = len(hosters)
     with kodi.ProgressDialog(i18n('trying_autoplay'), line1=' ', line2=' ', active=active) as pd:
         prev = ''
@@ -1450,7 +1566,7 @@ def set_related_url(mode, video_type, title, year, trakt_id, season='', episode=
         total = len(scrapers)
         for cls in scrapers:
             scraper = cls(max_timeout)
-            worker = utils2.start_worker(q, utils2.parallel_get_url, [scraper, video])
+            worker = utils2.start_worker(q, utils2.parallel_get_url, [scraper, video], utils2.scraper_host(scraper), cls.get_name())
             related_list.append({'class': scraper, 'url': '', 'name': cls.get_name(), 'label': '[%s]' % (cls.get_name())})
             worker_count += 1
             progress = worker_count * 50 / total
@@ -1482,7 +1598,8 @@ def set_related_url(mode, video_type, title, year, trakt_id, season='', episode=
         else:
             log_utils.log('All source results received', log_utils.LOGDEBUG)
 
-    utils2.record_failures(fails)
+    canceled = [worker.name for worker in utils2.cancel_workers(workers)]
+    utils2.record_failures([name for name in fails if name not in canceled])
     timeouts = len(fails)
     timeout_msg = i18n('scraper_timeout') % (timeouts, len(workers)) if timeouts else ''
     if timeout_msg:
@@ -1559,6 +1676,7 @@ def set_related_url(mode, video_type, title, year, trakt_id, season='', episode=
             else:
                 break
     finally:
+        utils2.cancel_workers(workers)
         utils2.reap_workers(workers, None)
 
 @url_dispatcher.register(MODES.RATE, ['section', 'id_type', 'show_id'], ['season', 'episode'])
@@ -1722,11 +1840,16 @@ def update_subscriptions():
     log_utils.log('Updating Subscriptions', log_utils.LOGDEBUG)
     active = kodi.get_setting(MODES.UPDATE_SUBS + '-notify') == 'true'
     with kodi.ProgressDialog(kodi.get_name(), line1=i18n('updating_subscriptions'), background=True, active=active) as pd:
-        update_strms(SECTIONS.TV, pd)
+        changed_paths = []
+        if update_strms(SECTIONS.TV, pd):
+            changed_paths.append(kodi.get_setting('tvshow-folder'))
         if kodi.get_setting('include_movies') == 'true':
-            update_strms(SECTIONS.MOVIES, pd)
+            if update_strms(SECTIONS.MOVIES, pd):
+                changed_paths.append(kodi.get_setting('movie-folder'))
         if kodi.get_setting('library-update') == 'true':
-            xbmc.executebuiltin('UpdateLibrary(video)')
+            # only rescan the library folders that actually got new/changed .strm files
+            for path in changed_paths:
+                xbmc.executebuiltin('UpdateLibrary(video,%s)' % (path))
         if kodi.get_setting('cleanup-subscriptions') == 'true':
             clean_subs()
     
@@ -1738,25 +1861,72 @@ def update_subscriptions():
     kodi.refresh_container()
 
 def update_strms(section, dialog=None):
+    """
+    Sync the subscription list for section to the library; only items whose trakt updated_at (or library settings) changed
+    since the last sync, or that are waiting on an episode to air/a source to show up, are refreshed. Returns True if any .strm changed
+    """
     section_params = utils2.get_section_params(section)
     slug = kodi.get_setting('%s_sub_slug' % (section))
     if not slug:
-        return
+        return False
     elif slug == utils.WATCHLIST_SLUG:
         items = trakt_api.show_watchlist(section)
     else:
         items = trakt_api.show_list(slug, section)
 
-    length = len(items)
-    for i, item in enumerate(items):
-        percent_progress = (i + 1) * 100 / length
-        title = re.sub('\s+\(\d{4}\)$', '', item['title'])
-            
-        dialog.update(percent_progress, '%s %s: %s (%s)' % (i18n('updating'), section, title, item['year']))
-        try:
-            add_to_library(section_params['video_type'], item['title'], item['year'], item['ids']['trakt'])
-        except Exception as e:
-            log_utils.log('Subscription Update Exception: |%s|%s|%s|%s| - %s' % (section_params['video_type'], item['title'], item['year'], item['ids']['trakt'], e), log_utils.LOGDEBUG)
+    video_type = section_params['video_type']
+    settings_hash = library_settings_hash(video_type)
+    synced = db_connection.get_library_items(video_type)
+    now = time.time()
+    pending = []
+    for item in items:
+        trakt_id = str(item['ids']['trakt'])
+        if trakt_id in synced:
+            updated_at, old_settings_hash, next_check = synced[trakt_id]
+            if updated_at and updated_at == item.get('updated_at') and old_settings_hash == settings_hash and (next_check is None or next_check > now):
+                continue
+        pending.append(item)
+
+    log_utils.log('Subscription Update (%s): %s of %s items need updating' % (section, len(pending), len(items)), log_utils.LOGDEBUG)
+    q = Queue()
+    workers = []
+    # every item is read from trakt, so the sync shares trakt's host limit: at most worker_host_limit items are
+    # updated at once, whatever the pool size
+    for item in pending:
+        workers.append(utils2.start_worker(q, parallel_add_to_library, [video_type, item, settings_hash], host=TRAKT_HOST, name=item['title']))
+
+    changed = False
+    for i in xrange(len(workers)):
+        try: item, result = q.get(True, LIBRARY_TIMEOUT)
+        except Empty:
+            log_utils.log('Subscription Update (%s) timed out: %s' % (section, [worker.name for worker in workers if worker.is_alive()]), log_utils.LOGWARNING)
+            utils2.cancel_workers(workers)
+            break
+
+        changed = changed or result
+        if dialog is not None:
+            percent_progress = (i + 1) * 100 / len(workers)
+            title = re.sub('\s+\(\d{4}\)$', '', item['title'])
+            dialog.update(percent_progress, '%s %s: %s (%s)' % (i18n('updating'), section, title, item['year']))
+    return changed
+
+def parallel_add_to_library(q, video_type, item, settings_hash):
+    changed = False
+    try:
+        changed, next_check = add_to_library(video_type, item['title'], item['year'], item['ids']['trakt'])
+        get_db_connection().set_library_item(video_type, item['ids']['trakt'], item.get('updated_at'), settings_hash, next_check)
+    except Exception as e:
+        log_utils.log('Subscription Update Exception: |%s|%s|%s|%s| - %s' % (video_type, item['title'], item['year'], item['ids']['trakt'], e), log_utils.LOGDEBUG)
+    finally:
+        q.put((item, changed))
+
+def library_settings_hash(video_type):
+    """
+    Hash of the settings that change what add_to_library writes; a change forces every item to be synced again
+    """
+    settings = ['tvshow-folder', 'movie-folder', 'exclude_local', 'create_nfo', 'include_unknown', 'include_specials', 'require_source']
+    values = [video_type] + [kodi.get_setting(setting) for setting in settings]
+    return hashlib.md5('|'.join(values)).hexdigest()
 
 @url_dispatcher.register(MODES.CLEAN_SUBS)
 def clean_subs():
@@ -1829,6 +1999,13 @@ def import_db():
         log_utils.log('Import Failed: %s' % (e), log_utils.LOGERROR)
         kodi.notify(header=i18n('import'), msg=i18n('import_failed'))
 
+@url_dispatcher.register(MODES.SCRAPER_BENCH, [], ['record'])
+def run_scraper_bench(record=False):
+    # only needed here, so it isn't imported on every plugin call
+    from salts_lib import scraper_bench
+    report_path = scraper_bench.run(record=record == 'true')
+    kodi.notify(msg=i18n('bench_complete') % (report_path), duration=5000)
+
 @url_dispatcher.register(MODES.ADD_TO_LIBRARY, ['video_type', 'title', 'year', 'trakt_id'])
 def man_add_to_library(video_type, title, year, trakt_id):
     try:
@@ -1844,18 +2021,27 @@ def man_add_to_library(video_type, title, year, trakt_id):
     kodi.notify(msg=i18n('added_to_lib') % (msg), duration=5000)
 
 def add_to_library(video_type, title, year, trakt_id):
+    """
+    Write the .strm (and .nfo) files for a movie or every aired episode of a show. Returns (changed, next_check) where
+    changed is True if any .strm was written and next_check is when the item should be looked at again even if
+    trakt hasn't updated it (i.e. an episode is due to air or a .strm is waiting on a source); None if never
+    """
     log_utils.log('Creating .strm for |%s|%s|%s|%s|' % (video_type, title, year, trakt_id), log_utils.LOGDEBUG)
     scraper = local_scraper.Local_Scraper()
     exclude_local = kodi.get_setting('exclude_local') == 'true'
     create_nfo = int(kodi.get_setting('create_nfo'))  # 0 = None | 1 = Won't scrape | 2 = All
+    changed = False
+    next_check = None
 
     if video_type == VIDEO_TYPES.TVSHOW:
         save_path = kodi.get_setting('tvshow-folder')
         save_path = kodi.translate_path(save_path)
         show = trakt_api.get_show_details(trakt_id)
         show['title'] = re.sub(' \(\d{4}\)$', '', show['title'])  # strip off year if it's part of show title
-        seasons = trakt_api.get_seasons(trakt_id)
+        seasons = trakt_api.get_seasons(trakt_id, episodes=True)
         include_unknown = kodi.get_setting('include_unknown') == 'true'
+        written = get_db_connection().get_library_strms(VIDEO_TYPES.EPISODE, trakt_id)
+        now = time.time()
 
         if not seasons:
             log_utils.log('No Seasons found for %s (%s)' % (show['title'], show['year']), log_utils.LOGERROR)
@@ -1868,8 +2054,7 @@ def add_to_library(video_type, title, year, trakt_id):
         for season in seasons:
             season_num = season['number']
             if kodi.get_setting('include_specials') == 'true' or season_num != 0:
-                episodes = trakt_api.get_episodes(trakt_id, season_num)
-                for episode in episodes:
+                for episode in season.get('episodes', []):
                     ep_num = episode['number']
                     air_date = utils2.make_air_date(episode['first_aired'])
                     if exclude_local:
@@ -1880,9 +2065,12 @@ def add_to_library(video_type, title, year, trakt_id):
                     if utils2.show_requires_source(trakt_id):
                         require_source = True
                     else:
-                        if (episode['first_aired'] != None and utils2.iso_2_utc(episode['first_aired']) <= time.time()) or (include_unknown and episode['first_aired'] == None):
+                        if (episode['first_aired'] != None and utils2.iso_2_utc(episode['first_aired']) <= now) or (include_unknown and episode['first_aired'] == None):
                             require_source = False
                         else:
+                            if episode['first_aired'] != None:
+                                aired = utils2.iso_2_utc(episode['first_aired'])
+                                next_check = aired if next_check is None else min(next_check, aired)
                             continue
 
                     filename = utils2.filename_from_title(show['title'], video_type)
@@ -1890,7 +2078,11 @@ def add_to_library(video_type, title, year, trakt_id):
                     final_path = os.path.join(make_path(save_path, video_type, show['title'], show['year'], season=season_num), filename)
                     strm_string = kodi.get_plugin_url({'mode': MODES.GET_SOURCES, 'video_type': VIDEO_TYPES.EPISODE, 'title': show['title'], 'year': year, 'season': season_num,
                                                        'episode': ep_num, 'trakt_id': trakt_id, 'ep_title': episode['title'], 'ep_airdate': air_date, 'dialog': True})
-                    write_strm(strm_string, final_path, VIDEO_TYPES.EPISODE, show['title'], show['year'], trakt_id, season_num, ep_num, require_source=require_source)
+                    result = write_strm(strm_string, final_path, VIDEO_TYPES.EPISODE, show['title'], show['year'], trakt_id, season_num, ep_num, require_source=require_source,
+                                        written=written.get((str(season_num), str(ep_num))))
+                    if result is None:
+                        next_check = now
+                    changed = changed or bool(result)
 
     elif video_type == VIDEO_TYPES.MOVIE:
         if exclude_local:
@@ -1908,7 +2100,14 @@ def add_to_library(video_type, title, year, trakt_id):
         strm_string = kodi.get_plugin_url({'mode': MODES.GET_SOURCES, 'video_type': video_type, 'title': title, 'year': year, 'trakt_id': trakt_id, 'dialog': True})
         filename = utils2.filename_from_title(title, VIDEO_TYPES.MOVIE, year)
         final_path = os.path.join(make_path(save_path, video_type, title, year), filename)
-        write_strm(strm_string, final_path, VIDEO_TYPES.MOVIE, title, year, trakt_id, require_source=kodi.get_setting('require_source') == 'true')
+        written = get_db_connection().get_library_strms(VIDEO_TYPES.MOVIE, trakt_id)
+        result = write_strm(strm_string, final_path, VIDEO_TYPES.MOVIE, title, year, trakt_id, require_source=kodi.get_setting('require_source') == 'true',
+                            written=written.get(('', '')))
+        if result is None:
+            next_check = time.time()
+        changed = bool(result)
+
+    return changed, next_check
 
 def make_path(base_path, video_type, title, year='', season=''):
     show_folder = re.sub(r'[^\w\-_\. ]', '_', title)
@@ -1965,8 +2164,16 @@ def write_nfo(path, video_type, meta_ids):
                 except Exception as e:
                     log_utils.log('Failed to create .nfo file (%s): %s' % (path, e), log_utils.LOGERROR)
 
-def write_strm(stream, path, video_type, title, year, trakt_id, season='', episode='', require_source=False):
+def write_strm(stream, path, video_type, title, year, trakt_id, season='', episode='', require_source=False, written=None):
+    """
+    written is the (path, strm_hash) recorded the last time this .strm was synced; if it still matches and the file is there, it isn't touched.
+    Returns True if the .strm was written, False if it was already up to date and None if it couldn't be written
+    """
     path = xbmc.makeLegalFilename(path)
+    strm_hash = hashlib.md5(stream).hexdigest()
+    if written is not None and written == (path, strm_hash) and xbmcvfs.exists(path):
+        return False
+
     if not xbmcvfs.exists(os.path.dirname(path)):
         try:
             try: xbmcvfs.mkdirs(os.path.dirname(path))
@@ -1983,6 +2190,7 @@ def write_strm(stream, path, video_type, title, year, trakt_id, season='', episo
 
     # print "Old String: %s; New String %s" %(old_strm_string,strm_string)
     # string will be blank if file doesn't exist or is blank
+    result = False
     if stream != old_strm_string:
         try:
             if not require_source or utils.url_exists(ScraperVideo(video_type, title, year, trakt_id, season, episode)):
@@ -1990,10 +2198,16 @@ def write_strm(stream, path, video_type, title, year, trakt_id, season='', episo
                 file_desc = xbmcvfs.File(path, 'w')
                 file_desc.write(stream)
                 file_desc.close()
+                result = True
             else:
                 log_utils.log('No strm written for |%s|%s|%s|%s|%s|' % (video_type, title, year, season, episode), log_utils.LOGWARNING)
+                return None
         except Exception as e:
             log_utils.log('Failed to create .strm file (%s): %s' % (path, e), log_utils.LOGERROR)
+            return None
+
+    get_db_connection().set_library_strm(video_type, trakt_id, season, episode, path, strm_hash)
+    return result
 
 def show_pickable_list(slug, pick_label, pick_mode, section):
     if not slug:
@@ -2062,6 +2276,7 @@ def make_dir_from_list(section, list_data, slug=None, query=None, page=None):
 
     utils2.set_view(section_params['content_type'])
     kodi.end_of_directory()
+    trakt_api.prefetch_next_page()
 
 def make_dir_from_cal(mode, start_date, days):
     try: start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
@@ -2412,7 +2627,7 @@ def main(argv=None):
 
     try:
         global db_connection
-        db_connection = DB_Connection()
+        db_connection = get_db_connection()
         mode = queries.get('mode', None)
         url_dispatcher.dispatch(mode, queries)
     except (TransientTraktError, TraktError, TraktAuthError) as e:
@@ -2421,6 +2636,11 @@ def main(argv=None):
     except DatabaseRecoveryError as e:
         log_utils.log('Attempting DB recovery due to Database Error: %s' % (e), log_utils.LOGWARNING)
         db_connection.attempt_db_recovery()
+    finally:
+        scraper.Scraper.flush_cookies()
+        scraper.Scraper.close_connections()
+        close_db_connections()
+        log_utils.log_summary()
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import re
+import threading
+import time
+import log_utils
+import scraper_utils
+
+CACHE_NAME = 'catalog-v2'  # entries hold the titles as parsed (they used to be cleansed)
+
+__catalogs = {}
+__catalogs_lock = threading.Lock()
+
+def tokenize(title):
+    return [token for token in (scraper_utils.normalize_title(word) for word in re.split('\s+', title or '')) if token]
+
+class Catalog(object):
+    """
+    Index of every show listed on a site's catalog page. entries is a list of (url, title, year) with the titles as
+    parsed; they're normalized once with scraper_utils.normalize_title, just like the title searched for, and only
+    cleansed for the results. entries and their normalized titles are what gets persisted, the word and title
+    lookups are only built if a search needs them
+    """
+    def __init__(self, entries, created=None, norm_titles=None):
+        self.entries = entries
+        self.created = time.time() if created is None else created
+        if norm_titles is None: norm_titles = [scraper_utils.normalize_title(title) for _url, title, _year in entries]
+        self.norm_titles = norm_titles
+        self.__tokens = None
+        self.__titles = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, title, year='', tokens=False):
+        """
+        Entries whose normalized title contains the normalized title, the same match the scrapers' own searches made.
+        With tokens, a title that doesn't match that way falls back to entries whose title has every word of title in
+        it; that finds more shows (and more wrong ones), so it's left to callers to opt in. Returns search() style results
+        """
+        norm_title = scraper_utils.normalize_title(title)
+        matches = [i for i, match_title in enumerate(self.norm_titles) if norm_title in match_title]
+        if not matches and tokens:
+            matches = self.__match_tokens(tokenize(title))
+
+        results = []
+        for i in matches:
+            url, match_title, match_year = self.entries[i]
+            if not year or not match_year or year == match_year:
+                results.append({'url': url, 'title': scraper_utils.cleanse_title(match_title), 'year': match_year})
+        return results
+
+    def find(self, title):
+        """
+        Entries whose title is title (ignoring case) in catalog order
+        """
+        if self.__titles is None:
+            titles = {}
+            for i, (_url, match_title, _year) in enumerate(self.entries):
+                titles.setdefault(match_title.lower(), []).append(i)
+            self.__titles = titles
+        return [self.entries[i] for i in self.__titles.get(title.lower(), [])]
+
+    def __match_tokens(self, tokens):
+        if not tokens:
+            return []
+
+        if self.__tokens is None:
+            # built in a local so that another scraper thread never sees a half built index
+            index = {}
+            for i, (_url, title, _year) in enumerate(self.entries):
+                for token in tokenize(title):
+                    index.setdefault(token, set()).add(i)
+            self.__tokens = index
+        postings = sorted((self.__tokens.get(token, set()) for token in tokens), key=len)
+        return sorted(set.intersection(*postings))
+
+def get_catalog(db_connection, name, url, get_html, parse, cache_limit=8):
+    """
+    Returns the Catalog of the page at url for name. get_html() fetches the page and parse(html) yields (url, title, year)
+    for every show on it. The catalog is kept in memory and in the db function cache for cache_limit hours, so the
+    page is only parsed again once it expires
+    """
+    key = (name, url)
+    max_age = cache_limit * 60 * 60
+    with __catalogs_lock:
+        catalog = __catalogs.get(key)
+    if catalog is not None and time.time() - catalog.created < max_age:
+        return catalog
+
+    found, result = db_connection.get_cached_function(CACHE_NAME, [name, url], cache_limit=max_age)
+    if found:
+        created, entries, norm_titles = result
+        catalog = Catalog(entries, created, norm_titles)
+    else:
+        html = get_html()
+        if not html:
+            return Catalog([])
+
+        with log_utils.span('catalog'):
+            seen_urls = set()
+            entries = []
+            for entry in parse(html):
+                if entry[0] not in seen_urls:
+                    seen_urls.add(entry[0])
+                    entries.append(tuple(entry))
+            catalog = Catalog(entries)
+        db_connection.cache_function(CACHE_NAME, [name, url], result=(catalog.created, catalog.entries, catalog.norm_titles))
+        log_utils.log('Catalog built for %s: %s (%s entries)', log_utils.LOGDEBUG, name, url, len(catalog))
+
+    with __catalogs_lock:
+        __catalogs[key] = catalog
+    return catalog
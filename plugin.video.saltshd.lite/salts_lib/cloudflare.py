@@ -53,12 +53,13 @@ def solve(url, cj, user_agent=None, wait=True):
         try: cj.load(ignore_discard=True)
         except: pass
         opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
-        urllib2.install_opener(opener)
+    else:
+        opener = urllib2.build_opener()
 
     request = urllib2.Request(url)
     for key in headers: request.add_header(key, headers[key])
     try:
-        response = urllib2.urlopen(request)
+        response = opener.open(request)
         html = response.read()
     except urllib2.HTTPError as e:
         html = e.read()
@@ -116,8 +117,7 @@ def solve(url, cj, user_agent=None, wait=True):
         for key in headers: request.add_header(key, headers[key])
         try:
             opener = urllib2.build_opener(NoRedirection)
-            urllib2.install_opener(opener)
-            response = urllib2.urlopen(request)
+            response = opener.open(request)
             while response.getcode() in [301, 302, 303, 307]:
                 if cj is not None:
                     cj.extract_cookies(response, request)
@@ -126,7 +126,7 @@ def solve(url, cj, user_agent=None, wait=True):
                 if cj is not None:
                     cj.add_cookie_header(request)
                     
-                response = urllib2.urlopen(request)
+                response = opener.open(request)
             final = response.read()
             if 'cf-browser-verification' in final:
                 log_utils.log('CF Failure: html: %s url: %s' % (html, url), log_utils.LOGWARNING)
@@ -35,7 +35,8 @@ MODES = __enum(
     AUTO_CONF='auto_config', CLEAR_SAVED='clear_saved', RESET_BASE_URL='reset_base_url', TOGGLE_TO_MENU='toggle_to_menu', LIKED_LISTS='liked_lists', MOSTS='mosts',
     PLAYED='played', WATCHED='watched', COLLECTED='collected', SHOW_BOOKMARKS='show_bookmarks', DELETE_BOOKMARK='delete_bookmark', SHOW_HISTORY='show_history',
     RESET_FAILS='reset_failures', MANAGE_PROGRESS='toggle_progress', AUTOPLAY='autoplay', INSTALL_THEMES='install_themes', RESET_REL_URLS='reset_rel_urls',
-    ANTICIPATED='anticipated', SHOW_REWATCH='show_rewatch', PICK_REWATCH_LIST='pick_rewatch_list', SET_REWATCH_LIST='set_rewatch_list', MANAGE_REWATCH='manage_rewatch')
+    ANTICIPATED='anticipated', SHOW_REWATCH='show_rewatch', PICK_REWATCH_LIST='pick_rewatch_list', SET_REWATCH_LIST='set_rewatch_list', MANAGE_REWATCH='manage_rewatch',
+    SCRAPER_BENCH='scraper_bench')
 SECTIONS = __enum(TV='TV', MOVIES='Movies')
 VIDEO_TYPES = __enum(TVSHOW='TV Show', MOVIE='Movie', EPISODE='Episode', SEASON='Season')
 CONTENT_TYPES = __enum(TVSHOWS='tvshows', MOVIES='movies', SEASONS='seasons', EPISODES='episodes', FILES='files')
@@ -73,6 +74,9 @@ HOURS_LIST[MODES.UPDATE_SUBS] = [.5, 1] + range(2, 25)
 LONG_AGO = '1970-01-01 23:59:00.000000'
 TEMP_ERRORS = [500, 502, 503, 504, 520, 521, 522, 524]
 SRT_SOURCE = 'addic7ed'
+SOURCE_STALE_LIMIT = 2 * 60 * 60  # seconds a cached source list can still be shown while it's refreshed
+PREFETCH_BATCH = 4  # scrapers a next episode prefetch runs at once
+URL_EXISTS_LIMIT = 30 * 24 * 60 * 60  # seconds the scraper that found a show's last url is remembered
 DISABLE_SETTINGS = __enum(OFF='0', PROMPT='1', ON='2')
 
 BLOG_Q_MAP = {}
@@ -91,6 +95,8 @@ HOST_Q[QUALITIES.HD720] = ['thefile', 'sharesix', 'filenuke', 'vidxden', 'movsha
 HOST_Q[QUALITIES.HD1080] = ['hugefiles', '180upload', 'mightyupload', 'videomega', 'allmyvideos']
 
 Q_ORDER = {QUALITIES.LOW: 1, QUALITIES.MEDIUM: 2, QUALITIES.HIGH: 3, QUALITIES.HD720: 4, QUALITIES.HD1080: 5}
+EARLY_PLAY_Q = [0, Q_ORDER[QUALITIES.HD1080], Q_ORDER[QUALITIES.HD720], Q_ORDER[QUALITIES.HIGH]]
+HOST_CACHE_LIMIT = 24  # hours
 
 IMG_SIZES = ['full', 'medium', 'thumb']
 
@@ -20,13 +20,18 @@ import time
 import csv
 import json
 import hashlib
+import zlib
 import cPickle
+import threading
+from contextlib import contextmanager
+from Queue import Queue, Empty
 from threading import Semaphore
 import xbmcvfs
 import xbmcgui
 import log_utils
 import kodi
 from kodi import i18n
+from lru_cache import LRU_Cache
 
 def enum(**enums):
     return type('Enum', (), enums)
@@ -40,6 +45,17 @@ MAX_TRIES = 5
 MYSQL_DATA_SIZE = 512
 MYSQL_URL_SIZE = 255
 MYSQL_MAX_BLOB_SIZE = 16777215
+# bump whenever a table definition in init_database changes; older databases are rebuilt through a migration
+SCHEMA_VERSION = 3
+# tables that aren't in the csv export survive a migration by being kept out of __drop_all instead; a schema
+# version that changes one of them has to migrate it explicitly
+PRESERVED_TABLES = [
+    'download_queue',
+    'library_item', 'library_strm',  # library sync state; losing it re-writes every .strm on the next update
+    'scraper_stats',  # scraper health: the timing history deadlines come from and open circuit breakers
+]
+MYSQL_POOL_NAME = 'saltshd'
+MYSQL_POOL_SIZE = 32
 
 INCREASED = False
 UP_THRESHOLD = 0
@@ -55,9 +71,59 @@ else:
     except: MAX_WRITERS = 1
 SQL_SEMA = Semaphore(MAX_WRITERS)
 
+L1_MAX_ENTRIES = 250
+L1_MAX_BYTES = 1024 * 1024 * 16
+L1_TTL = 60 * 5
+
+# process-wide, so that every DB_Connection (one per scraper thread) shares it
+URL_CACHE = LRU_Cache(L1_MAX_ENTRIES, L1_MAX_BYTES, L1_TTL)
+WRITE_Q = Queue()
+WRITE_BATCH = 250
+# rel_url rows queued for the writer; consulted by get_related_url so a thread always sees what was just set
+PENDING_REL_URLS = {}
+PENDING_LOCK = threading.Lock()
+WRITER_LOCK = threading.Lock()
+
+CONNECTIONS = {}
+CONNECTIONS_LOCK = threading.Lock()
+
+def get_db_connection():
+    """
+    Return the calling thread's DB_Connection, creating it on first use. Connections left behind by threads that have
+    exited are released at the same time
+    """
+    ident = threading.current_thread().ident
+    with CONNECTIONS_LOCK:
+        db_connection = CONNECTIONS.get(ident)
+        if db_connection is None:
+            live = set(thread.ident for thread in threading.enumerate())
+            for dead in [key for key in CONNECTIONS if key not in live]:
+                CONNECTIONS.pop(dead).release()
+
+    if db_connection is None:
+        db_connection = DB_Connection()
+        with CONNECTIONS_LOCK:
+            CONNECTIONS[ident] = db_connection
+    return db_connection
+
+def close_db_connections():
+    """
+    Flush the write-behind queue, then release the calling thread's connection and those of threads that have exited.
+    Threads that are still running (the writer, background refreshes, scraper workers) keep theirs
+    """
+    DB_Connection.flush_writes()
+    current = threading.current_thread().ident
+    live = set(thread.ident for thread in threading.enumerate())
+    with CONNECTIONS_LOCK:
+        connections = [CONNECTIONS.pop(ident) for ident in list(CONNECTIONS) if ident == current or ident not in live]
+
+    for db_connection in connections:
+        db_connection.release()
+
 class DB_Connection():
     locks = 0
     writes = 0
+    writer = None
     
     def __init__(self):
         global OperationalError
@@ -68,6 +134,7 @@ class DB_Connection():
         self.address = kodi.get_setting('db_address')
         self.db = None
         self.progress = None
+        self.__batch = False
 
         if kodi.get_setting('use_remote_db') == 'true':
             if self.address is not None and self.username is not None and self.password is not None and self.dbname is not None:
@@ -90,12 +157,58 @@ class DB_Connection():
         self.db_lib = db_lib
         self.__connect_to_db()
 
+    def release(self):
+        """
+        Close the underlying connection (MySQL connections go back to the pool). Sqlite connections can only be closed
+        by the thread that opened them, so those are left for garbage collection when called from any other thread
+        """
+        if self.db is None: return
+        try:
+            if self.db_type == DB_TYPES.MYSQL or self.thread_ident == threading.current_thread().ident:
+                self.db.close()
+        except Exception as e:
+            log_utils.log('Error closing DB connection: %s' % (e), log_utils.LOGDEBUG)
+        self.db = None
+
     def flush_cache(self):
+        URL_CACHE.clear()
+        DB_Connection.flush_writes()
         sql = 'DELETE FROM url_cache'
         self.__execute(sql)
         if self.db_type == DB_TYPES.SQLITE:
             self.__execute('VACUUM')
 
+    def prune_cache(self, max_age=0, max_size=0):
+        """
+        Drop url_cache entries older than max_age days, then the least recently used ones until the cached responses fit in max_size MB
+        """
+        DB_Connection.flush_writes()
+        if max_age:
+            sql = 'DELETE FROM url_cache WHERE timestamp < ?'
+            self.__execute(sql, (time.time() - max_age * 24 * 60 * 60,))
+
+        if max_size:
+            max_bytes = max_size * 1024 * 1024
+            rows = self.__execute('SELECT SUM(LENGTH(response)) FROM url_cache')
+            total = int(rows[0][0] or 0) if rows else 0
+            log_utils.log('Cache Size: %s/%s bytes' % (total, max_bytes), log_utils.LOGDEBUG)
+            if total > max_bytes:
+                # prune down to 80% of the limit so that the next check doesn't have to prune again
+                target = total - max_bytes * .8
+                freed = 0
+                cutoff = None
+                for last_access, size in self.__execute('SELECT last_access, LENGTH(response) FROM url_cache ORDER BY last_access'):
+                    if freed >= target: break
+                    cutoff = last_access
+                    freed += size or 0
+
+                if cutoff is not None:
+                    log_utils.log('Pruning url_cache: freeing %s bytes (last_access <= %s)' % (freed, cutoff), log_utils.LOGNOTICE)
+                    self.__execute('DELETE FROM url_cache WHERE last_access <= ?', (cutoff,))
+                    if self.db_type == DB_TYPES.SQLITE:
+                        self.__execute('VACUUM')
+        URL_CACHE.clear()
+
     def get_bookmark(self, trakt_id, season='', episode=''):
         if not trakt_id: return None
         sql = 'SELECT resumepoint FROM bookmark where slug=? and season=? and episode=?'
@@ -127,22 +240,24 @@ class DB_Connection():
         now = time.time()
         if data is None: data = ''
         if res_header is None: res_header = []
-        res_header = json.dumps(res_header)
         # truncate data if running mysql and greater than col size
         if self.db_type == DB_TYPES.MYSQL and len(url) > MYSQL_URL_SIZE:
             url = url[:MYSQL_URL_SIZE]
         if self.db_type == DB_TYPES.MYSQL and len(data) > MYSQL_DATA_SIZE:
             data = data[:MYSQL_DATA_SIZE]
-        sql = 'REPLACE INTO url_cache (url, data, response, res_header, timestamp) VALUES(?, ?, ?, ?, ?)'
-        self.__execute(sql, (url, data, body, res_header, now))
+        if isinstance(body, unicode): body = body.encode('utf-8')
+        URL_CACHE.set((url, data), (now, res_header, body), len(body) if body else 0)
+        sql = 'REPLACE INTO url_cache (url, data, response, res_header, timestamp, last_access) VALUES(?, ?, ?, ?, ?, ?)'
+        self.__write_behind(sql, (url, data, self.__compress(body), json.dumps(res_header), now, now))
 
     def delete_cached_url(self, url, data=''):
         if data is None: data = ''
         # truncate data if running mysql and greater than col size
         if self.db_type == DB_TYPES.MYSQL and len(data) > MYSQL_DATA_SIZE:
             data = data[:MYSQL_DATA_SIZE]
+        URL_CACHE.delete((url, data))
         sql = 'DELETE FROM url_cache WHERE url = ? and data= ?'
-        self.__execute(sql, (url, data))
+        self.__write_behind(sql, (url, data))
 
     def get_cached_url(self, url, data='', cache_limit=8):
         if data is None: data = ''
@@ -155,26 +270,104 @@ class DB_Connection():
         now = time.time()
         age = now - created
         limit = 60 * 60 * cache_limit
-        sql = 'SELECT timestamp, response, res_header FROM url_cache WHERE url = ? and data=?'
-        rows = self.__execute(sql, (url, data))
-
-        if rows:
-            created = float(rows[0][0])
-            res_header = json.loads(rows[0][2])
+        cached = URL_CACHE.get((url, data))
+        source = 'L1'
+        if cached is None:
+            source = 'DB'
+            sql = 'SELECT timestamp, response, res_header FROM url_cache WHERE url = ? and data=?'
+            rows = self.__execute(sql, (url, data))
+            if rows:
+                cached = (float(rows[0][0]), json.loads(rows[0][2]), self.__decompress(rows[0][1]))
+                URL_CACHE.set((url, data), cached, len(cached[2]) if cached[2] else 0)
+                sql = 'UPDATE url_cache SET last_access=? WHERE url = ? and data=?'
+                self.__write_behind(sql, (now, url, data))
+
+        if cached is not None:
+            created, res_header, body = cached
             age = now - created
             if age < limit:
-                html = rows[0][1]
-        log_utils.log('DB Cache: Url: %s, Data: %s, Cache Hit: %s, created: %s, age: %.2fs (%.2fh), limit: %ss' % (url, data, bool(html), created, age, age / (60 * 60), limit), log_utils.LOGDEBUG)
+                html = body
+        log_utils.log('%s Cache: Url: %s, Data: %s, Cache Hit: %s, created: %s, age: %.2fs (%.2fh), limit: %ss', log_utils.LOGDEBUG, source, url, data, bool(html), created, age, age / (60 * 60), limit)
         return created, res_header, html
 
+    def get_host_cache(self, signature, cache_limit=24):
+        """
+        Returns {host: (resolvable, debrid resolvers)} for hosts checked within cache_limit hours. Everything is thrown
+        away when signature (what urlresolver can resolve) differs from the one the cache was built with
+        """
+        if self.get_setting('host_cache_signature') != signature:
+            log_utils.log('Host cache signature changed; flushing host cache', log_utils.LOGDEBUG)
+            DB_Connection.flush_writes()
+            self.__execute('DELETE FROM host_cache')
+            self.set_setting('host_cache_signature', signature)
+            return {}
+
+        sql = 'SELECT host, resolvable, debrid FROM host_cache WHERE timestamp >= ?'
+        rows = self.__execute(sql, (time.time() - cache_limit * 60 * 60,))
+        return dict((row[0], (bool(row[1]), json.loads(row[2]))) for row in rows)
+
+    def cache_host(self, host, resolvable, debrid):
+        sql = 'REPLACE INTO host_cache (host, resolvable, debrid, timestamp) VALUES (?, ?, ?, ?)'
+        self.__write_behind(sql, (host, int(resolvable), json.dumps(debrid), time.time()))
+
+    def get_library_items(self, video_type):
+        """
+        Returns {trakt_id: (updated_at, settings_hash, next_check)} for every item of video_type synced to the library
+        """
+        sql = 'SELECT trakt_id, updated_at, settings_hash, next_check FROM library_item WHERE video_type = ?'
+        rows = self.__execute(sql, (video_type,))
+        return dict((str(row[0]), (row[1], row[2], row[3])) for row in rows)
+
+    def set_library_item(self, video_type, trakt_id, updated_at, settings_hash, next_check=None):
+        sql = 'REPLACE INTO library_item (video_type, trakt_id, updated_at, settings_hash, next_check) VALUES (?, ?, ?, ?, ?)'
+        self.__write_behind(sql, (video_type, str(trakt_id), updated_at, settings_hash, next_check))
+
+    def get_library_strms(self, video_type, trakt_id):
+        """
+        Returns {(season, episode): (path, strm_hash)} for every .strm written for trakt_id
+        """
+        sql = 'SELECT season, episode, path, strm_hash FROM library_strm WHERE video_type = ? AND trakt_id = ?'
+        rows = self.__execute(sql, (video_type, str(trakt_id)))
+        return dict(((str(row[0]), str(row[1])), (row[2], row[3])) for row in rows)
+
+    def set_library_strm(self, video_type, trakt_id, season, episode, path, strm_hash):
+        sql = 'REPLACE INTO library_strm (video_type, trakt_id, season, episode, path, strm_hash) VALUES (?, ?, ?, ?, ?, ?)'
+        self.__write_behind(sql, (video_type, str(trakt_id), str(season), str(episode), path, strm_hash))
+
+    def get_scraper_stats(self):
+        """
+        Returns {name: stats json} for every scraper with recorded health
+        """
+        sql = 'SELECT name, stats FROM scraper_stats'
+        rows = self.__execute(sql)
+        return dict((row[0], row[1]) for row in rows)
+
+    def set_scraper_stats(self, name, stats):
+        sql = 'REPLACE INTO scraper_stats (name, stats, timestamp) VALUES (?, ?, ?)'
+        self.__write_behind(sql, (name, stats, time.time()))
+
     def get_all_urls(self, include_response=False, order_matters=False):
         sql = 'SELECT url, data'
         if include_response: sql += ',response'
         sql += ' FROM url_cache'
         if order_matters: sql += ' ORDER BY url, data'
         rows = self.__execute(sql)
+        if include_response:
+            rows = [(row[0], row[1], self.__decompress(row[2])) for row in rows]
         return rows
 
+    def __compress(self, body):
+        if not body: return body
+        body = zlib.compress(body)
+        # store as a blob; sqlite would otherwise treat the compressed bytes as text
+        return buffer(body) if self.db_type == DB_TYPES.SQLITE else body
+
+    def __decompress(self, body):
+        if not body: return body
+        body = str(body)
+        try: return zlib.decompress(body)
+        except zlib.error: return body  # stored before compression was added
+
     def cache_function(self, name, args=None, kwargs=None, result=None):
         now = time.time()
         if args is None: args = []
@@ -187,7 +380,7 @@ class DB_Connection():
         arg_hash = hashlib.md5(str(args)).hexdigest() + hashlib.md5(str(kwargs)).hexdigest()
         sql = 'REPLACE INTO function_cache (name, args, result, timestamp) VALUES(?, ?, ?, ?)'
         self.__execute(sql, (name, arg_hash, pickle_result, now))
-        log_utils.log('Function Cached: |%s|%s|%s| -> |%s|' % (name, args, kwargs, len(pickle_result)), log_utils.LOGDEBUG)
+        log_utils.log('Function Cached: |%s|%s|%s| -> |%s|', log_utils.LOGDEBUG, name, args, kwargs, len(pickle_result))
 
     def get_cached_function(self, name, args=None, kwargs=None, cache_limit=60 * 60):
         max_age = time.time() - cache_limit
@@ -197,7 +390,7 @@ class DB_Connection():
         sql = 'SELECT result FROM function_cache WHERE name = ? and args = ? and timestamp >= ?'
         rows = self.__execute(sql, (name, arg_hash, max_age))
         if rows:
-            log_utils.log('Function Cache Hit: |%s|%s|%s| -> |%d|' % (name, args, kwargs, len(rows[0][0])), log_utils.LOGDEBUG)
+            log_utils.log('Function Cache Hit: |%s|%s|%s| -> |%d|', log_utils.LOGDEBUG, name, args, kwargs, len(rows[0][0]))
             return True, cPickle.loads(rows[0][0])
         else:
             return False, None
@@ -226,11 +419,19 @@ class DB_Connection():
 
     def set_related_url(self, video_type, title, year, source, rel_url, season='', episode=''):
         if year is None: year = ''
+        key = (video_type, title, year, season, episode, source)
+        params = (video_type, title, year, season, episode, source, rel_url)
         sql = 'REPLACE INTO rel_url (video_type, title, year, season, episode, source, rel_url) VALUES (?, ?, ?, ?, ?, ?, ?)'
-        self.__execute(sql, (video_type, title, year, season, episode, source, rel_url))
+        if self.__batch:
+            self.__execute(sql, params)
+        else:
+            with PENDING_LOCK:
+                PENDING_REL_URLS[key] = params
+            self.__write_behind(sql, params, key)
 
     def clear_related_url(self, video_type, title, year, source, season='', episode=''):
         if year is None: year = ''
+        DB_Connection.flush_writes()
         sql = 'DELETE FROM rel_url WHERE video_type=? and title=? and year=? and source=?'
         params = [video_type, title, year, source]
         if season:
@@ -242,12 +443,18 @@ class DB_Connection():
         self.__execute(sql, params)
 
     def clear_scraper_related_urls(self, source):
+        DB_Connection.flush_writes()
         sql = 'DELETE FROM rel_url WHERE source=?'
         params = [source]
         self.__execute(sql, params)
 
     def get_related_url(self, video_type, title, year, source, season='', episode=''):
         if year is None: year = ''
+        with PENDING_LOCK:
+            pending = PENDING_REL_URLS.get((video_type, title, year, season, episode, source))
+        if pending is not None:
+            return [(pending[-1],)]
+
         sql = 'SELECT rel_url FROM rel_url WHERE video_type=? and title=? and year=? and season=? and episode=? and source=?'
         rows = self.__execute(sql, (video_type, title, year, season, episode, source))
         return rows
@@ -277,6 +484,27 @@ class DB_Connection():
         sql = 'DELETE FROM saved_searches WHERE id=?'
         self.__execute(sql, (search_id, ))
 
+    def add_download(self, url, path, file_name, added=None):
+        if added is None: added = time.time()
+        sql = 'INSERT INTO download_queue (url, path, file_name, added) VALUES (?, ?, ?, ?)'
+        self.__execute(sql, (url, path, file_name, added))
+
+    def get_downloads(self):
+        """
+        Returns (id, url, path, file_name, tries) for every queued download that isn't waiting out a retry delay
+        """
+        sql = 'SELECT id, url, path, file_name, tries FROM download_queue WHERE next_try <= ? ORDER BY added'
+        rows = self.__execute(sql, (time.time(), ))
+        return rows
+
+    def retry_download(self, download_id, next_try):
+        sql = 'UPDATE download_queue SET tries=tries + 1, next_try=? WHERE id=?'
+        self.__execute(sql, (next_try, download_id))
+
+    def delete_download(self, download_id):
+        sql = 'DELETE FROM download_queue WHERE id=?'
+        self.__execute(sql, (download_id, ))
+
     def get_setting(self, setting):
         sql = 'SELECT value FROM db_info WHERE setting=?'
         rows = self.__execute(sql, (setting,))
@@ -347,7 +575,7 @@ class DB_Connection():
             else:
                 progress = xbmcgui.DialogProgress()
                 progress.create('SALTS', line2='Import from %s' % (full_path), line3='Importing 0 of %s' % (num_lines))
-            with open(temp_path, 'r') as f:
+            with open(temp_path, 'r') as f, self.batch_writes():
                     reader = csv.reader(f)
                     mode = ''
                     _ = f.readline()  # read header
@@ -399,7 +627,14 @@ class DB_Connection():
     def init_database(self, db_version):
         try:
             cur_version = kodi.get_version()
-            if db_version is not None and cur_version != db_version:
+            upgrade = db_version is not None and cur_version != db_version
+            schema_version = self.__get_schema_version()
+            if not upgrade and schema_version < SCHEMA_VERSION:
+                log_utils.log('DB Schema Upgrade from %s to %s detected.' % (schema_version, SCHEMA_VERSION), log_utils.LOGNOTICE)
+                if db_version is None: db_version = 'Unknown'
+                upgrade = True
+
+            if upgrade:
                 log_utils.log('DB Upgrade from %s to %s detected.' % (db_version, cur_version), log_utils.LOGNOTICE)
                 self.progress = xbmcgui.DialogProgress()
                 self.progress.create('SALTS', line1='Migrating from %s to %s' % (db_version, cur_version), line2='Saving current data.')
@@ -408,12 +643,22 @@ class DB_Connection():
     
             log_utils.log('Building SALTS Database', log_utils.LOGDEBUG)
             if self.db_type == DB_TYPES.MYSQL:
-                self.__execute('CREATE TABLE IF NOT EXISTS url_cache (url VARBINARY(%s) NOT NULL, data VARBINARY(%s) NOT NULL, response MEDIUMBLOB, res_header TEXT, timestamp TEXT, PRIMARY KEY(url, data))' % (MYSQL_URL_SIZE, MYSQL_DATA_SIZE))
-                self.__execute('CREATE TABLE IF NOT EXISTS function_cache (name VARCHAR(255) NOT NULL, args VARCHAR(64), result MEDIUMBLOB, timestamp TEXT, PRIMARY KEY(name, args))')
+                self.__execute('CREATE TABLE IF NOT EXISTS url_cache (url VARBINARY(%s) NOT NULL, data VARBINARY(%s) NOT NULL, response MEDIUMBLOB, res_header TEXT, timestamp DOUBLE, last_access DOUBLE, \
+                PRIMARY KEY(url, data), INDEX url_cache_timestamp (timestamp), INDEX url_cache_last_access (last_access))' % (MYSQL_URL_SIZE, MYSQL_DATA_SIZE))
+                self.__execute('CREATE TABLE IF NOT EXISTS function_cache (name VARCHAR(255) NOT NULL, args VARCHAR(64), result MEDIUMBLOB, timestamp DOUBLE, PRIMARY KEY(name, args), \
+                INDEX function_cache_timestamp (timestamp))')
                 self.__execute('CREATE TABLE IF NOT EXISTS db_info (setting VARCHAR(255) NOT NULL, value TEXT, PRIMARY KEY(setting))')
+                self.__execute('CREATE TABLE IF NOT EXISTS host_cache (host VARCHAR(255) NOT NULL, resolvable TINYINT, debrid TEXT, timestamp DOUBLE, PRIMARY KEY(host))')
+                self.__execute('CREATE TABLE IF NOT EXISTS library_item (video_type VARCHAR(15) NOT NULL, trakt_id VARCHAR(15) NOT NULL, updated_at VARCHAR(32), settings_hash VARCHAR(32), \
+                next_check DOUBLE, PRIMARY KEY(video_type, trakt_id))')
+                self.__execute('CREATE TABLE IF NOT EXISTS library_strm (video_type VARCHAR(15) NOT NULL, trakt_id VARCHAR(15) NOT NULL, season VARCHAR(5) NOT NULL, episode VARCHAR(5) NOT NULL, \
+                path TEXT, strm_hash VARCHAR(32), PRIMARY KEY(video_type, trakt_id, season, episode))')
+                self.__execute('CREATE TABLE IF NOT EXISTS scraper_stats (name VARCHAR(255) NOT NULL, stats TEXT, timestamp DOUBLE, PRIMARY KEY(name))')
+                self.__execute('CREATE TABLE IF NOT EXISTS download_queue (id INTEGER NOT NULL AUTO_INCREMENT, url TEXT NOT NULL, path TEXT NOT NULL, file_name TEXT NOT NULL, \
+                added DOUBLE NOT NULL, tries INTEGER NOT NULL DEFAULT 0, next_try DOUBLE NOT NULL DEFAULT 0, PRIMARY KEY(id))')
                 self.__execute('CREATE TABLE IF NOT EXISTS rel_url \
                 (video_type VARCHAR(15) NOT NULL, title VARCHAR(255) NOT NULL, year VARCHAR(4) NOT NULL, season VARCHAR(5) NOT NULL, episode VARCHAR(5) NOT NULL, source VARCHAR(49) NOT NULL, rel_url VARCHAR(255), \
-                PRIMARY KEY(video_type, title, year, season, episode, source))')
+                PRIMARY KEY(video_type, title, year, season, episode, source), INDEX rel_url_source (source))')
                 self.__execute('CREATE TABLE IF NOT EXISTS other_lists (section VARCHAR(10) NOT NULL, username VARCHAR(68) NOT NULL, slug VARCHAR(255) NOT NULL, name VARCHAR(255), \
                 PRIMARY KEY(section, username, slug))')
                 self.__execute('CREATE TABLE IF NOT EXISTS saved_searches (id INTEGER NOT NULL AUTO_INCREMENT, section VARCHAR(10) NOT NULL, added DOUBLE NOT NULL,query VARCHAR(255) NOT NULL, \
@@ -423,25 +668,43 @@ class DB_Connection():
             else:
                 self.__create_sqlite_db()
                 self.__execute('PRAGMA journal_mode=WAL')
-                self.__execute('CREATE TABLE IF NOT EXISTS url_cache (url VARCHAR(255) NOT NULL, data VARCHAR(255), response, res_header, timestamp, PRIMARY KEY(url, data))')
-                self.__execute('CREATE TABLE IF NOT EXISTS function_cache (name VARCHAR(255) NOT NULL, args VARCHAR(64), result, timestamp, PRIMARY KEY(name, args))')
+                self.__execute('CREATE TABLE IF NOT EXISTS url_cache (url VARCHAR(255) NOT NULL, data VARCHAR(255), response BLOB, res_header TEXT, timestamp REAL, last_access REAL, PRIMARY KEY(url, data))')
+                self.__execute('CREATE INDEX IF NOT EXISTS url_cache_timestamp ON url_cache (timestamp)')
+                self.__execute('CREATE INDEX IF NOT EXISTS url_cache_last_access ON url_cache (last_access)')
+                self.__execute('CREATE TABLE IF NOT EXISTS function_cache (name VARCHAR(255) NOT NULL, args VARCHAR(64), result, timestamp REAL, PRIMARY KEY(name, args))')
+                self.__execute('CREATE INDEX IF NOT EXISTS function_cache_timestamp ON function_cache (timestamp)')
                 self.__execute('CREATE TABLE IF NOT EXISTS db_info (setting VARCHAR(255), value TEXT, PRIMARY KEY(setting))')
+                self.__execute('CREATE TABLE IF NOT EXISTS host_cache (host TEXT NOT NULL, resolvable INTEGER, debrid TEXT, timestamp REAL, PRIMARY KEY(host))')
+                self.__execute('CREATE TABLE IF NOT EXISTS library_item (video_type TEXT NOT NULL, trakt_id TEXT NOT NULL, updated_at TEXT, settings_hash TEXT, next_check REAL, \
+                PRIMARY KEY(video_type, trakt_id))')
+                self.__execute('CREATE TABLE IF NOT EXISTS library_strm (video_type TEXT NOT NULL, trakt_id TEXT NOT NULL, season TEXT NOT NULL, episode TEXT NOT NULL, path TEXT, strm_hash TEXT, \
+                PRIMARY KEY(video_type, trakt_id, season, episode))')
+                self.__execute('CREATE TABLE IF NOT EXISTS scraper_stats (name TEXT NOT NULL, stats TEXT, timestamp REAL, PRIMARY KEY(name))')
+                self.__execute('CREATE TABLE IF NOT EXISTS download_queue (id INTEGER PRIMARY KEY, url TEXT NOT NULL, path TEXT NOT NULL, file_name TEXT NOT NULL, added REAL NOT NULL, \
+                tries INTEGER NOT NULL DEFAULT 0, next_try REAL NOT NULL DEFAULT 0)')
                 self.__execute('CREATE TABLE IF NOT EXISTS rel_url \
                 (video_type TEXT NOT NULL, title TEXT NOT NULL, year TEXT NOT NULL, season TEXT NOT NULL, episode TEXT NOT NULL, source TEXT NOT NULL, rel_url TEXT, \
                 PRIMARY KEY(video_type, title, year, season, episode, source))')
+                self.__execute('CREATE INDEX IF NOT EXISTS rel_url_source ON rel_url (source)')
                 self.__execute('CREATE TABLE IF NOT EXISTS other_lists (section TEXT NOT NULL, username TEXT NOT NULL, slug TEXT NOT NULL, name TEXT, PRIMARY KEY(section, username, slug))')
                 self.__execute('CREATE TABLE IF NOT EXISTS saved_searches (id INTEGER PRIMARY KEY, section TEXT NOT NULL, added DOUBLE NOT NULL,query TEXT NOT NULL)')
                 self.__execute('CREATE TABLE IF NOT EXISTS bookmark (slug TEXT NOT NULL, season TEXT NOT NULL, episode TEXT NOT NULL, resumepoint DOUBLE NOT NULL, \
                 PRIMARY KEY(slug, season, episode))')
     
+            # download_queue is preserved rather than rebuilt, so the retry columns (schema 3) are added to an older one
+            for column, column_type in [('tries', 'INTEGER'), ('next_try', 'DOUBLE')]:
+                if not self.__column_exists('download_queue', column):
+                    self.__execute('ALTER TABLE download_queue ADD COLUMN %s %s NOT NULL DEFAULT 0' % (column, column_type))
+
             # reload the previously saved backup export
-            if db_version is not None and cur_version != db_version:
+            if upgrade:
                 log_utils.log('Restoring DB from backup at %s' % (self.mig_path), log_utils.LOGDEBUG)
                 self.import_into_db(self.mig_path)
                 log_utils.log('DB restored from %s' % (self.mig_path), log_utils.LOGNOTICE)
     
             sql = 'REPLACE INTO db_info (setting, value) VALUES(?,?)'
             self.__execute(sql, ('version', kodi.get_version()))
+            self.__execute(sql, ('schema_version', str(SCHEMA_VERSION)))
         finally:
             if self.progress is not None:
                 self.progress.close()
@@ -458,10 +721,26 @@ class DB_Connection():
         else:
             return True
 
+    def __column_exists(self, table, column):
+        if self.db_type == DB_TYPES.MYSQL:
+            rows = self.__execute('SHOW COLUMNS FROM %s LIKE ?' % (table), (column,))
+        else:
+            rows = [row for row in self.__execute('PRAGMA table_info(%s)' % (table)) if row[1] == column]
+        return bool(rows)
+
+    def __get_schema_version(self):
+        # an empty db will be built at the current version; tables without a recorded version predate versioning
+        if not self.__table_exists('url_cache'):
+            return SCHEMA_VERSION
+        elif not self.__table_exists('db_info'):
+            return 1
+
+        try: return int(self.get_setting('schema_version'))
+        except (TypeError, ValueError): return 1
+
     def reset_db(self):
         if self.db_type == DB_TYPES.SQLITE:
-            try: self.db.close()
-            except: pass
+            self.release()
             os.remove(self.db_path)
             self.db = None
             self.__connect_to_db()
@@ -505,9 +784,14 @@ class DB_Connection():
             params = []
 
         rows = None
+        # a released connection (e.g. one cached by a scraper) reconnects on its next use
+        self.__connect_to_db()
         sql = self.__format(sql)
         is_read = self.__is_read(sql)
-        if self.db_type == DB_TYPES.SQLITE and not is_read:
+        # a batch already holds the semaphore and commits once at the end
+        in_batch = self.__batch
+        use_sema = self.db_type == DB_TYPES.SQLITE and not is_read and not in_batch
+        if use_sema:
             SQL_SEMA.acquire()
             
         try:
@@ -515,15 +799,17 @@ class DB_Connection():
             while True:
                 try:
                     if not is_read: DB_Connection.writes += 1
-                    cur = self.db.cursor()
-                    # log_utils.log('Running: %s with %s' % (sql, params), log_utils.LOGDEBUG)
-                    cur.execute(sql, params)
-                    if is_read:
-                        rows = cur.fetchall()
-                    cur.close()
-                    self.db.commit()
-                    if SPEED == 0:
-                        self.__update_writers()
+                    with log_utils.span('db'):
+                        cur = self.db.cursor()
+                        # log_utils.log('Running: %s with %s' % (sql, params), log_utils.LOGDEBUG)
+                        cur.execute(sql, params)
+                        if is_read:
+                            rows = cur.fetchall()
+                        cur.close()
+                        if not in_batch:
+                            self.db.commit()
+                            if SPEED == 0:
+                                self.__update_writers()
                     return rows
                 except OperationalError as e:
                     if tries < MAX_TRIES:
@@ -531,8 +817,10 @@ class DB_Connection():
                         log_utils.log('Retrying (%s/%s) SQL: %s Error: %s' % (tries, MAX_TRIES, sql, e), log_utils.LOGWARNING)
                         if 'database is locked' in str(e).lower():
                             DB_Connection.locks += 1
-                        self.db = None
-                        self.__connect_to_db()
+                        # reconnecting would throw away the uncommitted part of a batch
+                        if not in_batch:
+                            self.release()
+                            self.__connect_to_db()
                     elif any(s for s in ['no such table', 'no such column'] if s in str(e)):
                         self.db.rollback()
                         raise DatabaseRecoveryError(e)
@@ -542,9 +830,89 @@ class DB_Connection():
                     self.db.rollback()
                     raise DatabaseRecoveryError(e)
         finally:
-            if self.db_type == DB_TYPES.SQLITE and not is_read:
+            if use_sema:
+                SQL_SEMA.release()
+
+    @contextmanager
+    def batch_writes(self):
+        """
+        Run every statement made on this connection inside the block as a single transaction with a single commit.
+        Nested blocks join the outer one
+        """
+        if self.__batch:
+            yield
+            return
+
+        self.__connect_to_db()
+        if self.db_type == DB_TYPES.SQLITE:
+            SQL_SEMA.acquire()
+        self.__batch = True
+        try:
+            yield
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            self.__batch = False
+            if self.db_type == DB_TYPES.SQLITE:
                 SQL_SEMA.release()
 
+    def __write_behind(self, sql, params, key=None):
+        # inside a batch the write just joins the batch
+        if self.__batch:
+            self.__execute(sql, params)
+            return
+
+        WRITE_Q.put((sql, params, key))
+        with WRITER_LOCK:
+            if DB_Connection.writer is None or not DB_Connection.writer.is_alive():
+                DB_Connection.writer = threading.Thread(target=DB_Connection.__write_worker)
+                DB_Connection.writer.daemon = True
+                DB_Connection.writer.start()
+
+    @staticmethod
+    def __write_worker():
+        """
+        The single writer behind the write-behind queue; everything queued is committed WRITE_BATCH statements at a time
+        """
+        db_connection = None
+        while True:
+            writes = [WRITE_Q.get()]
+            while len(writes) < WRITE_BATCH:
+                try: writes.append(WRITE_Q.get_nowait())
+                except Empty: break
+
+            try:
+                if db_connection is None: db_connection = get_db_connection()
+                try:
+                    with db_connection.batch_writes():
+                        for sql, params, _key in writes:
+                            db_connection.__execute(sql, params)
+                except Exception as e:
+                    # the batch was rolled back; replay it a statement at a time so only the bad one is lost
+                    log_utils.log('Write-behind batch of %s statements failed: %s; retrying one at a time' % (len(writes), e), log_utils.LOGWARNING)
+                    for sql, params, _key in writes:
+                        try: db_connection.__execute(sql, params)
+                        except Exception as e:
+                            log_utils.log('Write-behind statement failed: %s (%s): %s' % (sql, params, e), log_utils.LOGWARNING)
+            except Exception as e:
+                log_utils.log('Write-behind batch of %s statements failed: %s' % (len(writes), e), log_utils.LOGWARNING)
+            finally:
+                with PENDING_LOCK:
+                    for _sql, params, key in writes:
+                        if key is not None and PENDING_REL_URLS.get(key) is params:
+                            del PENDING_REL_URLS[key]
+
+                for _ in writes: WRITE_Q.task_done()
+
+    @staticmethod
+    def flush_writes():
+        """
+        Block until every queued write-behind statement has been written
+        """
+        WRITE_Q.join()
+
     def __update_writers(self):
         global MAX_WRITERS
         global INCREASED
@@ -569,7 +937,7 @@ class DB_Connection():
         
     def __is_read(self, sql):
         fragment = sql[:6].upper()
-        return fragment[:6] == 'SELECT' or fragment[:4] == 'SHOW'
+        return fragment[:6] == 'SELECT' or fragment[:4] == 'SHOW' or fragment[:6] == 'PRAGMA'
     
     # purpose is to save the current db with an export, drop the db, recreate it, then connect to it
     def __prep_for_reinit(self):
@@ -591,7 +959,7 @@ class DB_Connection():
         else:
             sql = 'select name from sqlite_master where type="table"'
         rows = self.__execute(sql)
-        db_objects = [row[0] for row in rows]
+        db_objects = [row[0] for row in rows if row[0] not in PRESERVED_TABLES]
 
         for db_object in db_objects:
             sql = 'DROP TABLE IF EXISTS %s' % (db_object)
@@ -599,8 +967,14 @@ class DB_Connection():
 
     def __connect_to_db(self):
         if not self.db:
+            self.thread_ident = threading.current_thread().ident
             if self.db_type == DB_TYPES.MYSQL:
-                self.db = self.db_lib.connect(database=self.dbname, user=self.username, password=self.password, host=self.address, buffered=True)
+                params = {'database': self.dbname, 'user': self.username, 'password': self.password, 'host': self.address, 'buffered': True}
+                try:
+                    self.db = self.db_lib.connect(pool_name=MYSQL_POOL_NAME, pool_size=MYSQL_POOL_SIZE, **params)
+                except self.db_lib.PoolError as e:
+                    log_utils.log('MySQL pool unavailable (%s); using an unpooled connection' % (e), log_utils.LOGDEBUG)
+                    self.db = self.db_lib.connect(**params)
             else:
                 self.db = self.db_lib.connect(self.db_path)
                 self.db.text_factory = str
@@ -17,6 +17,92 @@
 '''
 import re
 import log_utils
+from lru_cache import LRU_Cache
+
+DOC_CACHE_SIZE = 16
+DOC_CACHE_CHARS = 1024 * 1024 * 4
+DOC_CACHE_TTL = 60
+MULTILINE_TAG_RE = re.compile('(<[^>]*\n[^>]*>)')
+TAG_RE = re.compile('<([\w:-]+)')
+PLAIN_NAME_RE = re.compile('^[\w:-]+$')
+
+# scrapers query the same page many times in a row, so keep the last few tokenized pages around
+DOC_CACHE = LRU_Cache(DOC_CACHE_SIZE, DOC_CACHE_CHARS, DOC_CACHE_TTL)
+
+class _Document(object):
+    '''
+    A decoded page with multi-line tags flattened and an index of where every tag starts (by lower-cased tag name)
+    '''
+    def __init__(self, html):
+        self.html = MULTILINE_TAG_RE.sub(_flatten_tag, html)
+        index = {}
+        for match in TAG_RE.finditer(self.html):
+            index.setdefault(match.group(1).lower(), []).append(match.start())
+        self.index = index
+
+    def findall(self, pattern, name):
+        '''
+        Same result as pattern.findall(self.html) for a pattern that starts with <name, but only tries it where name starts
+        '''
+        if not PLAIN_NAME_RE.match(name):
+            return pattern.findall(self.html)
+
+        results = []
+        last_end = 0
+        for pos in self.index.get(name.lower(), []):
+            if pos < last_end: continue
+            match = pattern.match(self.html, pos)
+            if match:
+                results.append(match.group(1))
+                last_end = match.end()
+        return results
+
+class _View(object):
+    '''
+    Behaves like html[offset:] for find and slicing without copying the rest of the page
+    '''
+    def __init__(self, html, offset=0):
+        self.html = html
+        self.offset = offset
+        self.length = len(html) - offset
+
+    def find(self, sub, start=0):
+        if start < 0: start = max(start + self.length, 0)
+        index = self.html.find(sub, self.offset + start)
+        return index - self.offset if index != -1 else -1
+
+    def slice(self, start=None, end=None):
+        start, end, _step = slice(start, end).indices(self.length)
+        return self.html[self.offset + start:self.offset + max(start, end)]
+
+    def advance(self, start):
+        start, _end, _step = slice(start, None).indices(self.length)
+        return _View(self.html, self.offset + start)
+
+def _flatten_tag(match):
+    return match.group(1).replace('\n', ' ').replace('\r', ' ')
+
+def _get_documents(html, decode=True):
+    # list items are used as-is, so they're cached separately from the same string passed in on its own
+    key = html if decode else (None, html)
+    docs = DOC_CACHE.get(key)
+    if docs is None:
+        items = _decode(html) if decode else [html]
+        docs = [_Document(item) for item in items]
+        DOC_CACHE.set(key, docs, len(html))
+    return docs
+
+def _decode(html):
+    if isinstance(html, str):
+        try:
+            return [html.decode("utf-8")]  # Replace with chardet thingy
+        except:
+            log_utils.log("Couldn't decode html binary string. Data length: " + repr(len(html)), log_utils.LOGWARNING)
+            try:
+                return [html.decode("utf-8", "replace")]
+            except:
+                log_utils.log("Couldn't decode html binary string (replace). Data length: " + repr(len(html)), log_utils.LOGWARNING)
+    return [html]
 
 def _getDOMContent(html, name, match, ret):
     end_str = "</%s" % (name)
@@ -35,16 +121,16 @@ def _getDOMContent(html, name, match, ret):
     if start == -1 and end == -1:
         result = ''
     elif start > -1 and end > -1:
-        result = html[start + len(match):end]
+        result = html.slice(start + len(match), end)
     elif end > -1:
-        result = html[:end]
+        result = html.slice(None, end)
     elif start > -1:
-        result = html[start + len(match):]
+        result = html.slice(start + len(match))
     else:
         result = ''
 
     if ret:
-        endstr = html[end:html.find(">", html.find(end_str)) + 1]
+        endstr = html.slice(end, html.find(">", html.find(end_str)) + 1)
         result = match + result + endstr
 
     return result
@@ -54,60 +140,53 @@ def _getDOMAttributes(match, name, ret):
     results = re.findall(pattern, match, re.I | re.M | re.S)
     return [result[1] if result[1] else result[2] for result in results]
 
-def _getDOMElements(item, name, attrs):
+def _getDOMElements(doc, name, attrs):
     if not attrs:
         pattern = '(<%s(?: [^>]*>|/?>))' % (name)
-        this_list = re.findall(pattern, item, re.M | re.S | re.I)
+        this_list = doc.findall(re.compile(pattern, re.M | re.S | re.I), name)
     else:
         last_list = None
         for key in attrs:
             pattern = '''(<%s [^>]*%s=['"]%s['"][^>]*>)''' % (name, key, attrs[key])
-            this_list = re.findall(pattern, item, re.M | re. S | re.I)
+            this_list = doc.findall(re.compile(pattern, re.M | re.S | re.I), name)
             if not this_list and ' ' not in attrs[key]:
                 pattern = '''(<%s [^>]*%s=%s[^>]*>)''' % (name, key, attrs[key])
-                this_list = re.findall(pattern, item, re.M | re. S | re.I)
-    
+                this_list = doc.findall(re.compile(pattern, re.M | re.S | re.I), name)
+
             if last_list is None:
                 last_list = this_list
             else:
                 last_list = [item for item in this_list if item in last_list]
         this_list = last_list
-    
+
     return this_list
 
 def parse_dom(html, name='', attrs=None, ret=False):
     if attrs is None: attrs = {}
-    log_utils.log('parse_dom: Name: |%s| Attrs: |%s| Ret: |%s| - HTML: %s' % (name, attrs, ret, type(html)), log_utils.LOGDEBUG)
-    if isinstance(html, str):
-        try:
-            html = [html.decode("utf-8")]  # Replace with chardet thingy
-        except:
-            log_utils.log("Couldn't decode html binary string. Data length: " + repr(len(html)), log_utils.LOGWARNING)
-            try:
-                html = [html.decode("utf-8", "replace")]
-            except:
-                log_utils.log("Couldn't decode html binary string (replace). Data length: " + repr(len(html)), log_utils.LOGWARNING)
-                html = [html]
-    elif isinstance(html, unicode):
-        html = [html]
-    elif not isinstance(html, list):
+    log_utils.log('parse_dom: Name: |%s| Attrs: |%s| Ret: |%s| - HTML: %s', log_utils.LOGDEBUG, name, attrs, ret, type(html))
+    with log_utils.span('parse_dom'):
+        return _parse_dom(html, name, attrs, ret)
+
+def _parse_dom(html, name, attrs, ret):
+    if isinstance(html, basestring):
+        docs = _get_documents(html)
+    elif isinstance(html, list):
+        docs = [doc for item in html for doc in _get_documents(item, decode=False)]
+    else:
         log_utils.log("Input isn't list or string/unicode.", log_utils.LOGWARNING)
         return ''
 
     if not name.strip():
         log_utils.log("Missing tag name", log_utils.LOGWARNING)
         return ''
-    
+
     if not isinstance(attrs, dict):
         log_utils.log("Attrs must be dictionary", log_utils.LOGWARNING)
         return ''
 
     ret_lst = []
-    for item in html:
-        for match in re.findall('(<[^>]*\n[^>]*>)', item):
-            item = item.replace(match, match.replace('\n', ' ').replace('\r', ' '))
-
-        lst = _getDOMElements(item, name, attrs)
+    for doc in docs:
+        lst = _getDOMElements(doc, name, attrs)
 
         if isinstance(ret, str):
             lst2 = []
@@ -116,9 +195,10 @@ def parse_dom(html, name='', attrs=None, ret=False):
             lst = lst2
         else:
             lst2 = []
+            view = _View(doc.html)
             for match in lst:
-                temp = _getDOMContent(item, name, match, ret).strip()
-                item = item[item.find(temp, item.find(match)):]
+                temp = _getDOMContent(view, name, match, ret).strip()
+                view = view.advance(view.find(temp, view.find(match)))
                 lst2.append(temp)
             lst = lst2
         ret_lst += lst
@@ -0,0 +1,339 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import httplib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import urllib2
+import xbmc
+import xbmcvfs
+import kodi
+import log_utils
+import utils2
+import stream_probe
+from db_utils import get_db_connection
+from constants import *
+from kodi import i18n
+
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+MAX_RETRIES = 5
+MAX_BACKOFF = 30
+PROGRESS_INTERVAL = 1  # seconds between progress dialog updates
+STATE_INTERVAL = 5  # seconds between state file saves
+MAX_JOBS = 2
+POLL_INTERVAL = 5
+RETRY_DELAY = 5 * 60  # seconds before a failed queued download is tried again; doubles with every failure
+MAX_RETRY_DELAY = 24 * 60 * 60  # seconds
+STAGING_DIR = os.path.join(kodi.translate_path(kodi.get_profile()), 'downloads')
+NETWORK_ERRORS = (urllib2.URLError, socket.error, httplib.HTTPException)
+
+class DownloadError(Exception):
+    pass
+
+class Download(object):
+    """
+    Fetches url into path with up to download_segments concurrent Range requests. Progress is kept in a .state file
+    next to the .part file, so a download that fails or is canceled picks up where it stopped the next time it's started
+    """
+    def __init__(self, url, path, file_name, stop_event=None):
+        self.url = url
+        self.path = path
+        self.file_name = file_name
+        self.headers = stream_probe.get_headers(url)
+        if 'User-Agent' not in self.headers: self.headers['User-Agent'] = USER_AGENT
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.ranged = False
+        self.length = 0
+        self.done = 0
+        self.segments = []
+        self.errors = []
+        self.__lock = threading.Lock()
+
+    def run(self, pd):
+        """
+        Returns the path of the finished file or None if the download was stopped before it finished
+        """
+        response = self.__open(0)
+        self.ranged = response.getcode() == 206
+        self.length = self.__get_length(response)
+        self.file_name = self.file_name.replace('.strm', utils2.get_extension(self.url, response))
+        full_path = os.path.join(self.path, self.file_name)
+        part_path = self.__make_dirs(full_path)
+        state_path = part_path + '.state'
+        log_utils.log('Downloading: %s -> %s (Length: %s Ranges: %s)' % (self.url, full_path, self.length, self.ranged), log_utils.LOGDEBUG)
+
+        if self.__load_state(state_path) and os.path.exists(part_path):
+            log_utils.log('Resuming download at %s/%s bytes: %s' % (self.done, self.length, full_path), log_utils.LOGDEBUG)
+            response.close()
+            response = None
+        else:
+            self.__split()
+            with open(part_path, 'wb'):
+                pass
+
+        threads = []
+        for i, segment in enumerate(self.segments):
+            if self.__segment_done(segment): continue
+            # the probe response is already positioned at the start of the first segment
+            first_response, response = (response, None) if i == 0 else (None, response)
+            thread = threading.Thread(target=self.__fetch, args=(part_path, segment, first_response))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        if response is not None: response.close()
+
+        last_progress = last_state = 0
+        while any(thread.is_alive() for thread in threads):
+            if pd.is_canceled():
+                self.stop_event.set()
+
+            now = time.time()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                percent = self.done * 100 / self.length if self.length else 0
+                log_utils.log('Position : %s / %s = %s%%' % (self.done, self.length, percent), log_utils.LOGDEBUG)
+                pd.update(percent)
+            if self.ranged and now - last_state >= STATE_INTERVAL:
+                last_state = now
+                self.__save_state(state_path)
+            time.sleep(.25)
+
+        if self.errors or self.stop_event.is_set():
+            if self.ranged: self.__save_state(state_path)
+            if self.errors: raise self.errors[0]
+            return None
+
+        pd.update(100)
+        self.__finish(part_path, full_path)
+        if xbmcvfs.exists(state_path): xbmcvfs.delete(state_path)
+        return full_path
+
+    def __open(self, start, end=None):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%s-%s' % (start, '' if end is None else end)
+        request = urllib2.Request(self.url.split('|')[0], headers=headers)
+        response = urllib2.urlopen(request, timeout=30)
+        if start and response.getcode() != 206:
+            response.close()
+            raise DownloadError('Server ignored range request')
+        return response
+
+    def __get_length(self, response):
+        match = re.search('/(\d+)', response.info().get('Content-Range', ''))
+        if match:
+            return int(match.group(1))
+        elif 'Content-Length' in response.info():
+            return int(response.info()['Content-Length'])
+        else:
+            return 0
+
+    def __make_dirs(self, full_path):
+        path = xbmc.makeLegalFilename(self.path)
+        try:
+            try: xbmcvfs.mkdirs(path)
+            except: os.makedirs(path)
+        except Exception as e:
+            log_utils.log('Path Create Failed: %s (%s)' % (e, path), log_utils.LOGDEBUG)
+
+        if not path.endswith(os.sep): path += os.sep
+        if not xbmcvfs.exists(path):
+            raise Exception(i18n('failed_create_dir'))
+
+        # segments need random access, so non-local destinations (smb://, nfs://, etc) are downloaded locally then copied
+        local_path = kodi.translate_path(path)
+        if os.path.isdir(local_path):
+            return kodi.translate_path(full_path) + '.part'
+        else:
+            if not os.path.exists(STAGING_DIR): os.makedirs(STAGING_DIR)
+            return os.path.join(STAGING_DIR, hashlib.md5(full_path.encode('utf-8') if isinstance(full_path, unicode) else full_path).hexdigest() + '.part')
+
+    def __split(self):
+        try: segments = int(kodi.get_setting('download_segments'))
+        except ValueError: segments = DEFAULT_SEGMENTS
+        if not self.ranged or not self.length:
+            segments = 1
+        else:
+            segments = max(1, min(segments, self.length / MIN_SEGMENT_SIZE))
+
+        self.done = 0
+        self.segments = []
+        if segments == 1:
+            end = self.length - 1 if self.length else None
+            self.segments.append({'start': 0, 'end': end, 'pos': 0})
+        else:
+            size = self.length / segments
+            for i in xrange(segments):
+                start = i * size
+                end = self.length - 1 if i == segments - 1 else start + size - 1
+                self.segments.append({'start': start, 'end': end, 'pos': start})
+
+    def __segment_done(self, segment):
+        return segment['end'] is not None and segment['pos'] > segment['end']
+
+    def __fetch(self, part_path, segment, response=None):
+        retries = 0
+        try:
+            with open(part_path, 'r+b') as f:
+                while not self.stop_event.is_set() and not self.__segment_done(segment):
+                    try:
+                        if response is None:
+                            response = self.__open(segment['pos'], segment['end'])
+                        f.seek(segment['pos'])
+                        if self.__read_segment(response, f, segment):
+                            break
+                        retries = 0
+                    except NETWORK_ERRORS as e:
+                        retries += 1
+                        # client errors (e.g. an expired link) won't go away by retrying
+                        if not self.ranged or retries > MAX_RETRIES or (isinstance(e, urllib2.HTTPError) and e.code < 500):
+                            raise
+                        log_utils.log('Segment %s-%s failed at %s (%s/%s): %s' % (segment['start'], segment['end'], segment['pos'], retries, MAX_RETRIES, e), log_utils.LOGDEBUG)
+                        self.stop_event.wait(min(2 ** retries, MAX_BACKOFF))
+                    finally:
+                        if response is not None:
+                            response.close()
+                            response = None
+        except Exception as e:
+            log_utils.log('Segment %s-%s failed: %s' % (segment['start'], segment['end'], e), log_utils.LOGWARNING)
+            self.errors.append(e)
+            self.stop_event.set()
+
+    def __read_segment(self, response, f, segment):
+        """
+        Returns True when the (open ended) segment hit the end of the stream
+        """
+        while not self.stop_event.is_set() and not self.__segment_done(segment):
+            size = CHUNK_SIZE if segment['end'] is None else min(CHUNK_SIZE, segment['end'] - segment['pos'] + 1)
+            data = response.read(size)
+            if not data:
+                if segment['end'] is None:
+                    return True
+                else:
+                    raise httplib.IncompleteRead('', segment['end'] - segment['pos'] + 1)
+
+            f.write(data)
+            with self.__lock:
+                segment['pos'] += len(data)
+                self.done += len(data)
+        return False
+
+    def __load_state(self, state_path):
+        if not self.ranged or not self.length:
+            return False
+
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        if state.get('length') != self.length:
+            return False
+        self.segments = [{'start': start, 'end': end, 'pos': pos} for start, end, pos in state['segments']]
+        self.done = sum(segment['pos'] - segment['start'] for segment in self.segments)
+        return True
+
+    def __save_state(self, state_path):
+        with self.__lock:
+            state = {'length': self.length, 'segments': [(segment['start'], segment['end'], segment['pos']) for segment in self.segments]}
+        try:
+            with open(state_path, 'w') as f:
+                json.dump(state, f)
+        except IOError as e:
+            log_utils.log('Unable to save download state: %s (%s)' % (state_path, e), log_utils.LOGWARNING)
+
+    def __finish(self, part_path, full_path):
+        local_path = kodi.translate_path(full_path)
+        if part_path == local_path + '.part':
+            if os.path.exists(local_path): os.remove(local_path)
+            os.rename(part_path, local_path)
+        else:
+            if not xbmcvfs.copy(part_path, full_path):
+                raise Exception(i18n('failed_write_file'))
+            os.remove(part_path)
+
+def download_media(url, path, file_name, background=False, stop_event=None):
+    download = Download(url, path, file_name, stop_event)
+    try:
+        progress = int(kodi.get_setting('down_progress'))
+        active = not progress == PROGRESS.OFF
+        background = background or progress == PROGRESS.BACKGROUND
+        with kodi.ProgressDialog(kodi.get_name(), i18n('downloading') % (file_name), background=background, active=active) as pd:
+            full_path = download.run(pd)
+
+        if full_path is not None:
+            kodi.notify(msg=i18n('download_complete') % (download.file_name), duration=5000)
+            log_utils.log('Download Complete: %s -> %s' % (url, full_path), log_utils.LOGDEBUG)
+            return True
+
+    except Exception as e:
+        log_utils.log('Error (%s) during download: %s -> %s' % (str(e), url, download.file_name), log_utils.LOGERROR)
+        kodi.notify(msg=i18n('download_error') % (str(e), download.file_name), duration=5000)
+    return False
+
+def queue_download(url, path, file_name):
+    get_db_connection().add_download(url, path, file_name)
+    kodi.notify(msg=i18n('download_queued') % (file_name), duration=5000)
+
+class DownloadQueue(object):
+    """
+    Runs queued downloads from the service, max_jobs at a time. Jobs stay queued until they finish, so a download
+    interrupted by a shutdown resumes when the service starts again; a failed one is tried again after a growing delay
+    """
+    def __init__(self, max_jobs=MAX_JOBS):
+        self.max_jobs = max_jobs
+        self.stop_event = threading.Event()
+        self.__jobs = {}
+        self.__last_poll = 0
+
+    def poll(self):
+        if time.time() - self.__last_poll < POLL_INTERVAL:
+            return
+
+        self.__last_poll = time.time()
+        self.__jobs = dict((download_id, thread) for download_id, thread in self.__jobs.iteritems() if thread.is_alive())
+        if len(self.__jobs) >= self.max_jobs:
+            return
+
+        for download_id, url, path, file_name, tries in get_db_connection().get_downloads():
+            if len(self.__jobs) >= self.max_jobs: break
+            if download_id in self.__jobs: continue
+            log_utils.log('Starting queued download %s (tries: %s): %s -> %s' % (download_id, tries, url, file_name), log_utils.LOGDEBUG)
+            thread = threading.Thread(target=self.__run, args=(download_id, url, path, file_name, tries))
+            thread.daemon = True
+            thread.start()
+            self.__jobs[download_id] = thread
+
+    def stop(self, timeout=5):
+        self.stop_event.set()
+        for thread in self.__jobs.itervalues():
+            thread.join(timeout)
+
+    def __run(self, download_id, url, path, file_name, tries):
+        if download_media(url, path, file_name, background=True, stop_event=self.stop_event):
+            get_db_connection().delete_download(download_id)
+        elif not self.stop_event.is_set():
+            # keep the job (and its .state sidecar) so a network error or a full disk doesn't lose it
+            delay = min(RETRY_DELAY * 2 ** tries, MAX_RETRY_DELAY)
+            log_utils.log('Queued download %s failed; retrying in %ss: %s' % (download_id, delay, file_name), log_utils.LOGWARNING)
+            get_db_connection().retry_download(download_id, time.time() + delay)
@@ -0,0 +1,140 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import httplib
+import socket
+import threading
+import urllib2
+from StringIO import StringIO
+import log_utils
+
+MAX_IDLE = 4
+MAX_BUFFER = 1024 * 1024 * 2
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections keyed by (connection class, host). Connections are only ever handed to one thread at a time
+    """
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        self.__lock = threading.Lock()
+        self.__idle = {}
+
+    def get(self, key):
+        with self.__lock:
+            conns = self.__idle.get(key)
+            if conns:
+                return conns.pop()
+
+    def put(self, key, conn):
+        with self.__lock:
+            conns = self.__idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.__lock:
+            for conns in self.__idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self.__idle = {}
+
+class KeepAliveMixin(object):
+    conn_class = None
+
+    def _keepalive_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        key = (self.conn_class.__name__, host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        response = None
+        conn = self.pool.get(key)
+        if conn is not None:
+            if conn.sock is not None and req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                conn.sock.settimeout(req.timeout)
+            try:
+                response = self.__request(conn, req, headers)
+            except (socket.error, httplib.HTTPException) as e:
+                # the server dropped the idle connection; try once more on a fresh one
+                log_utils.log('Stale keep-alive connection to %s: %s' % (host, e), log_utils.LOGDEBUG)
+                conn.close()
+
+        if response is None:
+            conn = self.conn_class(host, timeout=req.timeout)
+            try:
+                response = self.__request(conn, req, headers)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        if response.will_close or (response.length is not None and response.length > MAX_BUFFER):
+            # not reusable; hand the socket to the caller exactly like urllib2 does
+            response.recv = response.read
+            fp = socket._fileobject(response, close=True)
+        else:
+            try:
+                body = response.read(MAX_BUFFER + 1)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+            if response.isclosed():
+                self.pool.put(key, conn)
+            else:
+                conn.close()
+            fp = StringIO(body)
+
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def __request(self, conn, req, headers):
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering=True)
+
+class HTTPHandler(KeepAliveMixin, urllib2.HTTPHandler):
+    conn_class = httplib.HTTPConnection
+
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        if req._tunnel_host:
+            return urllib2.HTTPHandler.http_open(self, req)
+        return self._keepalive_open(req)
+
+class HTTPSHandler(KeepAliveMixin, urllib2.HTTPSHandler):
+    conn_class = httplib.HTTPSConnection
+
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        if req._tunnel_host:
+            return urllib2.HTTPSHandler.https_open(self, req)
+        return self._keepalive_open(req)
@@ -27,6 +27,7 @@ import os
 import re
 import strings
 import json
+import xml.etree.ElementTree as ET
 
 addon = xbmcaddon.Addon()
 get_setting = addon.getSetting
@@ -52,6 +53,101 @@ def translate_path(path):
 def set_setting(id, value):
     if not isinstance(value, basestring): value = str(value)
     addon.setSetting(id, value)
+    if __settings['current'] is not None:
+        __settings['current'] = __settings['current'].replace(id, value)
+
+def _to_int(value, default=0):
+    try: return int(value)
+    except (TypeError, ValueError): return default
+
+class Settings(object):
+    """
+    Read-only snapshot of the addon's settings, read from the default and profile settings.xml in one go instead of
+    one getSetting call per value. Ids that aren't in either file fall back to getSetting the first time they're read
+    """
+    def __init__(self, values=None):
+        self.__values = self.__load() if values is None else values
+        self.__scrapers = None
+
+    def __load(self):
+        values = {}
+        for path, defaults in [(os.path.join(get_path(), 'resources', 'settings.xml'), True), (os.path.join(translate_path(get_profile()), 'settings.xml'), False)]:
+            try: root = ET.parse(path).getroot()
+            except (IOError, ET.ParseError): continue
+            for element in root.iter('setting'):
+                id = element.get('id')
+                if not id: continue
+                if defaults:
+                    value = element.get('default')
+                    if value is None: continue
+                else:
+                    # old style profile files have value attributes, newer ones keep the value in the element text
+                    value = element.get('value', element.text or '')
+                if isinstance(value, unicode): value = value.encode('utf-8')
+                values[id] = value
+        return values
+
+    def replace(self, id, value):
+        values = dict(self.__values)
+        values[id] = value
+        return Settings(values)
+
+    def get(self, id):
+        value = self.__values.get(id)
+        if value is None:
+            value = self.__values[id] = get_setting(id)
+        return value
+
+    def get_bool(self, id):
+        return self.get(id) == 'true'
+
+    def get_int(self, id, default=0):
+        return _to_int(self.get(id), default)
+
+    def __get_scrapers(self):
+        # built on first use; every <name>-enable/-sub_check/-select/-filter setting parsed in one pass
+        if self.__scrapers is None:
+            scrapers = {'enable': {}, 'sub_check': {}, 'select': {}, 'filter': {}}
+            for id, value in self.__values.items():
+                name, _sep, suffix = id.rpartition('-')
+                if name and suffix in scrapers:
+                    scrapers[suffix][name] = value
+            self.__scrapers = {'enable': dict((name, value in ('true', '')) for name, value in scrapers['enable'].iteritems()),
+                               'sub_check': dict((name, value == 'true') for name, value in scrapers['sub_check'].iteritems()),
+                               'select': dict((name, _to_int(value)) for name, value in scrapers['select'].iteritems()),
+                               'filter': dict((name, _to_int(value)) for name, value in scrapers['filter'].iteritems())}
+        return self.__scrapers
+
+    def scraper_enabled(self, name):
+        # true if the setting is true or doesn't exist (i.e. '')
+        enabled = self.__get_scrapers()['enable'].get(name)
+        return enabled if enabled is not None else self.get('%s-enable' % (name)) in ('true', '')
+
+    def sub_check(self, name):
+        sub_check = self.__get_scrapers()['sub_check'].get(name)
+        return sub_check if sub_check is not None else self.get_bool('%s-sub_check' % (name))
+
+    def scraper_select(self, name):
+        select = self.__get_scrapers()['select'].get(name)
+        return select if select is not None else self.get_int('%s-select' % (name))
+
+    def filter_days(self, name):
+        filter_days = self.__get_scrapers()['filter'].get(name)
+        return filter_days if filter_days is not None else self.get_int('%s-filter' % (name))
+
+__settings = {'current': None}
+
+def get_settings():
+    """
+    The settings snapshot for this invocation; loaded on first use
+    """
+    if __settings['current'] is None:
+        __settings['current'] = Settings()
+    return __settings['current']
+
+def refresh_settings():
+    __settings['current'] = Settings()
+    return __settings['current']
 
 def get_version():
     return addon.getAddonInfo('version')
@@ -1,15 +1,50 @@
+import threading
 import time
 import kodi
 from xbmc import LOGDEBUG, LOGERROR, LOGFATAL, LOGINFO, LOGNONE, LOGNOTICE, LOGSEVERE, LOGWARNING  # @UnusedImport
 
 name = kodi.get_name()
+LEVEL_REFRESH = 60  # seconds the debug settings are trusted before they're checked again
+
+__levels = {'checked': 0, 'addon_debug': False, 'kodi_debug': False}
+__spans = {}
+__spans_lock = threading.Lock()
+
+def __refresh_levels():
+    now = time.time()
+    if now - __levels['checked'] >= LEVEL_REFRESH:
+        __levels['addon_debug'] = kodi.get_settings().get_bool('addon_debug')
+        if not __levels['addon_debug']:
+            # if kodi can't tell us, hand everything to xbmc.log and let it decide
+            try: __levels['kodi_debug'] = bool(__is_debugging())
+            except: __levels['kodi_debug'] = True
+        __levels['checked'] = now
+    return __levels
+
+def is_enabled(level=LOGDEBUG):
+    """
+    False if a message at level would be thrown away; use it to skip building expensive log messages
+    """
+    if level != LOGDEBUG:
+        return True
+    levels = __refresh_levels()
+    return levels['addon_debug'] or bool(levels['kodi_debug'])
+
+def log(msg, level=LOGDEBUG, *args):
+    """
+    msg is only formatted with args (msg % args) if the message is actually going to be logged
+    """
+    if level == LOGDEBUG:
+        levels = __refresh_levels()
+        # override message level to force logging when addon logging turned on
+        if levels['addon_debug']:
+            level = LOGNOTICE
+        elif not levels['kodi_debug']:
+            return
 
-def log(msg, level=LOGDEBUG):
-    # override message level to force logging when addon logging turned on
-    if kodi.get_setting('addon_debug') == 'true' and level == LOGDEBUG:
-        level = LOGNOTICE
-    
     try:
+        if args:
+            msg = msg % args
         if isinstance(msg, unicode):
             msg = '%s (ENCODED)' % (msg.encode('utf-8'))
 
@@ -18,22 +53,66 @@ def log(msg, level=LOGDEBUG):
         try: kodi.__log('Logging Failure: %s' % (e), level)
         except: pass  # just give up
 
+class _Span(object):
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_timing(self.name, time.time() - self.start)
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NO_SPAN = _NoSpan()
+
+def span(name):
+    """
+    with log_utils.span('fetch'): ... adds the time spent in the block to the summary; does nothing when debug logging is off
+    """
+    return _Span(name) if is_enabled() else NO_SPAN
+
+def add_timing(name, elapsed):
+    with __spans_lock:
+        timing = __spans.get(name)
+        if timing is None:
+            __spans[name] = [1, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+
+def log_summary():
+    """
+    Log (and reset) the totals of every span timed so far
+    """
+    with __spans_lock:
+        spans = sorted(__spans.iteritems(), key=lambda item: -item[1][1])
+        __spans.clear()
+    if spans:
+        log('Timing Summary: %s', LOGDEBUG, ', '.join('%s: %d in %.3fs (max %.3fs)' % (name, count, total, longest) for name, (count, total, longest) in spans))
+
 def trace(method):
     #  @debug decorator
-    def method_trace_on(*args, **kwargs):
+    def method_trace(*args, **kwargs):
+        if not is_enabled():
+            return method(*args, **kwargs)
+
         start = time.time()
         result = method(*args, **kwargs)
-        end = time.time()
-        log('{name!r} time: {time:2.4f}s args: |{args!r}| kwargs: |{kwargs!r}|'.format(name=method.__name__, time=end - start, args=args, kwargs=kwargs), LOGDEBUG)
+        elapsed = time.time() - start
+        add_timing(method.__name__, elapsed)
+        log('{name!r} time: {time:2.4f}s args: |{args!r}| kwargs: |{kwargs!r}|'.format(name=method.__name__, time=elapsed, args=args, kwargs=kwargs), LOGDEBUG)
         return result
-
-    def method_trace_off(*args, **kwargs):
-        return method(*args, **kwargs)
-
-    if __is_debugging():
-        return method_trace_on
-    else:
-        return method_trace_off
+    return method_trace
 
 def __is_debugging():
     command = {'jsonrpc': '2.0', 'id': 1, 'method': 'Settings.getSettings', 'params': {'filter': {'section': 'system', 'category': 'logging'}}}
@@ -42,5 +121,5 @@ def __is_debugging():
         for item in js_data['result']['settings']:
             if item['id'] == 'debug.showloginfo':
                 return item['value']
-    
+
     return False
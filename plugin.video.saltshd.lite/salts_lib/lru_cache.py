@@ -0,0 +1,72 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+class LRU_Cache(object):
+    """
+    Thread-safe LRU cache bounded by entry count and total size. Entries expire ttl seconds after they are stored
+    """
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__cache = OrderedDict()
+        self.__bytes = 0
+
+    def get(self, key):
+        with self.__lock:
+            item = self.__cache.pop(key, None)
+            if item is None:
+                return None
+
+            stored, size, value = item
+            if time.time() - stored > self.ttl:
+                self.__bytes -= size
+                return None
+
+            self.__cache[key] = item
+            return value
+
+    def set(self, key, value, size=0):
+        with self.__lock:
+            self.__remove(key)
+            if size > self.max_bytes:
+                return
+
+            self.__cache[key] = (time.time(), size, value)
+            self.__bytes += size
+            while len(self.__cache) > self.max_entries or self.__bytes > self.max_bytes:
+                _key, (_stored, old_size, _value) = self.__cache.popitem(last=False)
+                self.__bytes -= old_size
+
+    def delete(self, key):
+        with self.__lock:
+            self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            self.__bytes = 0
+
+    def __remove(self, key):
+        item = self.__cache.pop(key, None)
+        if item is not None:
+            self.__bytes -= item[1]
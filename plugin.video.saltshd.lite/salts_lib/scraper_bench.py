@@ -0,0 +1,280 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import urllib2
+import zlib
+import dom_parser
+import kodi
+import log_utils
+from constants import VIDEO_TYPES
+from scrapers import get_scrapers, ScraperVideo, scraper
+
+try: import resource
+except ImportError: resource = None
+
+BENCH_DIR = os.path.join(kodi.translate_path(kodi.get_profile()), 'bench')
+REPORT_FILE = 'report.txt'
+VIDEOS_FILE = 'videos.json'
+BENCH_TIMEOUT = 30
+REGEX_METHODS = ['search', 'match', 'findall', 'finditer', 'sub', 'subn', 'split']
+
+# used when the bench dir doesn't have a videos.json; same format: a list of ScraperVideo keyword args
+DEFAULT_VIDEOS = [
+    {'video_type': VIDEO_TYPES.MOVIE, 'title': 'The Martian', 'year': '2015', 'trakt_id': '183371'},
+    {'video_type': VIDEO_TYPES.EPISODE, 'title': 'Game of Thrones', 'year': '2011', 'trakt_id': '1390', 'season': '1', 'episode': '1',
+     'ep_title': 'Winter Is Coming', 'ep_airdate': '2011-04-17'},
+]
+
+class _Stats(object):
+    def __init__(self):
+        self.requests = 0
+        self.misses = 0
+        self.bytes = 0
+        self.regex = 0
+        self.parse_dom = 0
+
+class _CountedPattern(object):
+    """
+    Stands in for a compiled pattern while the bench runs, so that searches made through a precompiled pattern are
+    counted as well as the re module functions (which compile through re._compile)
+    """
+    def __init__(self, bench, compiled):
+        self.bench = bench
+        self.compiled = compiled
+
+    def __getattr__(self, name):
+        if name in REGEX_METHODS: self.bench.count_regex()
+        return getattr(self.compiled, name)
+
+class Bench(object):
+    """
+    Runs search, get_url and get_sources for every scraper against a fixed set of videos. When recording, every
+    _cached_http_get response is saved to a fixture file per scraper; when replaying, responses come only from those
+    fixtures and any other request (a scraper's own urllib2 call, say) fails, so the run never touches the network
+    """
+    def __init__(self, record=False):
+        self.record = record
+        self.stats = None
+        self.fixtures = {}
+        self.dirty = set()
+        self.rows = []
+
+    def run(self):
+        if not os.path.exists(BENCH_DIR):
+            os.makedirs(BENCH_DIR)
+
+        saved = self.__install()
+        try:
+            videos = [ScraperVideo(**video) for video in self.__get_videos()]
+            for cls in get_scrapers():
+                for video in videos:
+                    if video.video_type not in cls.provides():
+                        continue
+                    self.__bench_scraper(cls, video)
+        finally:
+            self.__uninstall(saved)
+            self.__save_fixtures()
+
+        return self.__write_report()
+
+    def __bench_scraper(self, cls, video):
+        try:
+            instance = cls(BENCH_TIMEOUT)
+        except Exception as e:
+            log_utils.log('Bench: Unable to create %s: %s' % (cls.get_name(), e), log_utils.LOGWARNING)
+            return
+
+        search_type = VIDEO_TYPES.TVSHOW if video.video_type == VIDEO_TYPES.EPISODE else video.video_type
+        calls = [('search', instance.search, (search_type, video.title, video.year)),
+                 ('get_url', instance.get_url, (video,)),
+                 ('get_sources', instance.get_sources, (video,))]
+        for name, func, args in calls:
+            self.rows.append([cls.get_name(), video.video_type, name] + self.__measure(func, args))
+
+    def __measure(self, func, args):
+        self.stats = _Stats()
+        error = ''
+        results = 0
+        rss = self.__max_rss()
+        cpu = self.__cpu_time()
+        start = time.time()
+        try:
+            result = func(*args)
+            if isinstance(result, (list, tuple)): results = len(result)
+            elif result: results = 1
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        wall = time.time() - start
+        cpu = self.__cpu_time() - cpu
+        rss = self.__max_rss() - rss if rss is not None else None
+        stats, self.stats = self.stats, None
+        return [wall, cpu, stats.bytes, stats.regex, stats.parse_dom, stats.requests, stats.misses, rss, results, error]
+
+    def __cpu_time(self):
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return usage.ru_utime + usage.ru_stime
+        else:
+            return time.clock()
+
+    def __max_rss(self):
+        # high-water mark for the whole process; the growth it shows is only an upper bound on what one call added
+        if resource is not None:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def __install(self):
+        saved = {'http': scraper.Scraper.__dict__['_cached_http_get'], 'parse_dom': dom_parser.parse_dom, 're': re._compile,
+                 'open': urllib2.OpenerDirector.open, 'patterns': []}
+        bench = self
+        orig_http_get = saved['http']
+        orig_parse_dom = saved['parse_dom']
+        orig_compile = saved['re']
+
+        def _cached_http_get(self, url, base_url, timeout, cookies=None, data=None, multipart_data=None, headers=None, allow_redirect=True, method=None,
+                             require_debrid=False, cache_limit=8):
+            post_data = multipart_data if multipart_data is not None else data
+            if bench.record:
+                html = orig_http_get(self, url, base_url, timeout, cookies=cookies, data=data, multipart_data=multipart_data, headers=headers,
+                                     allow_redirect=allow_redirect, method=method, require_debrid=require_debrid, cache_limit=cache_limit)
+                bench.save_response(self, url, post_data, method, html)
+            else:
+                html = bench.get_response(self, url, post_data, method)
+            return html
+
+        def parse_dom(*args, **kwargs):
+            if bench.stats is not None: bench.stats.parse_dom += 1
+            return orig_parse_dom(*args, **kwargs)
+
+        def _compile(pattern, flags):
+            if isinstance(pattern, _CountedPattern): pattern = pattern.compiled
+            return _CountedPattern(bench, orig_compile(pattern, flags))
+
+        def open_url(opener, fullurl, *args, **kwargs):
+            url = fullurl.get_full_url() if isinstance(fullurl, urllib2.Request) else fullurl
+            log_utils.log('Bench: Blocked request during replay: %s' % (url), log_utils.LOGDEBUG)
+            if bench.stats is not None:
+                bench.stats.requests += 1
+                bench.stats.misses += 1
+            raise urllib2.URLError('network disabled during bench replay')
+
+        scraper.Scraper._cached_http_get = _cached_http_get
+        dom_parser.parse_dom = parse_dom
+        re._compile = _compile
+        # patterns compiled at import time never go through re._compile again
+        addon_path = kodi.translate_path(kodi.get_path())
+        for module in sys.modules.values():
+            if module is None or not getattr(module, '__file__', '').startswith(addon_path): continue
+            for name, value in vars(module).items():
+                if isinstance(value, re._pattern_type):
+                    setattr(module, name, _CountedPattern(bench, value))
+                    saved['patterns'].append((module, name, value))
+        # every opener (Scraper._get_opener's, urlopen's, one a scraper builds itself) goes through OpenerDirector.open
+        if not self.record:
+            urllib2.OpenerDirector.open = open_url
+        return saved
+
+    def __uninstall(self, saved):
+        scraper.Scraper._cached_http_get = saved['http']
+        dom_parser.parse_dom = saved['parse_dom']
+        re._compile = saved['re']
+        urllib2.OpenerDirector.open = saved['open']
+        for module, name, value in saved['patterns']:
+            setattr(module, name, value)
+
+    def count_regex(self):
+        if self.stats is not None: self.stats.regex += 1
+
+    def save_response(self, instance, url, data, method, html):
+        fixtures = self.__get_fixtures(instance)
+        key = self.__make_key(url, data, method)
+        fixtures[key] = {'url': url, 'data': data, 'method': method, 'html': base64.b64encode(zlib.compress(html or ''))}
+        self.dirty.add(instance.get_name())
+        if self.stats is not None:
+            self.stats.requests += 1
+            self.stats.bytes += len(html or '')
+
+    def get_response(self, instance, url, data, method):
+        fixture = self.__get_fixtures(instance).get(self.__make_key(url, data, method))
+        if self.stats is not None:
+            self.stats.requests += 1
+        if fixture is None:
+            log_utils.log('Bench: No fixture for %s: %s (%s)' % (instance.get_name(), url, data), log_utils.LOGDEBUG)
+            if self.stats is not None: self.stats.misses += 1
+            return ''
+
+        html = zlib.decompress(base64.b64decode(fixture['html']))
+        if self.stats is not None: self.stats.bytes += len(html)
+        return html
+
+    def __make_key(self, url, data, method):
+        return hashlib.md5('%s|%s|%s' % (url, data, method)).hexdigest()
+
+    def __get_fixtures(self, instance):
+        name = instance.get_name()
+        if name not in self.fixtures:
+            try:
+                with open(self.__fixture_path(name), 'r') as f:
+                    self.fixtures[name] = json.load(f)
+            except (IOError, ValueError):
+                self.fixtures[name] = {}
+        return self.fixtures[name]
+
+    def __save_fixtures(self):
+        for name in self.dirty:
+            with open(self.__fixture_path(name), 'w') as f:
+                json.dump(self.fixtures[name], f)
+
+    def __fixture_path(self, name):
+        return os.path.join(BENCH_DIR, re.sub('[^\w\-.]', '_', name) + '.json')
+
+    def __get_videos(self):
+        try:
+            with open(os.path.join(BENCH_DIR, VIDEOS_FILE), 'r') as f:
+                return [dict((str(k), v) for k, v in video.iteritems()) for video in json.load(f)]
+        except (IOError, ValueError):
+            return DEFAULT_VIDEOS
+
+    def __write_report(self):
+        header = ['Scraper', 'Type', 'Call', 'Wall(s)', 'CPU(s)', 'Bytes', 'Regex', 'DOM', 'Reqs', 'Misses', 'RSS+(KB)', 'Results', 'Error']
+        lines = ['Scraper Benchmark (%s) - %s' % ('record' if self.record else 'replay', time.strftime('%Y-%m-%d %H:%M:%S')), '\t'.join(header)]
+        totals = [0, 0, 0, 0, 0]
+        for row in self.rows:
+            name, video_type, call, wall, cpu, size, regex, dom, requests, misses, rss, results, error = row
+            totals = [totals[0] + wall, totals[1] + cpu, totals[2] + size, totals[3] + regex, totals[4] + dom]
+            rss = '' if rss is None else rss
+            lines.append('\t'.join(str(item) for item in [name, video_type, call, '%.3f' % (wall), '%.3f' % (cpu), size, regex, dom, requests, misses, rss, results, error]))
+        lines.append('Total: Wall: %.3fs CPU: %.3fs Bytes: %s Regex: %s DOM: %s' % tuple(totals))
+
+        report = '\n'.join(lines)
+        log_utils.log(report, log_utils.LOGNOTICE)
+        report_path = os.path.join(BENCH_DIR, REPORT_FILE)
+        with open(report_path, 'w') as f:
+            f.write(report.encode('utf-8') if isinstance(report, unicode) else report)
+        return report_path
+
+def run(record=False):
+    """
+    Record fixtures (record=True, hits the live sites) or replay them offline; returns the path of the report
+    """
+    return Bench(record).run()
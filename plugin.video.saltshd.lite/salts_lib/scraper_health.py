@@ -0,0 +1,156 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import time
+import log_utils
+from db_utils import get_db_connection
+
+MAX_SAMPLES = 50
+MIN_SAMPLES = 5
+DEADLINE_FACTOR = 1.5
+MIN_DEADLINE = 5  # seconds
+MIN_HIT_RATE = .1
+BREAKER_FAILS = 5
+BREAKER_COOLDOWN = 30 * 60  # seconds
+MAX_COOLDOWN = 24 * 60 * 60  # seconds
+
+class ScraperHealth(object):
+    """
+    Recent get_sources history for one scraper: how long successful runs took, how many hosters each run returned
+    (-1 for a timeout/error) and a circuit breaker that opens after BREAKER_FAILS failures in a row
+    """
+    def __init__(self, name, stats=None):
+        if stats is None: stats = {}
+        self.name = name
+        self.times = stats.get('times', [])
+        self.results = stats.get('results', [])
+        self.fails = stats.get('fails', 0)
+        self.open_until = stats.get('open_until', 0)
+        self.cooldown = stats.get('cooldown', BREAKER_COOLDOWN)
+        self.dirty = False
+
+    def percentile(self, percent):
+        if not self.times: return None
+        times = sorted(self.times)
+        return times[min(len(times) - 1, int(len(times) * percent / 100.0))]
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p95(self):
+        return self.percentile(95)
+
+    @property
+    def hit_rate(self):
+        if not self.results: return None
+        return len([result for result in self.results if result > 0]) / float(len(self.results))
+
+    @property
+    def avg_hosters(self):
+        results = [result for result in self.results if result >= 0]
+        if not results: return None
+        return sum(results) / float(len(results))
+
+    def is_open(self, now=None):
+        if now is None: now = time.time()
+        return self.open_until > now
+
+    def deadline(self, max_timeout):
+        """
+        How long to wait for this scraper; max_timeout until there's enough history, then p95 with some slack (never more than max_timeout)
+        """
+        if not max_timeout or len(self.times) < MIN_SAMPLES:
+            return max_timeout
+        return min(max_timeout, max(MIN_DEADLINE, self.p95 * DEADLINE_FACTOR))
+
+    def rank(self):
+        # lower starts sooner: typical latency scaled up for scrapers that rarely find anything; unknown scrapers go first to build history
+        if not self.times or self.hit_rate is None:
+            return 0
+        return self.p50 / max(self.hit_rate, MIN_HIT_RATE)
+
+    def record_success(self, duration, hosters):
+        self.times = (self.times + [round(duration, 3)])[-MAX_SAMPLES:]
+        self.results = (self.results + [hosters])[-MAX_SAMPLES:]
+        self.fails = 0
+        self.open_until = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.dirty = True
+
+    def record_failure(self):
+        self.results = (self.results + [-1])[-MAX_SAMPLES:]
+        self.fails += 1
+        if self.fails >= BREAKER_FAILS:
+            # a failed trial run after the cooldown re-opens the breaker for twice as long
+            self.open_until = time.time() + self.cooldown
+            log_utils.log('Circuit breaker opened for %s for %ss after %s failures' % (self.name, self.cooldown, self.fails), log_utils.LOGDEBUG)
+            self.cooldown = min(self.cooldown * 2, MAX_COOLDOWN)
+        self.dirty = True
+
+    def reset(self):
+        self.__init__(self.name)
+        self.dirty = True
+
+    def to_dict(self):
+        return {'times': self.times, 'results': self.results, 'fails': self.fails, 'open_until': self.open_until, 'cooldown': self.cooldown}
+
+    def __str__(self):
+        if not self.times and not self.results:
+            return 'N/A'
+        p50 = '%.1fs' % (self.p50) if self.p50 is not None else '-'
+        p95 = '%.1fs' % (self.p95) if self.p95 is not None else '-'
+        hosters = '%.1f' % (self.avg_hosters) if self.avg_hosters is not None else '-'
+        label = 'p50: %s p95: %s Hits: %d%% Hosters: %s' % (p50, p95, self.hit_rate * 100, hosters)
+        if self.is_open():
+            label += ' (Off until %s)' % (time.strftime('%H:%M', time.localtime(self.open_until)))
+        return label
+
+class Scoreboard(object):
+    """
+    Health of every scraper, loaded from the db in one query
+    """
+    def __init__(self):
+        stats = get_db_connection().get_scraper_stats()
+        self.__health = {}
+        for name in stats:
+            try: self.__health[name] = ScraperHealth(name, json.loads(stats[name]))
+            except ValueError: pass
+
+    def get(self, name):
+        if name not in self.__health:
+            self.__health[name] = ScraperHealth(name)
+        return self.__health[name]
+
+    def order(self, scrapers):
+        """
+        Drop scrapers whose circuit breaker is open and put the rest in dispatch order
+        """
+        now = time.time()
+        skipped = [cls.get_name() for cls in scrapers if self.get(cls.get_name()).is_open(now)]
+        if skipped:
+            log_utils.log('Skipping scrapers with open circuit breakers: %s' % (skipped), log_utils.LOGDEBUG)
+        return sorted([cls for cls in scrapers if cls.get_name() not in skipped], key=lambda cls: self.get(cls.get_name()).rank())
+
+    def save(self):
+        db_connection = get_db_connection()
+        for health in self.__health.itervalues():
+            if health.dirty:
+                db_connection.set_scraper_stats(health.name, json.dumps(health.to_dict()))
+                health.dirty = False
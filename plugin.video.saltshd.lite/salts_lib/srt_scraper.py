@@ -24,10 +24,11 @@ import socket
 import xbmcvfs
 import log_utils
 import kodi
+import catalog
 from constants import VIDEO_TYPES
 from constants import SRT_SOURCE
 from constants import USER_AGENT
-from db_utils import DB_Connection
+from db_utils import get_db_connection
 
 MAX_RETRIES = 2
 TEMP_ERRORS = [500, 502, 503, 504]
@@ -35,7 +36,7 @@ BASE_URL = 'http://www.addic7ed.com'
 
 class SRT_Scraper():
     def __init__(self):
-        self.db_connection = DB_Connection()
+        self.db_connection = get_db_connection()
 
     def get_tvshow_id(self, title, year=None):
         match_title = title.lower()
@@ -45,27 +46,14 @@ class SRT_Scraper():
             log_utils.log('Returning local tvshow id: |%s|%s|%s|' % (title, year, tvshow_id), log_utils.LOGDEBUG)
             return tvshow_id
 
-        html = self.__get_cached_url(BASE_URL, 24)
-        regex = re.compile('option\s+value="(\d+)"\s*>(.*?)</option')
+        show_list = catalog.get_catalog(self.db_connection, SRT_SOURCE, BASE_URL, lambda: self.__get_cached_url(BASE_URL, 24), self.__parse_shows, 24)
         site_matches = []
-        for item in regex.finditer(html):
-            tvshow_id, site_title = item.groups()
-
-            # strip year off title and assign it to year if it exists
-            r = re.search('(\s*\((\d{4})\))$', site_title)
-            if r:
-                site_title = site_title.replace(r.group(1), '')
-                site_year = r.group(2)
-            else:
-                site_year = None
-
-            # print 'show: |%s|%s|%s|' % (tvshow_id, site_title, site_year)
-            if match_title == site_title.lower():
-                if year is None or year == site_year:
-                    self.db_connection.set_related_url(VIDEO_TYPES.TVSHOW, title, year, SRT_SOURCE, tvshow_id)
-                    return tvshow_id
+        for tvshow_id, site_title, site_year in show_list.find(match_title):
+            if year is None or year == site_year:
+                self.db_connection.set_related_url(VIDEO_TYPES.TVSHOW, title, year, SRT_SOURCE, tvshow_id)
+                return tvshow_id
 
-                site_matches.append((tvshow_id, site_title, site_year))
+            site_matches.append((tvshow_id, site_title, site_year))
 
         if not site_matches:
             return None
@@ -80,6 +68,20 @@ class SRT_Scraper():
                     self.db_connection.set_related_url(VIDEO_TYPES.TVSHOW, title, year, SRT_SOURCE, match[0])
                     return match[0]
 
+    def __parse_shows(self, html):
+        regex = re.compile('option\s+value="(\d+)"\s*>(.*?)</option')
+        for item in regex.finditer(html):
+            tvshow_id, site_title = item.groups()
+
+            # strip year off title and assign it to year if it exists
+            r = re.search('(\s*\((\d{4})\))$', site_title)
+            if r:
+                site_title = site_title.replace(r.group(1), '')
+                site_year = r.group(2)
+            else:
+                site_year = None
+            yield tvshow_id, site_title, site_year
+
     def get_season_subtitles(self, language, tvshow_id, season):
         url = BASE_URL + '/ajax_loadShow.php?show=%s&season=%s&langs=&hd=%s&hi=%s' % (tvshow_id, season, 0, 0)
         html = self.__get_cached_url(url, .25)
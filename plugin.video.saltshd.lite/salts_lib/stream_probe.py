@@ -0,0 +1,151 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from Queue import Queue, Empty
+import log_utils
+
+PROBE_TIMEOUT = 2
+MAX_PROBES = 8
+HOST_LIMIT = 2
+AUTOPLAY_PROBES = 20
+PROBE_KEYS = ('reachable', 'ttfb')
+
+__host_sems = {}
+__host_sems_lock = threading.Lock()
+
+def __host_semaphore(host):
+    # shared by every probe in the process so that concurrent scrapers don't pile onto one cdn
+    with __host_sems_lock:
+        if host not in __host_sems:
+            __host_sems[host] = threading.Semaphore(HOST_LIMIT)
+        return __host_sems[host]
+
+def get_headers(url):
+    # parse_qsl doesn't work because it splits elements by ';' which can be in a non-quoted UA
+    try:
+        headers = dict([item.split('=', 1) for item in (url.split('|')[1]).split('&')])
+        for key in headers: headers[key] = urllib.unquote(headers[key])
+    except:
+        headers = {}
+    return headers
+
+def probe_stream(hoster, timeout=PROBE_TIMEOUT):
+    """
+    Request the first byte of a direct stream. Sets hoster['reachable'] and hoster['ttfb'] (seconds until the response
+    headers arrived; None when the url isn't http) and returns reachable
+    """
+    url = hoster['url'].split('|')[0]
+    parts = urlparse.urlparse(url)
+    if parts.scheme.lower() not in ('http', 'https'):
+        # treat an unhandled url type as success
+        hoster['reachable'], hoster['ttfb'] = True, None
+        return True
+
+    headers = get_headers(hoster['url'])
+    if not any(key.lower() == 'range' for key in headers):
+        headers['Range'] = 'bytes=0-0'
+    log_utils.log('Probing Stream: %s from %s using Headers: %s' % (hoster['url'], hoster['class'].get_name(), headers), log_utils.LOGDEBUG)
+    request = urllib2.Request(url, headers=headers)
+    opener = urllib2.build_opener(urllib2.HTTPRedirectHandler)
+
+    msg = ''
+    with __host_semaphore(parts.hostname):
+        start = time.time()
+        try:
+            response = opener.open(request, timeout=timeout)
+            http_code = response.getcode()
+            response.close()
+        except urllib2.HTTPError as e:
+            http_code = e.code
+            msg = str(e)
+        except Exception as e:
+            http_code = 600
+            msg = '(%s) %s' % (type(e).__name__, e)
+        ttfb = time.time() - start
+
+    # 416: the server understood the range request, so the stream is there
+    reachable = http_code < 400 or http_code == 416
+    if not reachable:
+        log_utils.log('Probe Failed: Url: %s HTTP Code: %s Msg: %s' % (hoster['url'], http_code, msg), log_utils.LOGDEBUG)
+    hoster['reachable'], hoster['ttfb'] = reachable, ttfb
+    return reachable
+
+def probe_streams(hosters, timeout=PROBE_TIMEOUT, max_probes=MAX_PROBES):
+    """
+    Probe every hoster in hosters, max_probes at a time (and at most HOST_LIMIT per host across all probes)
+    """
+    q = Queue()
+    for hoster in hosters: q.put(hoster)
+
+    def worker():
+        while True:
+            try: hoster = q.get_nowait()
+            except Empty: return
+            try: probe_stream(hoster, timeout)
+            except Exception as e: log_utils.log('Probe of %s failed: (%s) %s' % (hoster['url'], type(e).__name__, e), log_utils.LOGWARNING)
+
+    if q.qsize() <= 1:
+        worker()
+        return
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(max_probes, q.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def filter_reachable(hosters):
+    """
+    Drop direct hosters whose stream doesn't answer
+    """
+    probe_streams([hoster for hoster in hosters if hoster['direct']])
+    return [hoster for hoster in hosters if not hoster['direct'] or hoster['reachable']]
+
+def speed_key(hoster):
+    # unprobed hosters sort after any probed one
+    ttfb = hoster.get('ttfb')
+    return ttfb if ttfb is not None else PROBE_TIMEOUT
+
+def order_for_autoplay(hosters, sort_key=None):
+    """
+    Returns hosters in the order autoplay should try them: the first AUTOPLAY_PROBES direct streams are probed
+    (if they haven't been already) and streams that didn't answer go last. sort_key is the function from
+    utils2.make_sort_key that hosters is sorted by; hosters whose whole sort key is equal are put fastest first.
+    Otherwise the existing order is kept
+    """
+    candidates = [hoster for hoster in hosters if not hoster['multi-part']][:AUTOPLAY_PROBES]
+    probe_streams([hoster for hoster in candidates if hoster['direct'] and 'reachable' not in hoster])
+
+    keys = []
+    run = 0
+    prev_key = None
+    for i, hoster in enumerate(hosters):
+        if sort_key is None:
+            run = i
+        else:
+            key = sort_key(hoster)
+            if i > 0 and key != prev_key:
+                run += 1
+            prev_key = key
+        keys.append((not hoster.get('reachable', True), run, speed_key(hoster), i))
+    return [hosters[key[-1]] for key in sorted(keys)]
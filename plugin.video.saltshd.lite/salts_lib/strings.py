@@ -286,5 +286,7 @@ STRINGS = {
     'last_watched_method': 30276,
     'set_rewatch_list': 30277,
     'playback_limited': 30278,
-    'size_limit': 30279
+    'size_limit': 30279,
+    'bench_complete': 30281,
+    'download_queued': 30282
 }
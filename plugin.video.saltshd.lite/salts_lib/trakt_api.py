@@ -20,11 +20,13 @@ import urllib2
 import urllib
 import socket
 import ssl
+import threading
 import time
+from Queue import Queue, Empty
 import kodi
 import log_utils
 import utils2
-from db_utils import DB_Connection
+from db_utils import get_db_connection, close_db_connections
 from constants import TRAKT_SECTIONS
 from constants import TEMP_ERRORS
 from constants import SECTIONS
@@ -47,6 +49,12 @@ CLIENT_SECRET = '96611f3e712a37bd8d3cac9316c4643e0e5fd0a0c02b4eaf4bba8fd57024c72
 REDIRECT_URI = 'urn:ietf:wg:oauth:2.0:oob'
 RESULTS_LIMIT = 10
 HIDDEN_SIZE = 100
+HISTORY_SIZE = 100
+PAGE_WORKERS = 4
+LAST_ACTIVITY_LIMIT = 2 * 60  # seconds
+MIRROR_LIMIT = 7 * 24 * 60 * 60  # seconds
+PROGRESS_LIMIT = 5 * 60  # seconds; a newly aired episode changes progress without touching last_activities
+MIRROR_NAME = 'trakt_mirror'
 
 class Trakt_API():
     def __init__(self, token=None, use_https=False, list_size=RESULTS_LIMIT, timeout=5, offline=False):
@@ -55,6 +63,8 @@ class Trakt_API():
         self.timeout = None if timeout == 0 else timeout
         self.list_size = list_size
         self.offline = offline
+        self.__activities = None
+        self.__next_page = None
 
     def get_code(self):
         url = '/oauth/device/code'
@@ -89,12 +99,16 @@ class Trakt_API():
         list_data = self.__call_trakt(url, params=params, auth=auth, cache_limit=cache_limit, cached=cached)
         return [item[item['type']] for item in list_data if item['type'] == TRAKT_SECTIONS[section][:-1]]
 
-    def show_watchlist(self, section):
+    def show_watchlist(self, section, cached=True):
         url = '/users/me/watchlist/%s' % (TRAKT_SECTIONS[section])
         params = {'extended': 'full,images'}
-        cache_limit = self.__get_cache_limit('lists', 'updated_at', cached=True)
-        response = self.__call_trakt(url, params=params, cache_limit=cache_limit)
-        return [item[TRAKT_SECTIONS[section][:-1]] for item in response]
+
+        def fetch():
+            response = self.__call_trakt(url, params=params, cached=False)
+            return [item[TRAKT_SECTIONS[section][:-1]] for item in response]
+        
+        name = 'watchlist-%s' % (section)
+        return self.__get_mirror(name, [(TRAKT_SECTIONS[section], 'watchlisted_at')], fetch, cached=cached)
 
     def get_list_header(self, slug, username=None, auth=True):
         if not username: username = 'me'
@@ -115,7 +129,7 @@ class Trakt_API():
         params = {'limit': self.list_size}
         if page: params['page'] = page
         cache_limit = self.__get_cache_limit('lists', 'liked_at', cached=cached)
-        return self.__call_trakt(url, params=params, cache_limit=cache_limit, cached=cached)
+        return self.__call_trakt_page(url, params=params, cache_limit=cache_limit, cached=cached)
 
     def add_to_list(self, section, slug, items):
         return self.__manage_list('add', section, slug, items)
@@ -145,27 +159,27 @@ class Trakt_API():
         url = '/%s/trending' % (TRAKT_SECTIONS[section])
         params = {'extended': 'full,images', 'limit': 69}
         if page: params['page'] = page
-        response = self.__call_trakt(url, params=params)
+        response = self.__call_trakt_page(url, params=params)
         return [item[TRAKT_SECTIONS[section][:-1]] for item in response]
 
     def get_anticipated(self, section, page=None):
         url = '/%s/anticipated' % (TRAKT_SECTIONS[section])
         params = {'extended': 'full,images', 'limit': 69}
         if page: params['page'] = page
-        response = self.__call_trakt(url, params=params)
+        response = self.__call_trakt_page(url, params=params)
         return [item[TRAKT_SECTIONS[section][:-1]] for item in response]
 
     def get_popular(self, section, page=None):
         url = '/%s/popular' % (TRAKT_SECTIONS[section])
         params = {'extended': 'full,images', 'limit': 69}
         if page: params['page'] = page
-        return self.__call_trakt(url, params=params)
+        return self.__call_trakt_page(url, params=params)
 
     def get_recent(self, section, date, page=None):
         url = '/%s/updates/%s' % (TRAKT_SECTIONS[section], date)
         params = {'extended': 'full,images', 'limit': 69}
         if page: params['page'] = page
-        response = self.__call_trakt(url, params=params)
+        response = self.__call_trakt_page(url, params=params)
         return [item[TRAKT_SECTIONS[section][:-1]] for item in response]
 
     def get_most_played(self, section, period, page=None):
@@ -181,7 +195,7 @@ class Trakt_API():
         url = '/%s/%s/%s' % (TRAKT_SECTIONS[section], category, period)
         params = {'extended': 'full,images', 'limit': self.list_size}
         if page: params['page'] = page
-        response = self.__call_trakt(url, params=params)
+        response = self.__call_trakt_page(url, params=params)
         return [item[TRAKT_SECTIONS[section][:-1]] for item in response]
     
     def get_genres(self, section):
@@ -214,10 +228,16 @@ class Trakt_API():
         params = {'extended': 'full,images', 'auth': True}
         return self.__call_trakt(url, params=params, auth=True, cache_limit=24, cached=cached)
 
-    def get_seasons(self, show_id):
+    def get_seasons(self, show_id, episodes=False):
         url = '/shows/%s/seasons' % (show_id)
-        params = {'extended': 'full,images'}
-        return self.__call_trakt(url, params=params, cache_limit=12)
+        if episodes:
+            # every season with its full episode list in a single call
+            params = {'extended': 'full,episodes'}
+            cache_limit = 1
+        else:
+            params = {'extended': 'full,images'}
+            cache_limit = 12
+        return self.__call_trakt(url, params=params, cache_limit=cache_limit)
 
     def get_episodes(self, show_id, season):
         url = '/shows/%s/seasons/%s' % (show_id, season)
@@ -252,22 +272,26 @@ class Trakt_API():
         params = {'type': TRAKT_SECTIONS[section][:-1], 'query': query, 'limit': self.list_size}
         if page: params['page'] = page
         # params.update({'extended': 'full,images'})
-        response = self.__call_trakt(url, params=params)
+        response = self.__call_trakt_page(url, params=params)
         return [item[TRAKT_SECTIONS[section][:-1]] for item in response]
 
     def get_collection(self, section, full=True, cached=True):
         url = '/users/me/collection/%s' % (TRAKT_SECTIONS[section])
         params = {'extended': 'full,images'} if full else None
         media = 'movies' if section == SECTIONS.MOVIES else 'episodes'
-        cache_limit = self.__get_cache_limit(media, 'collected_at', cached)
-        response = self.__call_trakt(url, params=params, cache_limit=cache_limit, cached=cached)
-        result = []
-        for item in response:
-            element = item[TRAKT_SECTIONS[section][:-1]]
-            if section == SECTIONS.TV:
-                element['seasons'] = item['seasons']
-            result.append(element)
-        return result
+
+        def fetch():
+            response = self.__call_trakt(url, params=params, cached=False)
+            result = []
+            for item in response:
+                element = item[TRAKT_SECTIONS[section][:-1]]
+                if section == SECTIONS.TV:
+                    element['seasons'] = item['seasons']
+                result.append(element)
+            return result
+
+        name = 'collection-%s-%s' % (section, full)
+        return self.__get_mirror(name, [(media, 'collected_at')], fetch, cached=cached)
 
     def get_watched(self, section, full=False, noseasons=False, cached=True):
         url = '/sync/watched/%s' % (TRAKT_SECTIONS[section])
@@ -277,8 +301,15 @@ class Trakt_API():
         elif noseasons:
             params['extended'] = 'noseasons'
         media = 'movies' if section == SECTIONS.MOVIES else 'episodes'
-        cache_limit = self.__get_cache_limit(media, 'watched_at', cached)
-        return self.__call_trakt(url, params=params, cache_limit=cache_limit, cached=cached)
+
+        def fetch():
+            return self.__call_trakt(url, params=params, cached=False)
+
+        def delta(last_activity, watched):
+            return self.__apply_history(section, full, noseasons, last_activity[0], watched)
+
+        name = 'watched-%s-%s' % (section, params.get('extended', ''))
+        return self.__get_mirror(name, [(media, 'watched_at')], fetch, delta, cached=cached)
 
     def get_history(self, section, full=False, page=None, cached=True):
         url = '/users/me/history/%s' % (TRAKT_SECTIONS[section])
@@ -287,29 +318,28 @@ class Trakt_API():
         if page: params['page'] = page
         media = 'movies' if section == SECTIONS.MOVIES else 'episodes'
         cache_limit = self.__get_cache_limit(media, 'watched_at', cached)
-        return self.__call_trakt(url, params=params, cache_limit=cache_limit, cached=cached)
+        return self.__call_trakt_page(url, params=params, cache_limit=cache_limit, cached=cached)
 
     def get_show_progress(self, show_id, full=False, hidden=False, specials=False, cached=True, cache_limit=None):
-        if cache_limit is None:
-            cache_limit = self.__get_cache_limit('episodes', 'watched_at', cached)
+        if cache_limit is None: cache_limit = PROGRESS_LIMIT / 60.0 / 60
         url = '/shows/%s/progress/watched' % (show_id)
         params = {}
         if full: params['extended'] = 'full,images'
         if hidden: params['hidden'] = 'true'
         if specials: params['specials'] = 'true'
-        return self.__call_trakt(url, params=params, cache_limit=cache_limit, cached=cached)
+        
+        def fetch():
+            return self.__call_trakt(url, params=params, cached=False)
+
+        activities = [('episodes', 'watched_at')]
+        if hidden: activities.append(('shows', 'hidden_at'))
+        name = 'progress-%s-%s' % (show_id, sorted(params.items()))
+        return self.__get_mirror(name, activities, fetch, cached=cached, cache_limit=cache_limit)
 
     def get_hidden_progress(self, cached=True):
         url = '/users/hidden/progress_watched'
-        params = {'type': 'show', 'limit': HIDDEN_SIZE, 'page': 1}
-        length = -1
-        result = []
-        while length != 0 or length == HIDDEN_SIZE:
-            hidden = self.__call_trakt(url, params=params, cached=cached)
-            length = len(hidden)
-            result += hidden
-            params['page'] += 1
-        return result
+        params = {'type': 'show', 'limit': HIDDEN_SIZE}
+        return self.__get_all_pages(url, params, cached=cached)
     
     def get_user_profile(self, username=None, cached=True):
         if username is None: username = 'me'
@@ -358,8 +388,11 @@ class Trakt_API():
         self.__call_trakt(url, data=data, cache_limit=0)
 
     def get_last_activity(self, media=None, activity=None):
-        url = '/sync/last_activities'
-        result = self.__call_trakt(url, cache_limit=.01)
+        # kept on the instance for LAST_ACTIVITY_LIMIT; writes made through this instance reset it sooner
+        if self.__activities is None or time.time() - self.__activities[0] > LAST_ACTIVITY_LIMIT:
+            url = '/sync/last_activities'
+            self.__activities = (time.time(), self.__call_trakt(url, cache_limit=LAST_ACTIVITY_LIMIT / 60.0 / 60))
+        result = self.__activities[1]
         if media is not None and media in result:
             if activity is not None and activity in result[media]:
                 return result[media][activity]
@@ -368,6 +401,180 @@ class Trakt_API():
         
         return result
     
+    def __reset_last_activity(self):
+        self.__activities = None
+        url = '%s%s%s' % (self.protocol, BASE_URL, '/sync/last_activities')
+        get_db_connection().delete_cached_url(url)
+
+    def __get_mirror(self, name, activities, fetch, delta=None, cached=True, cache_limit=None):
+        """
+        Local copy of a trakt sync payload kept in the function cache along with the last_activities timestamps it reflects.
+        While those are unchanged the copy is returned as-is; otherwise delta (if given) brings it up to date or it's fetched again
+        """
+        db_connection = get_db_connection()
+        max_age = MIRROR_LIMIT if cache_limit is None else cache_limit * 60 * 60
+        mirror = None
+        if cached:
+            in_cache, mirror = db_connection.get_cached_function(MIRROR_NAME, [name], cache_limit=max_age)
+            if in_cache and self.offline:
+                return mirror[1]
+
+        activity = None
+        if not self.offline:
+            activity = tuple(self.get_last_activity(media, key) for media, key in activities)
+            if not all(isinstance(stamp, basestring) for stamp in activity):
+                activity = None
+
+        if mirror and activity is not None:
+            last_activity, result = mirror
+            if last_activity == activity:
+                log_utils.log('Trakt Mirror Hit: %s (%s)' % (name, activity), log_utils.LOGDEBUG)
+                return result
+
+            if delta is not None:
+                result = delta(last_activity, result)
+                if result is not None:
+                    log_utils.log('Trakt Mirror Delta: %s (%s -> %s)' % (name, last_activity, activity), log_utils.LOGDEBUG)
+                    db_connection.cache_function(MIRROR_NAME, [name], result=(activity, result))
+                    return result
+
+        result = fetch()
+        if activity is not None:
+            db_connection.cache_function(MIRROR_NAME, [name], result=(activity, result))
+        return result
+
+    def __apply_history(self, section, full, noseasons, since, watched):
+        """
+        Add the plays recorded since the watched list was mirrored to it. Returns None (full refresh needed) if there are too many
+        or none at all (the activity was a history removal)
+        """
+        url = '/sync/history/%s' % (TRAKT_SECTIONS[section])
+        params = {'start_at': since, 'limit': HISTORY_SIZE}
+        if full: params['extended'] = 'full,images'
+        history = self.__call_trakt(url, params=params, cached=False)
+        since = utils2.iso_2_utc(since)
+        history = [item for item in history if utils2.iso_2_utc(item['watched_at']) > since]
+        if not history or len(history) >= HISTORY_SIZE:
+            return None
+        
+        key = 'movie' if section == SECTIONS.MOVIES else 'show'
+        items = dict((item[key]['ids']['trakt'], item) for item in watched)
+        for play in sorted(history, key=lambda x: x['watched_at']):
+            media = play[key]
+            item = items.get(media['ids']['trakt'])
+            if item is None:
+                item = {key: media, 'plays': 0, 'last_watched_at': None}
+                if section == SECTIONS.TV and not noseasons:
+                    item['seasons'] = []
+                items[media['ids']['trakt']] = item
+                watched.append(item)
+            item['plays'] += 1
+            item['last_watched_at'] = max(item['last_watched_at'], play['watched_at'])
+
+            if 'seasons' in item:
+                episode = play['episode']
+                season = [s for s in item['seasons'] if s['number'] == episode['season']]
+                if season:
+                    season = season[0]
+                else:
+                    season = {'number': episode['season'], 'episodes': []}
+                    item['seasons'].append(season)
+                
+                ep = [e for e in season['episodes'] if e['number'] == episode['number']]
+                if ep:
+                    ep = ep[0]
+                else:
+                    ep = {'number': episode['number'], 'plays': 0, 'last_watched_at': None}
+                    season['episodes'].append(ep)
+                ep['plays'] += 1
+                ep['last_watched_at'] = max(ep['last_watched_at'], play['watched_at'])
+        return watched
+
+    def prefetch_next_page(self):
+        """
+        Warm the cache with the page after the last paged list fetched. Meant to be called once the current page has been
+        rendered; the fetch runs in a non-daemon thread so it finishes even after the plugin returns
+        """
+        if self.__next_page is None or kodi.get_setting('prefetch_pages') != 'true':
+            return
+
+        url, params, cache_limit, cached = self.__next_page
+        self.__next_page = None
+        worker = threading.Thread(target=self.__prefetch, args=(url, params, cache_limit, cached))
+        worker.start()
+
+    def __prefetch(self, url, params, cache_limit, cached):
+        try:
+            log_utils.log('Prefetching Trakt Page: %s (%s)' % (url, params), log_utils.LOGDEBUG)
+            self.__call_trakt(url, params=params, cache_limit=cache_limit, cached=cached)
+        except Exception as e:
+            log_utils.log('Trakt Prefetch Failed: %s (%s): %s' % (url, params, e), log_utils.LOGDEBUG)
+        finally:
+            # usually runs after the plugin call has closed its connections; write out and close ours
+            close_db_connections()
+
+    def __call_trakt_page(self, url, params, cache_limit=.25, cached=True):
+        """
+        Fetch one page of a paged list and remember the next one (if trakt says there is one) for prefetch_next_page
+        """
+        response, res_headers = self.__call_trakt(url, params=params, cache_limit=cache_limit, cached=cached, with_headers=True)
+        try:
+            page = int(res_headers.get('x-pagination-page', params.get('page', 1)))
+            page_count = int(res_headers.get('x-pagination-page-count', 0))
+        except ValueError:
+            page = page_count = 0
+
+        if page < page_count:
+            next_params = dict(params)
+            next_params['page'] = page + 1
+            self.__next_page = (url, next_params, cache_limit, True)
+        else:
+            self.__next_page = None
+        return response
+
+    def __get_all_pages(self, url, params, cached=True):
+        """
+        Fetch every page of a paged list; the first page says how many there are and the rest are fetched at most PAGE_WORKERS at a time
+        """
+        params = dict(params)
+        params['page'] = 1
+        result, res_headers = self.__call_trakt(url, params=params, cached=cached, with_headers=True)
+        try: page_count = int(res_headers['x-pagination-page-count'])
+        except (KeyError, ValueError): page_count = None
+
+        # no pagination info (e.g. an old cached response); walk pages until one comes back short
+        if page_count is None:
+            page = result
+            while len(page) >= params.get('limit', 0) > 0:
+                params['page'] += 1
+                page = self.__call_trakt(url, params=params, cached=cached)
+                result += page
+            return result
+
+        pages = {1: result}
+        errors = []
+        q = Queue()
+        for page in xrange(2, page_count + 1):
+            q.put(page)
+
+        def fetch_pages():
+            while True:
+                try: page = q.get_nowait()
+                except Empty: return
+                page_params = dict(params)
+                page_params['page'] = page
+                try: pages[page] = self.__call_trakt(url, params=page_params, cached=cached)
+                except Exception as e: errors.append(e)
+
+        workers = [threading.Thread(target=fetch_pages) for _ in xrange(min(PAGE_WORKERS, page_count - 1))]
+        for worker in workers: worker.start()
+        for worker in workers: worker.join()
+        if errors:
+            raise errors[0]
+
+        log_utils.log('Fetched %s pages of %s with %s workers' % (page_count, url, len(workers)), log_utils.LOGDEBUG)
+        return [item for page in sorted(pages) for item in pages[page]]
+
     def __get_cache_limit(self, media, activity, cached):
         if cached:
             activity = self.get_last_activity(media, activity)
@@ -417,7 +624,7 @@ class Trakt_API():
             data[TRAKT_SECTIONS[section]].append(ids)
         return data
 
-    def __call_trakt(self, url, method=None, data=None, params=None, auth=True, cache_limit=.25, cached=True):
+    def __call_trakt(self, url, method=None, data=None, params=None, auth=True, cache_limit=.25, cached=True, with_headers=False):
         res_headers = {}
         if not cached: cache_limit = 0
         if self.offline:
@@ -432,7 +639,7 @@ class Trakt_API():
         url = '%s%s%s' % (self.protocol, BASE_URL, url)
         if params: url = url + '?' + urllib.urlencode(params)
 
-        db_connection = DB_Connection()
+        db_connection = get_db_connection()
         created, cached_headers, cached_result = db_connection.get_cached_url(url, json_data, db_cache_limit)
         if cached_result and (self.offline or (time.time() - created) < (60 * 60 * cache_limit)):
             result = cached_result
@@ -455,6 +662,8 @@ class Trakt_API():
                     res_headers = dict(response.info().items())
 
                     db_connection.cache_url(url, result, json_data, response.info().items())
+                    if json_data is not None or method is not None:
+                        self.__reset_last_activity()
                     break
                 except (ssl.SSLError, socket.timeout) as e:
                     if cached_result:
@@ -514,4 +723,6 @@ class Trakt_API():
                 log_utils.log('Invalid JSON Trakt API Response: %s - |%s|' % (url, js_data), log_utils.LOGERROR)
 
         # log_utils.log('Trakt Response: %s' % (response), xbmc.LOGDEBUG)
+        if with_headers:
+            return js_data, res_headers
         return js_data
@@ -25,11 +25,13 @@ import kodi
 import utils2
 from constants import *
 from trakt_api import Trakt_API
-from db_utils import DB_Connection
+from db_utils import get_db_connection
 import threading
+import scraper_health
+from Queue import Queue, Empty
 from scrapers import *  # import all scrapers into this namespace
+from scrapers import get_scrapers, ScraperVideo
 
-_db_connection = None
 last_check = datetime.datetime.fromtimestamp(0)
 TOKEN = kodi.get_setting('trakt_oauth_token')
 use_https = kodi.get_setting('use_https') == 'true'
@@ -40,10 +42,7 @@ trakt_api = Trakt_API(TOKEN, use_https, list_size, trakt_timeout, offline)
 
 # delay db_connection until needed to force db errors during recovery try: block
 def _get_db_connection():
-    global _db_connection
-    if _db_connection is None:
-        _db_connection = DB_Connection()
-    return _db_connection
+    return get_db_connection()
     
 def choose_list(username=None):
     lists = trakt_api.get_lists(username)
@@ -147,10 +146,6 @@ def make_source_sort_key():
 
     return sort_key
 
-def get_source_sort_key(item):
-    sort_key = make_source_sort_key()
-    return -sort_key[item.get_name()]
-
 def parallel_get_progress(q, trakt_id, cached, cache_limit):
     worker = threading.current_thread()
     log_utils.log('Worker: %s (%s) for %s progress' % (worker.name, worker, trakt_id), log_utils.LOGDEBUG)
@@ -247,35 +242,132 @@ def get_bookmark(trakt_id, season, episode):
     return bookmark
 
 def relevant_scrapers(video_type=None, include_disabled=False, order_matters=False):
-    classes = scraper.Scraper.__class__.__subclasses__(scraper.Scraper)
-    classes += proxy.Proxy.__class__.__subclasses__(proxy.Proxy)
+    # manifest entries stand in for the scraper classes; a scraper is only imported once it's instantiated
     relevant = []
-    for cls in classes:
-        if cls.get_name() and not cls.has_proxy() and (video_type is None or video_type in cls.provides()):
+    for cls in get_scrapers():
+        if video_type is None or video_type in cls.provides():
             if include_disabled or utils2.scraper_enabled(cls.get_name()):
                     relevant.append(cls)
 
     if order_matters:
-        relevant.sort(key=get_source_sort_key)
+        sort_key = make_source_sort_key()
+        relevant.sort(key=lambda cls: -sort_key[cls.get_name()])
     return relevant
 
 def url_exists(video):
     """
-    check each source for a url for this video; return True as soon as one is found. If none are found, return False
+    check the sources for a url for this video; return True as soon as one is found. If none are found, return False
+    The scraper that last found one for this show is asked on its own first; if it doesn't have it, every other
+    scraper is asked at once through the worker pool (for up to source_timeout) and whatever is still queued when one
+    finds it is canceled. Called from a pool worker, the scrapers are asked one at a time instead
     """
-    max_timeout = int(kodi.get_setting('source_timeout'))
+    settings = kodi.get_settings()
+    max_timeout = settings.get_int('source_timeout')
     log_utils.log('Checking for Url Existence: |%s|' % (video), log_utils.LOGDEBUG)
-    for cls in relevant_scrapers(video.video_type):
-        if kodi.get_setting('%s-sub_check' % (cls.get_name())) == 'true':
-            scraper_instance = cls(max_timeout)
-            url = scraper_instance.get_url(video)
-            if url:
-                log_utils.log('Found url for |%s| @ %s: %s' % (video, cls.get_name(), url), log_utils.LOGDEBUG)
-                return True
+    scrapers = [cls for cls in relevant_scrapers(video.video_type) if settings.sub_check(cls.get_name())]
+    db_connection = _get_db_connection()
+    _found, winner = db_connection.get_cached_function('url_exists', [video.video_type, video.trakt_id], cache_limit=URL_EXISTS_LIMIT)
+    scrapers.sort(key=lambda cls: cls.get_name() != winner)
+    if utils2.in_worker():
+        # already a pool task (e.g. write_strm from parallel_add_to_library); waiting here on more pool tasks can
+        # deadlock the pool, so the scrapers are asked one at a time on this thread instead
+        for cls in scrapers:
+            if _get_url(cls(max_timeout), video):
+                return _found_url(db_connection, video, cls.get_name())
+    else:
+        if scrapers and scrapers[0].get_name() == winner:
+            cls = scrapers.pop(0)
+            if _get_url(cls(max_timeout), video):
+                return _found_url(db_connection, video, cls.get_name())
+
+        q = Queue()
+        workers = []
+        try:
+            for cls in scrapers:
+                scraper = cls(max_timeout)
+                workers.append(utils2.start_worker(q, _parallel_get_url, [scraper, video], utils2.scraper_host(scraper), cls.get_name()))
+
+            begin = time.time()
+            for _ in workers:
+                timeout = max(0, max_timeout - (time.time() - begin)) if max_timeout > 0 else None
+                try: name, url = q.get(True, timeout)
+                except Empty:
+                    log_utils.log('Url Existence Check Timeouts: %s' % ([worker.name for worker in workers if worker.is_alive()]), log_utils.LOGWARNING)
+                    break
+
+                if url:
+                    return _found_url(db_connection, video, name)
+        finally:
+            utils2.cancel_workers(workers)
 
     log_utils.log('No url found for: |%s|' % (video), log_utils.LOGDEBUG)
     return False
 
+def _found_url(db_connection, video, name):
+    log_utils.log('Found url for |%s| @ %s' % (video, name), log_utils.LOGDEBUG)
+    db_connection.cache_function('url_exists', [video.video_type, video.trakt_id], result=name)
+    return True
+
+def _get_url(scraper, video):
+    try: return scraper.get_url(video)
+    except Exception as e:
+        log_utils.log('%s get_url failed: %s' % (scraper.get_name(), e), log_utils.LOGWARNING)
+
+def _parallel_get_url(q, scraper, video):
+    # always answer, even on failure, since url_exists waits for one result per worker
+    q.put((scraper.get_name(), _get_url(scraper, video)))
+
+def prefetch_next_episode(trakt_id, season, episode):
+    """
+    Fill the source cache for the episode after season/episode of trakt_id in a background thread, so that playing it
+    next doesn't have to wait on the scrapers
+    """
+    thread = threading.Thread(target=_prefetch_next_episode, args=(trakt_id, season, episode), name='prefetch_sources')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _get_next_episode(trakt_id, season, episode):
+    for next_season, next_episode in [(int(season), int(episode) + 1), (int(season) + 1, 1)]:
+        try: episodes = trakt_api.get_episodes(trakt_id, next_season)
+        except Exception as e:
+            log_utils.log('Prefetch: No episodes for %s season %s: %s' % (trakt_id, next_season, e), log_utils.LOGDEBUG)
+            continue
+
+        for item in episodes or []:
+            if item['number'] == next_episode:
+                return item
+
+def _prefetch_next_episode(trakt_id, season, episode):
+    try:
+        item = _get_next_episode(trakt_id, season, episode)
+        if item is None or not item['first_aired'] or utils2.iso_2_utc(item['first_aired']) > time.time():
+            log_utils.log('Prefetch: No aired episode after |%s|%s|%s|' % (trakt_id, season, episode), log_utils.LOGDEBUG)
+            return
+
+        show = trakt_api.get_show_details(trakt_id)
+        # season/episode are strings in the plugin urls get_sources is called with, and they're part of the cache key
+        video = ScraperVideo(VIDEO_TYPES.EPISODE, show['title'], show['year'], trakt_id, str(item['season']), str(item['number']), item['title'],
+                             utils2.make_air_date(item['first_aired']))
+        settings = kodi.get_settings()
+        ttl = settings.get_int('source_cache_ttl') * 60
+        max_timeout = settings.get_int('source_timeout')
+        scrapers = []
+        for cls in scraper_health.Scoreboard().order(relevant_scrapers(VIDEO_TYPES.EPISODE)):
+            hosters, is_stale = utils2.get_cached_sources(video, cls.get_name(), ttl)
+            if hosters is None or is_stale:
+                scrapers.append(cls)
+
+        log_utils.log('Prefetch: Getting sources for %s from %s scrapers' % (video, len(scrapers)), log_utils.LOGDEBUG)
+        # a few scrapers at a time so the prefetch doesn't compete with the stream that's playing
+        for i in xrange(0, len(scrapers), PREFETCH_BATCH):
+            if xbmc.abortRequested: break
+            batch = [cls(max_timeout) for cls in scrapers[i:i + PREFETCH_BATCH]]
+            utils2.revalidate_sources(batch, video, max_timeout or None).join()
+        log_utils.log('Prefetch: Finished %s' % (video), log_utils.LOGDEBUG)
+    except Exception as e:
+        log_utils.log('Prefetch of episode after |%s|%s|%s| failed: %s' % (trakt_id, season, episode, e), log_utils.LOGWARNING)
+
 def do_disable_check():
     auto_disable = kodi.get_setting('auto-disable')
     disable_limit = int(kodi.get_setting('disable-limit'))
@@ -35,6 +35,10 @@ import xbmcgui
 import xbmcplugin
 import kodi
 import pyaes
+import worker_pool
+import stream_probe
+from Queue import Queue, Empty
+from db_utils import get_db_connection, close_db_connections
 from constants import *
 from kodi import i18n
 
@@ -48,13 +52,7 @@ else:
 THEME_PATH = os.path.join(themepak_path, 'art', 'themes', THEME)
 PLACE_POSTER = os.path.join(kodi.get_path(), 'resources', 'place_poster.png')
 
-SORT_FIELDS = [
-    (SORT_LIST[int(kodi.get_setting('sort1_field'))], SORT_SIGNS[kodi.get_setting('sort1_order')]),
-    (SORT_LIST[int(kodi.get_setting('sort2_field'))], SORT_SIGNS[kodi.get_setting('sort2_order')]),
-    (SORT_LIST[int(kodi.get_setting('sort3_field'))], SORT_SIGNS[kodi.get_setting('sort3_order')]),
-    (SORT_LIST[int(kodi.get_setting('sort4_field'))], SORT_SIGNS[kodi.get_setting('sort4_order')]),
-    (SORT_LIST[int(kodi.get_setting('sort5_field'))], SORT_SIGNS[kodi.get_setting('sort5_order')]),
-    (SORT_LIST[int(kodi.get_setting('sort6_field'))], SORT_SIGNS[kodi.get_setting('sort6_order')])]
+SORT_FIELDS = [(SORT_LIST[kodi.get_settings().get_int('sort%s_field' % (i))], SORT_SIGNS[kodi.get_settings().get('sort%s_order' % (i))]) for i in xrange(1, 7)]
 
 def art(name):
     path = os.path.join(THEME_PATH, name)
@@ -308,99 +306,166 @@ def filename_from_title(title, video_type, year=None):
     return filename
 
 def filter_exclusions(hosters):
-    exclusions = kodi.get_setting('excl_list')
+    exclusions = kodi.get_settings().get('excl_list')
     exclusions = exclusions.replace(' ', '')
     exclusions = exclusions.lower()
     if not exclusions: return hosters
     filtered_hosters = []
     for hoster in hosters:
         if hoster['host'].lower() in exclusions:
-            log_utils.log('Excluding %s (%s) from %s' % (hoster['url'], hoster['host'], hoster['class'].get_name()), log_utils.LOGDEBUG)
+            log_utils.log('Excluding %s (%s) from %s', log_utils.LOGDEBUG, hoster['url'], hoster['host'], hoster['class'].get_name())
             continue
         filtered_hosters.append(hoster)
     return filtered_hosters
 
 def filter_quality(video_type, hosters):
-    qual_filter = 5 - int(kodi.get_setting('%s_quality' % video_type))  # subtract to match Q_ORDER
+    qual_filter = 5 - kodi.get_settings().get_int('%s_quality' % video_type)  # subtract to match Q_ORDER
     if qual_filter == 5:
         return hosters
     else:
         return [hoster for hoster in hosters if hoster['quality'] is not None and Q_ORDER[hoster['quality']] <= qual_filter]
 
-def get_sort_key(item):
-    item_sort_key = []
-    for field, sign in SORT_FIELDS:
+def get_early_play_quality():
+    # 0 = Off | 1 = HD1080 | 2 = HD720 | 3 = High; returns the minimum Q_ORDER value or 0 if disabled
+    early_play = kodi.get_settings().get_int('early_play_quality')
+    return EARLY_PLAY_Q[early_play] if early_play < len(EARLY_PLAY_Q) else 0
+
+def make_sort_key(sort_fields=None):
+    """
+    Compile the sort settings into a function that returns a hoster's sort key. The field list, signs and SORT_KEYS
+    lookups are resolved once here, so build it once per sort (after SORT_KEYS['source'] is set), not once per hoster
+    """
+    if sort_fields is None: sort_fields = SORT_FIELDS
+    getters = []
+    for field, sign in sort_fields:
         if field == 'none':
             break
         elif field in SORT_KEYS:
+            # assume all unlisted values sort as worst
+            ranks = dict((value, sign * int(rank)) for value, rank in SORT_KEYS[field].iteritems())
             if field == 'source':
-                value = item['class'].get_name()
+                getters.append(lambda item, ranks=ranks, worst=-sign: ranks.get(item['class'].get_name(), worst))
             else:
-                value = item[field]
-
-            if value in SORT_KEYS[field]:
-                item_sort_key.append(sign * int(SORT_KEYS[field][value]))
-            else:  # assume all unlisted values sort as worst
-                item_sort_key.append(sign * -1)
+                getters.append(lambda item, field=field, ranks=ranks, worst=-sign: ranks.get(item[field], worst))
         elif field == 'debrid':
-            if field in item:
-                item_sort_key.append(sign * bool(item[field]))
-            else:
-                item_sort_key.append(0)
+            getters.append(lambda item, sign=sign: sign * bool(item['debrid']) if 'debrid' in item else 0)
         else:
-            if item[field] is None:
-                item_sort_key.append(sign * -1)
-            else:
-                item_sort_key.append(sign * int(item[field]))
-    # log_utils.log('item: %s sort_key: %s' % (item, item_sort_key), log_utils.LOGDEBUG)
-    return tuple(item_sort_key)
+            getters.append(lambda item, field=field, sign=sign: -sign if item[field] is None else sign * int(item[field]))
+    return lambda item: tuple([getter(item) for getter in getters])
 
 def make_source_sort_string(sort_key):
     sorted_key = sorted(sort_key.items(), key=lambda x: -x[1])
     sort_string = '|'.join([element[0] for element in sorted_key])
     return sort_string
 
-def start_worker(q, func, args):
-    worker = threading.Thread(target=func, args=([q] + args))
-    worker.daemon = True
-    worker.start()
-    return worker
+def start_worker(q, func, args, host=None, name=None):
+    return worker_pool.get_pool().request(q, func, args, host, name)
+
+def in_worker():
+    return worker_pool.in_worker()
+
+def cancel_workers(workers):
+    """
+    Cancel pool workers that haven't started yet; return the canceled workers
+    """
+    return worker_pool.get_pool().cancel(workers)
+
+def scraper_host(scraper):
+    try: host = urlparse.urlparse(scraper.base_url).hostname
+    except: host = None
+    return host if host else scraper.get_name()
 
 def reap_workers(workers, timeout=0):
     """
     Reap thread/process workers; don't block by default; return un-reaped workers
     """
-    log_utils.log('In Reap: %s' % (workers), log_utils.LOGDEBUG)
+    log_utils.log('In Reap: %s', log_utils.LOGDEBUG, workers)
     living_workers = []
     for worker in workers:
         if worker:
-            log_utils.log('Reaping: %s' % (worker.name), log_utils.LOGDEBUG)
+            log_utils.log('Reaping: %s', log_utils.LOGDEBUG, worker.name)
             worker.join(timeout)
             if worker.is_alive():
-                log_utils.log('Worker %s still running' % (worker.name), log_utils.LOGDEBUG)
+                log_utils.log('Worker %s still running', log_utils.LOGDEBUG, worker.name)
                 living_workers.append(worker)
     return living_workers
 
-def parallel_get_sources(q, scraper, video):
+def source_cache_args(video, name):
+    return [video.video_type, video.trakt_id, video.season, video.episode, name]
+
+def get_cached_sources(video, name, ttl):
+    """
+    Returns (hosters, stale) from name's last get_sources for video; stale results (older than ttl seconds) are still
+    returned for up to SOURCE_STALE_LIMIT so they can be shown while they're refreshed. (None, False) if nothing is cached
+    """
+    found, result = get_db_connection().get_cached_function('get_sources', source_cache_args(video, name), cache_limit=max(ttl, SOURCE_STALE_LIMIT))
+    if not found:
+        return None, False
+    
+    created, hosters = result
+    # a stream may have gone down since it was probed, so it has to be probed again rather than trusted
+    for hoster in hosters:
+        for key in stream_probe.PROBE_KEYS: hoster.pop(key, None)
+    return hosters, time.time() - created > ttl
+
+def cache_sources(video, name, hosters):
+    # the scraper instance is re-attached when the hosters are loaded
+    hosters = [dict((key, value) for key, value in hoster.iteritems() if key != 'class') for hoster in hosters]
+    try: get_db_connection().cache_function('get_sources', source_cache_args(video, name), result=(time.time(), hosters))
+    except Exception as e: log_utils.log('Unable to cache %s sources: %s' % (name, e), log_utils.LOGWARNING)
+
+def revalidate_sources(scrapers, video, timeout=None):
+    """
+    Refresh the cached sources of scrapers in a background thread; the thread isn't a daemon so that it survives the
+    end of the plugin call that started it
+    """
+    def revalidate():
+        q = Queue()
+        workers = [start_worker(q, parallel_get_sources, [scraper, video, True], scraper_host(scraper), scraper.get_name()) for scraper in scrapers]
+        try:
+            for _ in workers:
+                q.get(True, timeout)
+        except Empty:
+            log_utils.log('Source revalidation timed out: %s' % ([worker.name for worker in workers if worker.is_alive()]), log_utils.LOGDEBUG)
+        finally:
+            cancel_workers(workers)
+            # the plugin call that started this has usually closed its connections by now; write out and close ours
+            close_db_connections()
+    
+    log_utils.log('Revalidating cached sources for %s: %s' % (video, [scraper.get_name() for scraper in scrapers]), log_utils.LOGDEBUG)
+    thread = threading.Thread(target=revalidate, name='revalidate_sources')
+    thread.start()
+    return thread
+
+def parallel_get_sources(q, scraper, video, cache_results=False):
     worker = threading.current_thread()
-    log_utils.log('********Worker: %s (%s) for %s sources: %s' % (worker.name, worker, scraper.get_name(), video), log_utils.LOGDEBUG)
+    log_utils.log('********Worker: %s (%s) for %s sources: %s', log_utils.LOGDEBUG, worker.name, worker, scraper.get_name(), video)
     start = time.time()
-    hosters = scraper.get_sources(video)
+    try:
+        with log_utils.span('get_sources'):
+            hosters = scraper.get_sources(video)
+    except Exception as e:
+        log_utils.log('%s get_sources failed: (%s) %s' % (scraper.get_name(), type(e).__name__, e), log_utils.LOGWARNING)
+        q.put({'name': scraper.get_name(), 'hosters': [], 'time': time.time() - start, 'error': True})
+        return
+
     if hosters is None: hosters = []
-    if kodi.get_setting('filter_direct') == 'true':
-        hosters = [hoster for hoster in hosters if not hoster['direct'] or test_stream(hoster)]
+    if kodi.get_settings().get_bool('filter_direct'):
+        hosters = stream_probe.filter_reachable(hosters)
     for hoster in hosters:
         if not hoster['direct']:
             hoster['host'] = hoster['host'].lower().strip()
-    log_utils.log('%s returned %s sources from %s in %.2fs' % (scraper.get_name(), len(hosters), worker, time.time() - start), log_utils.LOGDEBUG)
-    result = {'name': scraper.get_name(), 'hosters': hosters}
+    log_utils.log('%s returned %s sources from %s in %.2fs', log_utils.LOGDEBUG, scraper.get_name(), len(hosters), worker, time.time() - start)
+    if cache_results:
+        cache_sources(video, scraper.get_name(), hosters)
+    result = {'name': scraper.get_name(), 'hosters': hosters, 'time': time.time() - start}
     q.put(result)
 
 def parallel_get_url(q, scraper, video):
     worker = threading.current_thread()
-    log_utils.log('Worker: %s (%s) for %s url' % (worker.name, worker, scraper.get_name()), log_utils.LOGDEBUG)
+    log_utils.log('Worker: %s (%s) for %s url', log_utils.LOGDEBUG, worker.name, worker, scraper.get_name())
     url = scraper.get_url(video)
-    log_utils.log('%s returned url %s from %s' % (scraper.get_name(), url, worker), log_utils.LOGDEBUG)
+    log_utils.log('%s returned url %s from %s', log_utils.LOGDEBUG, scraper.get_name(), url, worker)
     if not url: url = ''
     if url == FORCE_NO_MATCH:
         label = '[%s] [COLOR green]%s[/COLOR]' % (scraper.get_name(), i18n('force_no_match'))
@@ -410,45 +475,10 @@ def parallel_get_url(q, scraper, video):
     q.put(related)
 
 def test_stream(hoster):
-    # parse_qsl doesn't work because it splits elements by ';' which can be in a non-quoted UA
-    try:
-        headers = dict([item.split('=') for item in (hoster['url'].split('|')[1]).split('&')])
-        for key in headers: headers[key] = urllib.unquote(headers[key])
-    except:
-        headers = {}
-    log_utils.log('Testing Stream: %s from %s using Headers: %s' % (hoster['url'], hoster['class'].get_name(), headers), xbmc.LOGDEBUG)
-    request = urllib2.Request(hoster['url'].split('|')[0], headers=headers)
-
-    msg = ''
-    opener = urllib2.build_opener(urllib2.HTTPRedirectHandler)
-    urllib2.install_opener(opener)
-    try: http_code = urllib2.urlopen(request, timeout=2).getcode()
-    except urllib2.URLError as e:
-        # treat an unhandled url type as success
-        if hasattr(e, 'reason') and 'unknown url type' in str(e.reason).lower():
-            return True
-        else:
-            if isinstance(e, urllib2.HTTPError):
-                http_code = e.code
-            else:
-                http_code = 600
-        msg = str(e)
-    except Exception as e:
-        if 'unknown url type' in str(e).lower():
-            return True
-        else:
-            log_utils.log('Exception during test_stream: (%s) %s' % (type(e).__name__, e), xbmc.LOGDEBUG)
-            http_code = 601
-        msg = str(e)
-
-    if int(http_code) >= 400:
-        log_utils.log('Test Stream Failed: Url: %s HTTP Code: %s Msg: %s' % (hoster['url'], http_code, msg), xbmc.LOGDEBUG)
-
-    return int(http_code) < 400
+    return stream_probe.probe_stream(hoster)
 
 def scraper_enabled(name):
-    # return true if setting exists and set to true, or setting doesn't exist (i.e. '')
-    return kodi.get_setting('%s-enable' % (name)) in ('true', '')
+    return kodi.get_settings().scraper_enabled(name)
 
 def set_view(content, set_sort=False):
     # set content type so library shows more views and info
@@ -603,70 +633,6 @@ def format_time(seconds):
     else:
         return "%02d:%02d" % (minutes, seconds)
 
-def download_media(url, path, file_name):
-    try:
-        progress = int(kodi.get_setting('down_progress'))
-        active = not progress == PROGRESS.OFF
-        background = progress == PROGRESS.BACKGROUND
-        with kodi.ProgressDialog(kodi.get_name(), i18n('downloading') % (file_name), background=background, active=active) as pd:
-            try:
-                headers = dict([item.split('=') for item in (url.split('|')[1]).split('&')])
-                for key in headers: headers[key] = urllib.unquote(headers[key])
-            except:
-                headers = {}
-            if 'User-Agent' not in headers: headers['User-Agent'] = USER_AGENT
-            request = urllib2.Request(url.split('|')[0], headers=headers)
-            response = urllib2.urlopen(request)
-            if 'Content-Length' in response.info():
-                content_length = int(response.info()['Content-Length'])
-            else:
-                content_length = 0
-    
-            file_name = file_name.replace('.strm', get_extension(url, response))
-            full_path = os.path.join(path, file_name)
-            log_utils.log('Downloading: %s -> %s' % (url, full_path), log_utils.LOGDEBUG)
-    
-            path = xbmc.makeLegalFilename(path)
-            try:
-                try: xbmcvfs.mkdirs(path)
-                except: os.makedirs(path)
-            except Exception as e:
-                log_utils.log('Path Create Failed: %s (%s)' % (e, path), log_utils.LOGDEBUG)
-    
-            if not path.endswith(os.sep): path += os.sep
-            if not xbmcvfs.exists(path):
-                raise Exception(i18n('failed_create_dir'))
-            
-            file_desc = xbmcvfs.File(full_path, 'w')
-            total_len = 0
-            cancel = False
-            while True:
-                data = response.read(CHUNK_SIZE)
-                if not data:
-                    break
-    
-                if pd.is_canceled():
-                    cancel = True
-                    break
-    
-                total_len += len(data)
-                if not file_desc.write(data):
-                    raise Exception(i18n('failed_write_file'))
-    
-                percent_progress = (total_len) * 100 / content_length if content_length > 0 else 0
-                log_utils.log('Position : %s / %s = %s%%' % (total_len, content_length, percent_progress), log_utils.LOGDEBUG)
-                pd.update(percent_progress)
-            
-            file_desc.close()
-
-        if not cancel:
-            kodi.notify(msg=i18n('download_complete') % (file_name), duration=5000)
-            log_utils.log('Download Complete: %s -> %s' % (url, full_path), log_utils.LOGDEBUG)
-
-    except Exception as e:
-        log_utils.log('Error (%s) during download: %s -> %s' % (str(e), url, file_name), log_utils.LOGERROR)
-        kodi.notify(msg=i18n('download_error') % (str(e), file_name), duration=5000)
-
 def get_extension(url, response):
     filename = url2name(url)
     if 'Content-Disposition' in response.info():
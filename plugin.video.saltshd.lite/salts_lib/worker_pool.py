@@ -0,0 +1,157 @@
+"""
+    SALTS XBMC Addon
+    Copyright (C) 2016 tknorris
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+import log_utils
+import kodi
+
+DEFAULT_WORKERS = 16
+DEFAULT_HOST_LIMIT = 4
+
+class Task(object):
+    """
+    A unit of work queued in a WorkerPool. Quacks like a threading.Thread (name, join, is_alive) so that it can be
+    handled by utils2.reap_workers
+    """
+    def __init__(self, q, func, args, host=None, name=None):
+        self.q = q
+        self.func = func
+        self.args = args
+        self.host = host
+        self.name = name if name is not None else func.__name__
+        self.started = False
+        self.started_at = None
+        self.canceled = False
+        self.__done = threading.Event()
+
+    def join(self, timeout=None):
+        self.__done.wait(timeout)
+
+    def is_alive(self):
+        return not self.__done.is_set()
+
+    def run(self):
+        try:
+            self.func(*([self.q] + self.args))
+        except Exception as e:
+            log_utils.log('Worker Task %s failed: (%s) %s' % (self.name, type(e).__name__, e), log_utils.LOGWARNING)
+        finally:
+            self.finish()
+
+    def finish(self):
+        self.__done.set()
+
+    def __repr__(self):
+        return '<Task %s (%s) started: %s canceled: %s>' % (self.name, self.host, self.started, self.canceled)
+
+class WorkerPool(object):
+    """
+    Bounded pool of daemon worker threads. At most max_workers tasks run at once and at most host_limit tasks
+    run against the same host. Workers exit as soon as there is nothing left to run, so an idle pool holds no threads
+    """
+    def __init__(self, max_workers=DEFAULT_WORKERS, host_limit=DEFAULT_HOST_LIMIT):
+        self.max_workers = max(1, max_workers)
+        self.host_limit = host_limit
+        self.__cond = threading.Condition()
+        self.__tasks = []
+        self.__host_counts = {}
+        self.__workers = 0
+        self.__idle = 0
+
+    def request(self, q, func, args, host=None, name=None):
+        task = Task(q, func, args, host, name)
+        with self.__cond:
+            self.__tasks.append(task)
+            if self.__idle == 0 and self.__workers < self.max_workers:
+                self.__workers += 1
+                worker = threading.Thread(target=self.__run)
+                worker.daemon = True
+                worker.pool_worker = True
+                worker.start()
+            self.__cond.notify()
+        return task
+
+    def cancel(self, tasks):
+        """
+        Drop any of tasks that haven't started yet; running tasks are left to finish. Returns the canceled tasks
+        """
+        canceled = []
+        with self.__cond:
+            for task in tasks:
+                if not task.started and not task.canceled and task in self.__tasks:
+                    self.__tasks.remove(task)
+                    task.canceled = True
+                    task.finish()
+                    canceled.append(task)
+        if canceled:
+            log_utils.log('Canceled %s pending worker tasks: %s' % (len(canceled), [task.name for task in canceled]), log_utils.LOGDEBUG)
+        return canceled
+
+    def __next_task(self):
+        for task in self.__tasks:
+            if task.host is None or not self.host_limit or self.__host_counts.get(task.host, 0) < self.host_limit:
+                self.__tasks.remove(task)
+                task.started = True
+                task.started_at = time.time()
+                if task.host is not None:
+                    self.__host_counts[task.host] = self.__host_counts.get(task.host, 0) + 1
+                return task
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                task = self.__next_task()
+                while task is None:
+                    # nothing queued at all; let this worker go
+                    if not self.__tasks:
+                        self.__workers -= 1
+                        return
+
+                    # everything queued is blocked on a host limit; wait for a running task to finish
+                    self.__idle += 1
+                    self.__cond.wait()
+                    self.__idle -= 1
+                    task = self.__next_task()
+
+            task.run()
+            with self.__cond:
+                if task.host is not None:
+                    self.__host_counts[task.host] -= 1
+                self.__cond.notify_all()
+
+__pool = None
+__pool_lock = threading.Lock()
+
+def in_worker():
+    """
+    True if the calling thread is a pool worker, i.e. the caller is itself running as a Task. A task that blocks on
+    other tasks it queued can deadlock the pool (every worker, or the host limit, taken by tasks that are waiting)
+    """
+    return getattr(threading.current_thread(), 'pool_worker', False)
+
+def get_pool():
+    global __pool
+    with __pool_lock:
+        if __pool is None:
+            try: max_workers = int(kodi.get_setting('worker_pool_size'))
+            except: max_workers = DEFAULT_WORKERS
+            try: host_limit = int(kodi.get_setting('worker_host_limit'))
+            except: host_limit = DEFAULT_HOST_LIMIT
+            log_utils.log('Creating Worker Pool: Workers: %s Host Limit: %s' % (max_workers, host_limit), log_utils.LOGDEBUG)
+            __pool = WorkerPool(max_workers, host_limit)
+    return __pool
@@ -165,7 +165,7 @@ class TwoDDL_Scraper(scraper.Scraper):
         return results
 
     def __too_old(self, post):
-        filter_days = datetime.timedelta(days=int(kodi.get_setting('%s-filter' % (self.get_name()))))
+        filter_days = datetime.timedelta(days=kodi.get_settings().filter_days(self.get_name()))
         if filter_days:
             today = datetime.date.today()
             match = re.search('<a[^>]+title="posting time[^"]*">(.*?)\s+(\d+)\s*(\d{2,4})<', post)
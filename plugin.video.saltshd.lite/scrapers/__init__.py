@@ -1,7 +1,10 @@
 import datetime
+import hashlib
+import json
 import os
 import re
 import time
+import xbmc
 
 from salts_lib import kodi
 from salts_lib import log_utils
@@ -9,9 +12,10 @@ from salts_lib import utils2
 from salts_lib.constants import FORCE_NO_MATCH
 from salts_lib.constants import VIDEO_TYPES
 
-__all__ = ['scraper', 
-'proxy', 
-'local_scraper', 
+# only the base classes are imported eagerly; real scrapers are imported on demand through the manifest
+__all__ = ['scraper', 'proxy', 'local_scraper']
+
+SCRAPER_MODULES = ['local_scraper', 
 'pw_scraper', 
 'nitertv_scraper',
            'movieshd_scraper', 
@@ -47,6 +51,9 @@ __all__ = ['scraper',
 		   'dayt_scraper',
            'moviesub_scraper', 
 		   'cloudmovie_scraper']
+MANIFEST_VERSION = 1
+MANIFEST_PATH = os.path.join(kodi.translate_path(kodi.get_profile()), 'scraper_manifest.json')
+LIST_PATH = os.path.join(kodi.translate_path(kodi.get_profile()), 'scraper_list.txt')
 
 from . import *
     
@@ -70,6 +77,133 @@ class ScraperVideo:
     def __str__(self):
         return '|%s|%s|%s|%s|%s|%s|%s|' % (self.video_type, self.title, self.year, self.season, self.episode, self.ep_title, self.ep_airdate)
 
+class LazyScraper(object):
+    """
+    Stands in for a scraper class using its manifest entry so that name/provides/settings checks don't import the scraper.
+    Calling it (or touching anything else on it) imports the real class
+    """
+    def __init__(self, entry):
+        self.__entry = entry
+        self.__cls = None
+
+    def get_name(self):
+        return self.__entry['name']
+
+    def provides(self):
+        return frozenset(self.__entry['provides'])
+
+    def get_settings(self):
+        return list(self.__entry['settings'])
+
+    def has_proxy(self):
+        return False
+
+    def get_class(self):
+        if self.__cls is None:
+            module = __import__('scrapers.%s' % (self.__entry['module']), fromlist=[self.__entry['class']])
+            self.__cls = getattr(module, self.__entry['class'])
+        return self.__cls
+
+    def __call__(self, *args, **kwargs):
+        return self.get_class()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.get_class(), name)
+
+    def __repr__(self):
+        return '<LazyScraper %s (%s.%s)>' % (self.get_name(), self.__entry['module'], self.__entry['class'])
+
+__manifest = None
+
+def get_scrapers():
+    """
+    Returns a LazyScraper for every scraper in the manifest (in import order)
+    """
+    return [LazyScraper(entry) for entry in get_manifest()['scrapers']]
+
+def get_manifest():
+    global __manifest
+    if __manifest is None:
+        __manifest = load_manifest()
+    return __manifest
+
+def reset_manifest():
+    # the next get_manifest re-checks the source hash (and rebuilds if the scraper files changed)
+    global __manifest
+    __manifest = None
+
+def get_scraper_modules():
+    """
+    SCRAPER_MODULES plus any scraper the updater downloaded that isn't in it
+    """
+    modules = list(SCRAPER_MODULES)
+    scraper_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(LIST_PATH, 'r') as f:
+            scraper_list = f.read()
+    except IOError:
+        return modules
+
+    for line in scraper_list.split('\n'):
+        line = line.replace(' ', '')
+        if not line or ',' not in line: continue
+        module = os.path.splitext(line.split(',')[1])[0]
+        if module and module not in modules and os.path.exists(os.path.join(scraper_dir, module + '.py')):
+            modules.append(module)
+    return modules
+
+def load_manifest():
+    source_hash = get_source_hash()
+    try:
+        with open(MANIFEST_PATH, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION and manifest.get('hash') == source_hash:
+            return manifest
+    except (IOError, ValueError):
+        pass
+    except Exception as e:
+        log_utils.log('Unable to read scraper manifest: %s' % (e), log_utils.LOGWARNING)
+
+    log_utils.log('Scraper manifest out of date; rebuilding: %s' % (source_hash), log_utils.LOGDEBUG)
+    manifest = build_manifest(source_hash)
+    update_settings(manifest['scrapers'])
+    try:
+        with open(MANIFEST_PATH, 'w') as f:
+            json.dump(manifest, f)
+    except Exception as e:
+        log_utils.log('Unable to write scraper manifest: %s' % (e), log_utils.LOGWARNING)
+    return manifest
+
+def get_source_hash():
+    """
+    Hash of everything the manifest is built from: the scraper sources, the addon version and the UI language (labels
+    in the generated settings are translated)
+    """
+    h = hashlib.md5()
+    h.update('%s|%s|%s' % (MANIFEST_VERSION, kodi.get_version(), xbmc.getLanguage()))
+    scraper_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in ['scraper', 'proxy'] + get_scraper_modules():
+        try: stat = os.stat(os.path.join(scraper_dir, module + '.py'))
+        except OSError: stat = None
+        h.update('|%s:%s:%s' % (module, stat.st_size if stat else '', stat.st_mtime if stat else ''))
+    return h.hexdigest()
+
+def build_manifest(source_hash):
+    for module in get_scraper_modules():
+        try:
+            __import__('scrapers.%s' % (module))
+        except Exception as e:
+            log_utils.log('Failure importing scraper %s: %s' % (module, e), log_utils.LOGWARNING)
+
+    entries = []
+    classes = scraper.Scraper.__class__.__subclasses__(scraper.Scraper)  # @UndefinedVariable
+    classes += proxy.Proxy.__class__.__subclasses__(proxy.Proxy)  # @UndefinedVariable
+    for cls in classes:
+        if not cls.get_name() or cls.has_proxy(): continue
+        module = cls.__module__.split('.')[-1]
+        entries.append({'name': cls.get_name(), 'provides': sorted(cls.provides()), 'settings': cls.get_settings(), 'module': module, 'class': cls.__name__})
+    return {'version': MANIFEST_VERSION, 'hash': source_hash, 'scrapers': entries}
+
 def update_xml(xml, new_settings, cat_count):
     new_settings.insert(0, '<category label="Scrapers %s">' % (cat_count))
     new_settings.append('    </category>')
@@ -83,7 +217,7 @@ def update_xml(xml, new_settings, cat_count):
         log_utils.log('Unable to match category: %s' % (cat_count), log_utils.LOGWARNING)
     return xml
 
-def update_settings():
+def update_settings(entries):
     full_path = os.path.join(kodi.get_path(), 'resources', 'settings.xml')
     
     try:
@@ -99,11 +233,8 @@ def update_settings():
         new_settings = []
         cat_count = 1
         old_xml = xml
-        classes = scraper.Scraper.__class__.__subclasses__(scraper.Scraper)  # @UndefinedVariable
-        classes += proxy.Proxy.__class__.__subclasses__(proxy.Proxy)  # @UndefinedVariable
-        for cls in sorted(classes, key=lambda x: x.get_name().upper()):
-            if not cls.get_name() or cls.has_proxy(): continue
-            new_settings += cls.get_settings()
+        for entry in sorted(entries, key=lambda x: x['name'].upper()):
+            new_settings += [setting.encode('utf-8') if isinstance(setting, unicode) else setting for setting in entry['settings']]
             if len(new_settings) > 90:
                 xml = update_xml(xml, new_settings, cat_count)
                 new_settings = []
@@ -120,12 +251,17 @@ def update_settings():
 
 
 def update_all_scrapers():
+        """
+        Download the scraper list and any changed scrapers at most once a day; run from the service rather than at
+        import. Returns True if a scraper file changed (the manifest is reset so the next get_manifest rebuilds it)
+        """
+        updated = False
         try: last_check = int(kodi.get_setting('last_list_check'))
         except: last_check = 0
         now = int(time.time())
         list_url = kodi.get_setting('scraper_url')
         scraper_password = kodi.get_setting('scraper_password')
-        list_path = os.path.join(kodi.translate_path(kodi.get_profile()), 'scraper_list.txt')
+        list_path = LIST_PATH
         exists = os.path.exists(list_path)
         if list_url and scraper_password and (not exists or last_check < (now - (24 * 60 * 60))):
             scraper_list = utils2.get_and_decrypt(list_url, scraper_password)
@@ -141,9 +277,12 @@ def update_all_scrapers():
                         if line:
                             scraper_url, filename = line.split(',')
                             if scraper_url.startswith('http'):
-                                update_scraper(filename, scraper_url)
+                                updated = update_scraper(filename, scraper_url) or updated
                 except Exception as e:
                     log_utils.log('Exception during scraper update: %s' % (e), log_utils.LOGWARNING)
+
+        if updated: reset_manifest()
+        return updated
     
 def update_scraper(filename, scraper_url):
     try:
@@ -164,9 +303,10 @@ def update_scraper(filename, scraper_url):
                 if old_py != new_py:
                     with open(py_path, 'w') as f:
                         f.write(new_py)
+                    return True
                         
     except Exception as e:
         log_utils.log('Failure during %s scraper update: %s' % (filename, e), log_utils.LOGWARNING)
+    return False
 
-update_settings()
-update_all_scrapers()
+get_manifest()
@@ -161,7 +161,7 @@ class DDLValley_Scraper(scraper.Scraper):
         return slug
         
     def __too_old(self, post):
-        filter_days = datetime.timedelta(days=int(kodi.get_setting('%s-filter' % (self.get_name()))))
+        filter_days = datetime.timedelta(days=kodi.get_settings().filter_days(self.get_name()))
         if filter_days:
             today = datetime.date.today()
             match = re.search('<span\s+class="date">(.*?)\s+(\d+)[^<]+(\d{4})<', post)
@@ -137,15 +137,11 @@ class Diziay_Scraper(scraper.Scraper):
             return self._default_get_episode_url(SEASON_URL, video, episode_pattern, title_pattern, data=data, headers=XHR)
 
     def search(self, video_type, title, year, season=''):
-        html = self._http_get(self.base_url, cache_limit=8)
-        results = []
+        return self._search_catalog(self.base_url, self.__parse_catalog, title, cache_limit=8)
+
+    def __parse_catalog(self, html):
         fragment = dom_parser.parse_dom(html, 'div', {'class': '[^"]*dizis[^"]*'})
-        norm_title = scraper_utils.normalize_title(title)
         if fragment:
             for match in re.finditer('href="([^"]+)[^>]*>([^<]+)', fragment[0]):
                 url, match_title = match.groups()
-                if norm_title in scraper_utils.normalize_title(match_title):
-                    result = {'url': scraper_utils.pathify_url(url), 'title': scraper_utils.cleanse_title(match_title), 'year': ''}
-                    results.append(result)
-
-        return results
+                yield url, match_title, ''
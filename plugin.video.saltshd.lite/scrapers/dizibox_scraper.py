@@ -127,17 +127,10 @@ class Dizibox_Scraper(scraper.Scraper):
             return self._default_get_episode_url(season_url, video, episode_pattern)
 
     def search(self, video_type, title, year, season=''):
-        html = self._http_get(self.base_url, cache_limit=8)
-        results = []
-        seen_urls = {}
-        norm_title = scraper_utils.normalize_title(title)
+        return self._search_catalog(self.base_url, self.__parse_catalog, title, cache_limit=8)
+
+    def __parse_catalog(self, html):
         for fragment in dom_parser.parse_dom(html, 'ul', {'class': 'category-list'}):
             for match in re.finditer('''href=["']([^'"]+)[^>]+>([^<]+)''', fragment):
                 url, match_title = match.groups()
-                if url not in seen_urls:
-                    seen_urls[url] = True
-                    if norm_title in scraper_utils.normalize_title(match_title):
-                        result = {'url': scraper_utils.pathify_url(url), 'title': scraper_utils.cleanse_title(match_title), 'year': ''}
-                        results.append(result)
-
-        return results
+                yield url, match_title, ''
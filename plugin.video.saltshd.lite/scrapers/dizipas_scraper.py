@@ -151,21 +151,15 @@ class Dizipas_Scraper(scraper.Scraper):
         return self._default_get_episode_url(show_url, video, episode_pattern, title_pattern)
 
     def search(self, video_type, title, year, season=''):
-        results = []
         xml_url = urlparse.urljoin(self.base_url, '/series.xml')
-        xml = self._http_get(xml_url, cache_limit=24)
-        if xml:
-            norm_title = scraper_utils.normalize_title(title)
-            match_year = ''
-            try:
-                for element in ET.fromstring(xml).findall('.//dizi'):
-                    name = element.find('adi')
-                    if name is not None and norm_title in scraper_utils.normalize_title(name.text):
-                        url = element.find('url')
-                        if url is not None and (not year or not match_year or year == match_year):
-                            result = {'url': scraper_utils.pathify_url(url.text), 'title': scraper_utils.cleanse_title(name.text), 'year': ''}
-                            results.append(result)
-            except (ParseError, ExpatError) as e:
-                log_utils.log('Dizilab Search Parse Error: %s' % (e), log_utils.LOGWARNING)
-
-        return results
+        return self._search_catalog(xml_url, self.__parse_catalog, title, year, cache_limit=24)
+
+    def __parse_catalog(self, xml):
+        try:
+            for element in ET.fromstring(xml).findall('.//dizi'):
+                name = element.find('adi')
+                url = element.find('url')
+                if name is not None and name.text and url is not None:
+                    yield url.text, name.text, ''
+        except (ParseError, ExpatError) as e:
+            log_utils.log('Dizilab Search Parse Error: %s' % (e), log_utils.LOGWARNING)
@@ -123,7 +123,7 @@ class RlsBB_Scraper(scraper.Scraper):
         return results
 
     def __too_old(self, post):
-        filter_days = datetime.timedelta(days=int(kodi.get_setting('%s-filter' % (self.get_name()))))
+        filter_days = datetime.timedelta(days=kodi.get_settings().filter_days(self.get_name()))
         if filter_days:
             today = datetime.date.today()
             match = re.search('class="postMonth"\s+title="([^"]+)">([^<]+).*?class="postDay"[^>]*>([^<]+)', post)
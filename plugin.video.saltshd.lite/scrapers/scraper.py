@@ -29,7 +29,9 @@ import urllib2
 import urlparse
 import xbmcgui
 import urlresolver
+from salts_lib import catalog
 from salts_lib import cloudflare
+from salts_lib import http_pool
 from salts_lib import kodi
 from salts_lib import log_utils
 from salts_lib import scraper_utils
@@ -37,7 +39,7 @@ from salts_lib.constants import FORCE_NO_MATCH
 from salts_lib.constants import Q_ORDER
 from salts_lib.constants import SHORT_MONS
 from salts_lib.constants import VIDEO_TYPES
-from salts_lib.db_utils import DB_Connection
+from salts_lib.db_utils import get_db_connection
 from salts_lib.kodi import i18n
 
 
@@ -47,6 +49,7 @@ COOKIEPATH = kodi.translate_path(kodi.get_profile())
 MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
 # Q_LIST = [item[0] for item in sorted(Q_ORDER.items(), key=lambda x:x[1])]
 MAX_RESPONSE = 1024 * 1024 * 2
+COOKIE_FLUSH_INTERVAL = 60
 
 class NoRedirection(urllib2.HTTPErrorProcessor):
     def http_response(self, request, response):
@@ -72,6 +75,12 @@ class Scraper(object):
     db_connection = None
     worker_id = None
     debrid_resolvers = None
+    __openers = {}
+    __conn_pools = {}
+    __cookie_jars = {}
+    __dirty_jars = set()
+    __last_flush = time.time()
+    __http_lock = threading.RLock()
 
     def __init__(self, timeout=DEFAULT_TIMEOUT):
         pass
@@ -263,7 +272,7 @@ class Scraper(object):
         if headers is None: headers = {}
         if url.startswith('//'): url = 'http:' + url
         referer = headers['Referer'] if 'Referer' in headers else url
-        log_utils.log('Getting Url: %s cookie=|%s| data=|%s| extra headers=|%s|' % (url, cookies, data, headers), log_utils.LOGDEBUG)
+        log_utils.log('Getting Url: %s cookie=|%s| data=|%s| extra headers=|%s|', log_utils.LOGDEBUG, url, cookies, data, headers)
         if data is not None:
             if isinstance(data, basestring):
                 data = data
@@ -277,75 +286,65 @@ class Scraper(object):
         self.create_db_connection()
         _created, _res_header, html = self.db_connection.get_cached_url(url, data, cache_limit)
         if html:
-            log_utils.log('Returning cached result for: %s' % (url), log_utils.LOGDEBUG)
+            log_utils.log('Returning cached result for: %s', log_utils.LOGDEBUG, url)
             return html
 
-        try:
-            self.cj = self._set_cookies(base_url, cookies)
-            request = urllib2.Request(url, data=data)
-            request.add_header('User-Agent', scraper_utils.get_ua())
-            request.add_header('Accept', '*/*')
-            request.add_unredirected_header('Host', request.get_host())
-            request.add_unredirected_header('Referer', referer)
-            for key in headers: request.add_header(key, headers[key])
-            self.cj.add_cookie_header(request)
-            if not allow_redirect:
-                opener = urllib2.build_opener(NoRedirection)
-                urllib2.install_opener(opener)
-            else:
-                opener = urllib2.build_opener(urllib2.HTTPRedirectHandler)
-                urllib2.install_opener(opener)
-                opener2 = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cj))
-                urllib2.install_opener(opener2)
-
-            if method is not None: request.get_method = lambda: method.upper()
-            response = urllib2.urlopen(request, timeout=timeout)
-            self.cj.extract_cookies(response, request)
-            if kodi.get_setting('cookie_debug') == 'true':
-                log_utils.log('Response Cookies: %s - %s' % (url, scraper_utils.cookies_as_str(self.cj)), log_utils.LOGDEBUG)
-            self.cj._cookies = scraper_utils.fix_bad_cookies(self.cj._cookies)
-            self.cj.save(ignore_discard=True)
-            if not allow_redirect and (response.getcode() in [301, 302, 303, 307] or response.info().getheader('Refresh')):
-                if response.info().getheader('Refresh') is not None:
-                    refresh = response.info().getheader('Refresh')
-                    return refresh.split(';')[-1].split('url=')[-1]
-                else:
-                    return response.info().getheader('Location')
+        with log_utils.span('fetch'):
+            try:
+                self.cj = self._set_cookies(base_url, cookies)
+                request = urllib2.Request(url, data=data)
+                request.add_header('User-Agent', scraper_utils.get_ua())
+                request.add_header('Accept', '*/*')
+                request.add_unredirected_header('Host', request.get_host())
+                request.add_unredirected_header('Referer', referer)
+                for key in headers: request.add_header(key, headers[key])
+                self.cj.add_cookie_header(request)
+                if method is not None: request.get_method = lambda: method.upper()
+                response = self._get_opener(allow_redirect).open(request, timeout=timeout)
+                self.cj.extract_cookies(response, request)
+                if kodi.get_setting('cookie_debug') == 'true' and log_utils.is_enabled():
+                    log_utils.log('Response Cookies: %s - %s' % (url, scraper_utils.cookies_as_str(self.cj)), log_utils.LOGDEBUG)
+                self._save_cookies()
+                if not allow_redirect and (response.getcode() in [301, 302, 303, 307] or response.info().getheader('Refresh')):
+                    if response.info().getheader('Refresh') is not None:
+                        refresh = response.info().getheader('Refresh')
+                        return refresh.split(';')[-1].split('url=')[-1]
+                    else:
+                        return response.info().getheader('Location')
             
-            content_length = response.info().getheader('Content-Length', 0)
-            if int(content_length) > MAX_RESPONSE:
-                log_utils.log('Response exceeded allowed size. %s => %s / %s' % (url, content_length, MAX_RESPONSE), log_utils.LOGWARNING)
+                content_length = response.info().getheader('Content-Length', 0)
+                if int(content_length) > MAX_RESPONSE:
+                    log_utils.log('Response exceeded allowed size. %s => %s / %s' % (url, content_length, MAX_RESPONSE), log_utils.LOGWARNING)
             
-            if method == 'HEAD':
-                return ''
-            else:
-                if response.info().get('Content-Encoding') == 'gzip':
-                    buf = StringIO(response.read(MAX_RESPONSE))
-                    f = gzip.GzipFile(fileobj=buf)
-                    html = f.read()
+                if method == 'HEAD':
+                    return ''
                 else:
-                    html = response.read(MAX_RESPONSE)
-        except urllib2.HTTPError as e:
-            if e.code == 503 and 'cf-browser-verification' in e.read():
-                html = cloudflare.solve(url, self.cj, scraper_utils.get_ua())
-                if not html:
+                    if response.info().get('Content-Encoding') == 'gzip':
+                        buf = StringIO(response.read(MAX_RESPONSE))
+                        f = gzip.GzipFile(fileobj=buf)
+                        html = f.read()
+                    else:
+                        html = response.read(MAX_RESPONSE)
+            except urllib2.HTTPError as e:
+                if e.code == 503 and 'cf-browser-verification' in e.read():
+                    # cloudflare works against the cookie file, so get it current first
+                    Scraper.flush_cookies()
+                    html = cloudflare.solve(url, self.cj, scraper_utils.get_ua())
+                    if not html:
+                        return ''
+                else:
+                    log_utils.log('Error (%s) during scraper http get: %s' % (str(e), url), log_utils.LOGWARNING)
                     return ''
-            else:
+            except Exception as e:
                 log_utils.log('Error (%s) during scraper http get: %s' % (str(e), url), log_utils.LOGWARNING)
                 return ''
-        except Exception as e:
-            log_utils.log('Error (%s) during scraper http get: %s' % (str(e), url), log_utils.LOGWARNING)
-            return ''
 
         self.db_connection.cache_url(url, html, data)
         return html
 
     def _set_cookies(self, base_url, cookies):
-        cookie_file = os.path.join(COOKIEPATH, '%s_cookies.lwp' % (self.get_name()))
-        cj = cookielib.LWPCookieJar(cookie_file)
-        try: cj.load(ignore_discard=True)
-        except: pass
-        if kodi.get_setting('cookie_debug') == 'true':
+        cj = self.__get_cookie_jar()
+        if kodi.get_setting('cookie_debug') == 'true' and log_utils.is_enabled():
             log_utils.log('Before Cookies: %s - %s' % (self, scraper_utils.cookies_as_str(cj)), log_utils.LOGDEBUG)
         domain = urlparse.urlsplit(base_url).hostname
         for key in cookies:
@@ -353,11 +352,66 @@ class Scraper(object):
                                  domain_initial_dot=False, path='/', path_specified=True, secure=False, expires=None, discard=False, comment=None,
                                  comment_url=None, rest={})
             cj.set_cookie(c)
-        cj.save(ignore_discard=True)
-        if kodi.get_setting('cookie_debug') == 'true':
+        if cookies: self._save_cookies()
+        if kodi.get_setting('cookie_debug') == 'true' and log_utils.is_enabled():
             log_utils.log('After Cookies: %s - %s' % (self, scraper_utils.cookies_as_str(cj)), log_utils.LOGDEBUG)
         return cj
 
+    def __get_cookie_jar(self):
+        name = self.get_name()
+        with Scraper.__http_lock:
+            if name not in Scraper.__cookie_jars:
+                cookie_file = os.path.join(COOKIEPATH, '%s_cookies.lwp' % (name))
+                cj = cookielib.LWPCookieJar(cookie_file)
+                try: cj.load(ignore_discard=True)
+                except: pass
+                Scraper.__cookie_jars[name] = cj
+            return Scraper.__cookie_jars[name]
+
+    def _get_opener(self, allow_redirect=True):
+        """
+        Openers (and their keep-alive connections) are shared by every instance of a scraper and never installed globally
+        """
+        name = self.get_name()
+        key = (name, allow_redirect)
+        with Scraper.__http_lock:
+            if key not in Scraper.__openers:
+                pool = Scraper.__conn_pools.setdefault(name, http_pool.ConnectionPool())
+                handlers = [http_pool.HTTPHandler(pool), http_pool.HTTPSHandler(pool)]
+                if allow_redirect:
+                    handlers.append(urllib2.HTTPCookieProcessor(self.__get_cookie_jar()))
+                else:
+                    handlers.append(NoRedirection)
+                Scraper.__openers[key] = urllib2.build_opener(*handlers)
+            return Scraper.__openers[key]
+
+    def _save_cookies(self):
+        """
+        Mark this scraper's cookie jar as changed; jars are written to disk in batches by flush_cookies
+        """
+        with Scraper.__http_lock:
+            Scraper.__dirty_jars.add(self.get_name())
+            flush = time.time() - Scraper.__last_flush >= COOKIE_FLUSH_INTERVAL
+        if flush:
+            Scraper.flush_cookies()
+
+    @classmethod
+    def flush_cookies(cls):
+        with Scraper.__http_lock:
+            Scraper.__last_flush = time.time()
+            for name in Scraper.__dirty_jars:
+                cj = Scraper.__cookie_jars[name]
+                cj._cookies = scraper_utils.fix_bad_cookies(cj._cookies)
+                try: cj.save(ignore_discard=True)
+                except Exception as e: log_utils.log('Failed to save cookies for %s: %s' % (name, e), log_utils.LOGWARNING)
+            Scraper.__dirty_jars.clear()
+
+    @classmethod
+    def close_connections(cls):
+        with Scraper.__http_lock:
+            for pool in Scraper.__conn_pools.itervalues():
+                pool.close()
+
     def _do_recaptcha(self, key, tries=None, max_tries=None):
         challenge_url = CAPTCHA_BASE_URL + '/challenge?k=%s' % (key)
         html = self._cached_http_get(challenge_url, CAPTCHA_BASE_URL, timeout=DEFAULT_TIMEOUT, cache_limit=0)
@@ -433,17 +487,15 @@ class Scraper(object):
         norm_title = scraper_utils.normalize_title(show_title)
 
         today = datetime.date.today()
+        filter_days = datetime.timedelta(days=kodi.get_settings().filter_days(self.get_name()))
         for match in re.finditer(post_pattern, html, re.DOTALL):
             post_data = match.groupdict()
             post_title = post_data['post_title']
             if 'quality' in post_data:
                 post_title += '- [%s]' % (post_data['quality'])
 
-            try: filter_days = int(kodi.get_setting('%s-filter' % (self.get_name())))
-            except ValueError: filter_days = 0
             if filter_days and date_format and 'date' in post_data:
                 post_data['date'] = post_data['date'].strip()
-                filter_days = datetime.timedelta(days=filter_days)
                 try: post_date = datetime.datetime.strptime(post_data['date'], date_format).date()
                 except TypeError:
                     try:
@@ -494,7 +546,7 @@ class Scraper(object):
             url = result[0][0]
             log_utils.log('Got local related url: |%s|%s|%s|%s|%s|' % (video.video_type, video.title, video.year, self.get_name(), url), log_utils.LOGDEBUG)
         else:
-            select = int(kodi.get_setting('%s-select' % (self.get_name())))
+            select = kodi.get_settings().scraper_select(self.get_name())
             if video.video_type == VIDEO_TYPES.EPISODE:
                 temp_title = re.sub('[^A-Za-z0-9 ]', '', video.title)
                 if not scraper_utils.force_title(video):
@@ -633,11 +685,24 @@ class Scraper(object):
             cookies.append('%s=%s' % (cookie.name, cookie.value))
         return urllib.quote(';'.join(cookies))
 
+    def _search_catalog(self, url, parse, title, year='', cache_limit=8):
+        """
+        search() for sites that list every show on one page: parse(html) yields (url, title, year) for each show on it
+        and is only run again once the catalog is more than cache_limit hours old
+        """
+        def parse_catalog(html):
+            for match_url, match_title, match_year in parse(html):
+                yield scraper_utils.pathify_url(match_url), match_title, match_year
+
+        self.create_db_connection()
+        index = catalog.get_catalog(self.db_connection, self.get_name(), url, lambda: self._http_get(url, cache_limit=cache_limit), parse_catalog, cache_limit)
+        return index.search(title, year)
+
     def create_db_connection(self):
         worker_id = threading.current_thread().ident
         # create a connection if we don't have one or it was created in a different worker
         if self.db_connection is None or self.worker_id != worker_id:
-            self.db_connection = DB_Connection()
+            self.db_connection = get_db_connection()
             self.worker_id = worker_id
 
     def _parse_sources_list(self, html):
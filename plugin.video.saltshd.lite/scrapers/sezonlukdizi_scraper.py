@@ -126,14 +126,10 @@ class SezonLukDizi_Scraper(scraper.Scraper):
                 return result
 
     def search(self, video_type, title, year, season=''):
-        results = []
         search_url = urlparse.urljoin(self.base_url, SEARCH_URL)
-        html = self._http_get(search_url, cache_limit=48)
-        norm_title = scraper_utils.normalize_title(title)
-        match_year = ''
+        return self._search_catalog(search_url, self.__parse_catalog, title, year, cache_limit=48)
+
+    def __parse_catalog(self, html):
         for match in re.finditer('d\s*:\s*"([^"]+).*?u\s*:\s*"([^"]+)', html):
             match_title, match_url = match.groups()
-            if norm_title in scraper_utils.normalize_title(match_title) and (not year or not match_year or year == match_year):
-                result = {'url': scraper_utils.pathify_url(match_url), 'title': scraper_utils.cleanse_title(match_title), 'year': match_year}
-                results.append(result)
-        return results
+            yield match_url, match_title, ''
@@ -15,6 +15,8 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import threading
+import time
 import xbmc
 import xbmcgui
 import xbmcaddon
@@ -22,14 +24,18 @@ from salts_lib import kodi
 from salts_lib import log_utils
 from salts_lib import utils
 from salts_lib import utils2
+from salts_lib import downloader
+import scrapers
 from salts_lib.constants import MODES
 from salts_lib.constants import TRIG_DB_UPG
-from salts_lib.db_utils import DB_Connection
+from salts_lib.db_utils import get_db_connection, close_db_connections
 
 MAX_ERRORS = 10
+PRUNE_INTERVAL = 60 * 60
+SCRAPER_UPDATE_INTERVAL = 60 * 60  # update_all_scrapers only downloads once a day; this is how often it's asked
 
 log_utils.log('Service: Installed Version: %s' % (kodi.get_version()), log_utils.LOGNOTICE)
-db_connection = DB_Connection()
+db_connection = get_db_connection()
 if kodi.get_setting('use_remote_db') == 'false' or kodi.get_setting('enable_upgrade') == 'true':
     if TRIG_DB_UPG:
         db_version = db_connection.get_db_version()
@@ -61,6 +67,7 @@ class Service(xbmc.Player):
         self.season = None
         self.episode = None
         self._lastPos = 0
+        self._prefetched = False
 
     def onPlayBackStarted(self):
         log_utils.log('Service: Playback started', log_utils.LOGNOTICE)
@@ -128,11 +135,33 @@ class Service(xbmc.Player):
                         xbmc.executebuiltin(run)
             self.reset()
 
+    def check_prefetch(self):
+        # once enough of an episode has played, get the next one's sources into the source cache
+        if self._prefetched or not self.season or not self.episode or self._totalTime in (0, 999999):
+            return
+
+        settings = kodi.get_settings()
+        percent = settings.get_int('prefetch_next')
+        if not percent or not settings.get_int('source_cache_ttl'):
+            return
+
+        if self._lastPos * 100 / self._totalTime >= percent:
+            log_utils.log('Service: Prefetching the episode after |%s|%s|%s|' % (self.trakt_id, self.season, self.episode), log_utils.LOGDEBUG)
+            self._prefetched = True
+            utils.prefetch_next_episode(self.trakt_id, self.season, self.episode)
+
     def onPlayBackEnded(self):
         log_utils.log('Service: Playback completed', log_utils.LOGNOTICE)
         self.onPlayBackStopped()
 
+class SettingsMonitor(xbmc.Monitor):
+    def onSettingsChanged(self):
+        # the service outlives any one settings snapshot
+        log_utils.log('Service: Settings changed, reloading...', log_utils.LOGDEBUG)
+        kodi.refresh_settings()
+
 monitor = Service()
+settings_monitor = SettingsMonitor()
 utils.do_startup_task(MODES.UPDATE_SUBS)
 
 was_on = False
@@ -151,13 +180,46 @@ def disable_global_cx():
             sf.setSetting('CONTEXT', 'true')
             was_on = False
     
+def update_scrapers():
+    try:
+        if scrapers.update_all_scrapers():
+            # rebuild the manifest (and the scraper settings) here so plugin calls find it current
+            scrapers.get_manifest()
+    except Exception as e:
+        log_utils.log('Service: Scraper update failed: %s' % (e), log_utils.LOGWARNING)
+
+def prune_cache():
+    try:
+        max_age = int(kodi.get_setting('cache_max_age'))
+        max_size = int(kodi.get_setting('cache_max_size'))
+    except ValueError:
+        return
+
+    try: get_db_connection().prune_cache(max_age, max_size)
+    except Exception as e: log_utils.log('Service: Cache pruning failed: %s' % (e), log_utils.LOGWARNING)
+
 errors = 0
+last_prune = 0
+last_scraper_update = 0
+download_queue = downloader.DownloadQueue()
 while not xbmc.abortRequested:
     try:
         isPlaying = monitor.isPlaying()
         utils.do_scheduled_task(MODES.UPDATE_SUBS, isPlaying)
+        download_queue.poll()
         if monitor.tracked and monitor.isPlayingVideo():
             monitor._lastPos = monitor.getTime()
+            monitor.check_prefetch()
+        if not isPlaying and time.time() - last_prune >= PRUNE_INTERVAL:
+            last_prune = time.time()
+            pruner = threading.Thread(target=prune_cache)
+            pruner.daemon = True
+            pruner.start()
+        if not isPlaying and time.time() - last_scraper_update >= SCRAPER_UPDATE_INTERVAL:
+            last_scraper_update = time.time()
+            updater = threading.Thread(target=update_scrapers)
+            updater.daemon = True
+            updater.start()
     except Exception as e:
         errors += 1
         if errors >= MAX_ERRORS:
@@ -171,4 +233,6 @@ while not xbmc.abortRequested:
     xbmc.sleep(1000)
     disable_global_cx()
     
+download_queue.stop()
+close_db_connections()
 log_utils.log('Service: shutting down...', log_utils.LOGNOTICE)